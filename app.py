@@ -1,10 +1,21 @@
 import streamlit as st
-import json
-from datetime import datetime
-from llm_service import LLMService, MockLLMService
-from ingestion import generate_mock_emails
+from datetime import datetime, timedelta
+from llm_service import LLMService, MockLLMService, TASK_SETTINGS
+from llm_router import LLMRouter
+from ingestion import generate_mock_emails, import_mbox, import_maildir
+from mail_store import MailStore, STARTUP_MONTHS
+from chat_memory import ChatMemory
+from task_extraction import extract_tasks, parse_due, LOCAL_TASK_CONFIDENCE
+from scheduler import CategorizeRun, CHECKPOINT_EVERY
+from budget import Budget, BUDGET_MAX_TOKENS, BUDGET_MAX_COST, BUDGET_MAX_MINUTES
+from state_snapshot import SNAPSHOT_EVERY
+from prefetch import (Prefetcher, email_context, SUMMARY_QUERY, DRAFT_QUERY,
+                      PREFETCH_MAX_CALLS, PREFETCH_MAX_EMAILS)
 import storage
 
+# Emails retrieved per mailbox question; the prompt budget decides how many are actually sent
+MAILBOX_TOP_K = 10
+
 # Page configuration
 st.set_page_config(
     page_title="Email Productivity Agent",
@@ -76,6 +87,13 @@ if 'selected_email_id' not in st.session_state:
     st.session_state.selected_email_id = None
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
+if 'mailbox_chat_history' not in st.session_state:
+    st.session_state.mailbox_chat_history = []
+# Bounded history actually sent to the LLM (recent turns verbatim + rolling summary)
+if 'chat_memory' not in st.session_state:
+    st.session_state.chat_memory = ChatMemory()
+if 'mailbox_memory' not in st.session_state:
+    st.session_state.mailbox_memory = ChatMemory()
 if 'llm_provider' not in st.session_state:
     st.session_state.llm_provider = "mock"
 if 'llm_service' not in st.session_state:
@@ -84,53 +102,131 @@ if 'llm_service' not in st.session_state:
     else:
         st.session_state.llm_service = LLMService(provider=st.session_state.llm_provider)
 
-# Load Data on Startup
-if 'emails' not in st.session_state:
-    emails = storage.load_emails()
-    if not emails:
-        emails = generate_mock_emails(20)
-        storage.save_emails(emails)
-    st.session_state.emails = emails
+@st.cache_resource
+def get_store():
+    """One MailStore per server process, shared by every browser session."""
+    store = MailStore()
+    store.load()
+    # Mock mail would create a new store over an older one whose migration failed
+    if not len(store) and not storage.list_partitions() and not storage.migration_pending():
+        store.add_emails(generate_mock_emails(20))
+    return store
+
+@st.cache_resource
+def get_prefetcher():
+    """Background summary/draft generator, shared like the store it reads from."""
+    return Prefetcher(get_store())
+
+@st.cache_resource
+def get_categorizer():
+    """Background Categorize All run, shared like the store it writes to."""
+    return CategorizeRun(get_store())
+
+def get_prompts_dict():
+    return {k: v['template'] for k, v in st.session_state.prompts.items()}
+
+def sync_session():
+    """Bring this session's view of the shared store up to date, fetching only deltas."""
+    store = get_store()
+    store.refresh_partitions()  # Picks up results merged by batch_jobs.py in another process
+    delta = None
+    if 'emails' in st.session_state:
+        if st.session_state.store_version == store.version:
+            delta = (store.version, [])
+        else:
+            delta = store.changes_since(st.session_state.store_version)
+    if delta is None:
+        version, records = store.snapshot()
+        st.session_state.emails = list(records)
+    else:
+        version, changed = delta
+        emails = st.session_state.emails
+        for position, record in changed:
+            if position < len(emails):
+                emails[position] = record
+            else:
+                emails.append(record)
+    st.session_state.store_version = version
 
-if 'prompts' not in st.session_state:
-    st.session_state.prompts = storage.load_prompts()
+    if st.session_state.get('prompts_version') != store.prompts_version:
+        st.session_state.prompts = store.prompts
+        st.session_state.prompts_version = store.prompts_version
+    if st.session_state.get('drafts_version') != store.drafts_version:
+        st.session_state.drafts = store.drafts
+        st.session_state.drafts_version = store.drafts_version
 
-if 'drafts' not in st.session_state:
-    st.session_state.drafts = storage.load_drafts()
+# Load Data on Startup (and pick up other sessions' changes on every rerun)
+sync_session()
 
 def get_category_class(category: str) -> str:
     return category.lower().replace("-", "_")
 
-def render_email_card(email, is_selected=False):
+def get_thread_text(email):
+    """Body text for the LLM: the deduplicated conversation if the email is part of a thread."""
+    return get_store().thread_text(email)
+
+# Rendered HTML is cached per (email id, rev): rev changes whenever category, action
+# items, tasks or read state change, so an entry never goes stale. The record itself
+# is passed as an underscore argument, which st.cache_data leaves out of the key.
+
+@st.cache_data(max_entries=5000, show_spinner=False)
+def email_card_html(email_id, rev, is_selected, thread_size, _email):
+    email = _email
     category_class = get_category_class(email['category'])
     card_style = "border: 2px solid #667eea;" if is_selected else ""
     
     action_count = len(email.get('action_items', []))
+    thread_label = f' <span style="color: #9ca3af;">🧵 {thread_size} messages</span>' if thread_size > 1 else ''
+    unread = '<span title="Unread">🔵</span> ' if not email['is_read'] else ''
     
-    st.markdown(f"""
+    return f"""
     <div class="email-card" style="{card_style}">
         <div>
             <span class="category-badge {category_class}">{email['category']}</span>
-            <strong style="font-size: 1.1rem;">{email['subject']}</strong>
+            {unread}<strong style="font-size: 1.1rem;">{email['subject']}</strong>{thread_label}
         </div>
         <div style="margin-top: 0.5rem; color: #9ca3af;">
             From: {email['sender']} | {email['timestamp'].strftime('%Y-%m-%d %H:%M')}
         </div>
         {f'<div style="margin-top: 0.5rem;">📋 {action_count} action item(s)</div>' if action_count > 0 else ''}
     </div>
-    """, unsafe_allow_html=True)
+    """
+
+@st.cache_data(max_entries=500, show_spinner=False)
+def email_detail_html(email_id, rev, _email):
+    email = _email
+    category_class = get_category_class(email['category'])
+    return f"""
+    <div style="background: rgba(255,255,255,0.05); padding: 1.5rem; border-radius: 10px;">
+        <div><span class="category-badge {category_class}">{email['category']}</span></div>
+        <h3>{email['subject']}</h3>
+        <p style="color: #9ca3af;">From: {email['sender']}</p>
+        <p style="color: #9ca3af;">Date: {email['timestamp'].strftime('%Y-%m-%d %H:%M')}</p>
+        <hr style="border-color: rgba(255,255,255,0.1);">
+        <p style="white-space: pre-wrap;">{storage.get_body(email)}</p>
+    </div>
+    """
+
+def clear_render_cache():
+    """Needed when email ids are reused (Reset All Data)."""
+    email_card_html.clear()
+    email_detail_html.clear()
+
+def render_email_card(email, is_selected=False, thread_size=1):
+    st.markdown(email_card_html(email['id'], email['rev'], is_selected, thread_size, email), unsafe_allow_html=True)
 
 def main():
     st.sidebar.markdown("## 📧 Email Productivity Agent")
     
     # LLM Provider Selection
     st.sidebar.markdown("### 🤖 LLM Provider")
-    llm_options = ["mock", "openai", "gemini", "huggingface"]
+    llm_options = ["mock", "openai", "gemini", "huggingface", "router"]
     llm_labels = {
         "mock": "Mock (Testing)",
         "openai": "OpenAI GPT",
         "gemini": "Google Gemini",
-        "huggingface": "Hugging Face"
+        "huggingface": "Hugging Face",
+        "router": "Auto (Hedged Failover)"
     }
     
     selected_provider = st.sidebar.selectbox(
@@ -146,7 +242,10 @@ def main():
             st.session_state.llm_service = MockLLMService()
         else:
             try:
-                st.session_state.llm_service = LLMService(provider=selected_provider)
+                if selected_provider == "router":
+                    st.session_state.llm_service = LLMRouter()
+                else:
+                    st.session_state.llm_service = LLMService(provider=selected_provider)
                 st.sidebar.success(f"✅ Switched to {llm_labels[selected_provider]}")
             except Exception as e:
                 st.sidebar.error(f"❌ Error: {str(e)}")
@@ -158,7 +257,7 @@ def main():
     
     page = st.sidebar.radio(
         "Navigation",
-        ["📥 Inbox", "🔧 Prompt Brain", "📝 Review Drafts", "⚙️ Settings"]
+        ["📥 Inbox", "💬 Ask Mailbox", "✅ Tasks", "🔧 Prompt Brain", "📝 Review Drafts", "⚙️ Settings"]
     )
     
     st.sidebar.markdown("---")
@@ -167,6 +266,10 @@ def main():
     
     if page == "📥 Inbox":
         render_inbox_page()
+    elif page == "💬 Ask Mailbox":
+        render_mailbox_chat_page()
+    elif page == "✅ Tasks":
+        render_tasks_page()
     elif page == "🔧 Prompt Brain":
         render_prompt_brain_page()
     elif page == "📝 Review Drafts":
@@ -174,66 +277,180 @@ def main():
     elif page == "⚙️ Settings":
         render_settings_page()
 
+@st.fragment(run_every=2)
+def render_categorize_progress():
+    """Progress of the background Categorize All run; reruns the page when new results land."""
+    categorizer = get_categorizer()
+    run = categorizer.progress()
+    if not run:
+        return
+    completed, total = run['completed'], run['total']
+    budget = run.get('budget') or {}
+    spent = ""
+    if budget.get('max_tokens') or budget.get('max_cost') or budget.get('max_minutes'):
+        calls = budget['calls']
+        spent = (f" Budget used: {budget['tokens']:,} tokens, ${budget['cost_usd']:.4f}, {budget['minutes']} min"
+                 f" ({calls['cheaper']} call(s) on a cheaper model, {calls['local']} answered locally).")
+    if categorizer.running:
+        st.progress(completed / total if total else 0.0,
+                    text=f"Categorizing... {completed}/{total} conversation group(s), most urgent first "
+                         f"(saved every {CHECKPOINT_EVERY})")
+        if spent:
+            st.caption(spent.strip())
+    elif categorizer.resumable:
+        reason = f" ({run['stop_reason']})" if run.get('stop_reason') else ""
+        st.warning(f"⚠️ Categorization stopped after {completed}/{total} group(s){reason}. "
+                   f"Results so far are saved.{spent}")
+    else:
+        st.caption(
+            f"Last run: {run['emails']} emails categorized with {run['llm_calls']} LLM call(s); "
+            f"{run['emails'] - run['threads']} avoided by threading, "
+            f"{run['threads'] - run['llm_calls']} by near-duplicate propagation.{spent}"
+        )
+    if st.session_state.store_version != get_store().version:
+        st.rerun(scope="app")
+
 def render_inbox_page():
     st.markdown('<h1 class="main-header">📥 Email Inbox</h1>', unsafe_allow_html=True)
     
-    # Categorize Button
-    if st.button("✨ Categorize All Emails"):
-        with st.spinner("Categorizing emails using AI..."):
-            service = st.session_state.llm_service
-            prompt_template = st.session_state.prompts["Categorization"]["template"]
-            
-            progress_bar = st.progress(0)
-            for i, email in enumerate(st.session_state.emails):
-                try:
-                    category = service.categorize_email(email['subject'], email['body'], prompt_template)
-                    email['category'] = category
-                except Exception as e:
-                    st.error(f"Error categorizing email {email['id']}: {str(e)}")
-                    email['category'] = "Uncategorized"
-                progress_bar.progress((i + 1) / len(st.session_state.emails))
-            
-            storage.save_emails(st.session_state.emails)
-            st.success("✅ Categorization Complete!")
+    # Warm summaries/drafts for the newest mail while the user is browsing
+    if get_prefetcher().enabled:
+        get_prefetcher().start(st.session_state.llm_service, get_prompts_dict())
+    
+    # Categorize All runs in the background, most urgent conversations first;
+    # the inbox refreshes as each batch of results is checkpointed
+    categorizer = get_categorizer()
+    template = st.session_state.prompts["Categorization"]["template"]
+    with st.expander("💰 Run Budget"):
+        st.caption("Limits for each Categorize All start or resume (0 = no limit). Near the limit, calls move to "
+                   "a cheaper model, then to local keyword rules; past the deadline the run stops and can be resumed.")
+        col_tokens, col_cost, col_minutes = st.columns(3)
+        with col_tokens:
+            max_tokens = st.number_input("Max tokens", min_value=0, value=BUDGET_MAX_TOKENS, step=10000)
+        with col_cost:
+            max_cost = st.number_input("Max cost (USD)", min_value=0.0, value=BUDGET_MAX_COST, step=0.5)
+        with col_minutes:
+            max_minutes = st.number_input("Deadline (minutes)", min_value=0.0, value=BUDGET_MAX_MINUTES, step=5.0)
+        if st.button("🧮 Estimate Cost"):
+            with st.spinner("Sizing prompts..."):
+                estimate = categorizer.estimate(st.session_state.llm_service, template)
+            st.info(f"About {estimate['calls']:,} LLM call(s), {estimate['tokens']:,} tokens, "
+                    f"${estimate['cost_usd']:.4f} at list prices (worst-case output length).")
+    budget = Budget(int(max_tokens), float(max_cost), float(max_minutes))
+    col_run, col_resume = st.columns([1, 1])
+    with col_run:
+        if st.button("✨ Categorize All Emails", disabled=categorizer.running):
+            categorizer.start(st.session_state.llm_service, template, budget=budget)
             st.rerun()
+    with col_resume:
+        if categorizer.running:
+            if st.button("⏹️ Stop"):
+                categorizer.stop()
+        elif categorizer.resumable:
+            if st.button("▶️ Resume Categorization"):
+                categorizer.start(st.session_state.llm_service, None, resume=True, budget=budget)
+                st.rerun()
+    render_categorize_progress()
 
     # Filters
-    col1, col2 = st.columns([2, 1])
+    store = get_store()
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
     with col1:
         search = st.text_input("🔍 Search emails", placeholder="Search...")
+        search_mode = st.radio("Search mode", ["Exact", "Semantic"], horizontal=True, label_visibility="collapsed")
     with col2:
         # Extract unique categories from emails dynamically
         unique_categories = sorted(set(email['category'] for email in st.session_state.emails))
         categories = ["All"] + unique_categories
         selected_category = st.selectbox("Filter by Category", categories)
+    with col3:
+        # Older months are on disk but only paged in when asked for
+        partitions = {p['month']: p for p in store.partitions() if not p['archived']}
+        selected_month = st.selectbox(
+            "Month", ["All loaded"] + list(partitions),
+            format_func=lambda m: m if m == "All loaded" or partitions[m]['loaded']
+            else f"{m} ({partitions[m]['emails']} on disk)",
+            key="inbox_month"
+        )
+        if selected_month != "All loaded" and not partitions[selected_month]['loaded']:
+            with st.spinner(f"Loading {selected_month}..."):
+                store.load_partitions([selected_month])
+            st.rerun()
+    with col4:
+        collapse_threads = st.checkbox("🧵 Group conversations", value=True)
 
     # Filter Logic
     filtered_emails = st.session_state.emails
+    if search and search_mode == "Semantic":
+        # Ranked by similarity rather than time
+        filtered_emails = get_store().semantic_search(search)
     if selected_category != "All":
         filtered_emails = [e for e in filtered_emails if e['category'] == selected_category]
-    if search:
+    if selected_month != "All loaded":
+        filtered_emails = [e for e in filtered_emails if storage.partition_key(e) == selected_month]
+    if search and search_mode == "Exact":
         term = search.lower()
-        filtered_emails = [e for e in filtered_emails if term in e['subject'].lower() or term in e['sender'].lower() or term in e['body'].lower()]
+        filtered_emails = [e for e in filtered_emails if term in e['subject'].lower() or term in e['sender'].lower() or term in storage.get_body(e).lower()]
+    unloaded = store.unloaded_months()
+    if search and unloaded:
+        older_count = sum(partitions[month]['emails'] for month in unloaded)
+        if st.button(f"🔎 Also search older mail ({older_count} emails in {len(unloaded)} month(s))"):
+            with st.spinner("Loading older mail..."):
+                store.load_all()
+            st.rerun()
     
-    # Sort by time desc
-    filtered_emails.sort(key=lambda x: x['timestamp'], reverse=True)
+    if not (search and search_mode == "Semantic"):
+        # Sort by time desc (sorted() so the session's shared-order list isn't reordered)
+        filtered_emails = sorted(filtered_emails, key=lambda x: x['timestamp'], reverse=True)
 
-    # Layout
+    # Collapse each conversation to its newest matching message
+    thread_sizes = {}  # {email_id: messages in its conversation} for the emails shown
+    if collapse_threads:
+        threads = get_store().threads()
+        thread_ids = get_store().thread_ids()
+        seen = set()
+        collapsed = []
+        for email in filtered_emails:
+            thread_id = thread_ids.get(email['id'], email['id'])
+            if thread_id not in seen:
+                seen.add(thread_id)
+                thread_sizes[email['id']] = len(threads.get(thread_id, [email]))
+                collapsed.append(email)
+        filtered_emails = collapsed
+
+    older = partitions[unloaded[0]] if unloaded and not search and selected_month == "All loaded" else None
+    render_email_panes(filtered_emails, thread_sizes, older)
+
+@st.fragment
+def render_email_panes(emails, thread_sizes, older=None):
+    """
+    The email list and the selected email's details. Runs as a fragment:
+    selecting an email redraws only these columns, not the filtering,
+    sorting and thread grouping above them; loading older mail reruns the
+    whole page.
+    """
+    store = get_store()
     col_list, col_detail = st.columns([1, 2])
     
     with col_list:
-        st.markdown(f"### Emails ({len(filtered_emails)})")
-        for email in filtered_emails:
+        st.markdown(f"### Emails ({len(emails)})")
+        for email in emails:
+            # The list is from the last page run; read state may have changed since
+            email = store.get(email['id']) or email
             with st.container():
-                if st.button(f"📧 {email['id']}", key=f"btn_{email['id']}", use_container_width=True):
-                    st.session_state.selected_email_id = email['id']
-                    st.session_state.chat_history = []
-                    st.rerun()
-                render_email_card(email, is_selected=(st.session_state.selected_email_id == email['id']))
+                # Selecting in the click callback lets this fragment's own rerun draw the selection
+                st.button(f"📧 {email['id']}", key=f"btn_{email['id']}", use_container_width=True,
+                          on_click=select_email, args=(email['id'],))
+                render_email_card(email, is_selected=(st.session_state.selected_email_id == email['id']),
+                                  thread_size=thread_sizes.get(email['id'], 1))
+        if older:
+            if st.button(f"⬇️ Load older mail ({older['month']}, {older['emails']} emails)", use_container_width=True):
+                store.load_older()
+                st.rerun(scope="app")
     
     with col_detail:
         if st.session_state.selected_email_id:
-            selected_email = next((e for e in st.session_state.emails if e['id'] == st.session_state.selected_email_id), None)
+            selected_email = store.get(st.session_state.selected_email_id)
             if selected_email:
                 render_email_detail(selected_email)
             else:
@@ -241,25 +458,45 @@ def render_inbox_page():
         else:
             st.info("Select an email to view details.")
 
+def select_email(email_id):
+    """
+    Show an email in the detail panel and mark it read. If marking it read
+    is the only change to the store since this session last synced, the
+    session takes it in directly, so the progress poll doesn't rerun the
+    whole page for it.
+    """
+    st.session_state.selected_email_id = email_id
+    st.session_state.chat_history = []
+    st.session_state.chat_memory.clear()
+    store = get_store()
+    email = store.get(email_id)
+    if email is None or email['is_read']:
+        return
+    in_sync = st.session_state.store_version == store.version
+    store.update_email(email_id, is_read=True)
+    delta = store.changes_since(st.session_state.store_version) if in_sync else None
+    if delta and [record.id for _, record in delta[1]] == [email_id]:
+        for position, record in delta[1]:
+            st.session_state.emails[position] = record
+        st.session_state.store_version = delta[0]
+
+@st.fragment
 def render_email_detail(email):
+    """
+    Detail view and agent chat. Runs as a fragment: chat and summary requests
+    rerun only this panel; actions that change mail rerun the whole page so
+    the list picks them up.
+    """
     st.markdown("### 📧 Email Details")
     
-    category_class = get_category_class(email['category'])
-    st.markdown(f"""
-    <div style="background: rgba(255,255,255,0.05); padding: 1.5rem; border-radius: 10px;">
-        <div><span class="category-badge {category_class}">{email['category']}</span></div>
-        <h3>{email['subject']}</h3>
-        <p style="color: #9ca3af;">From: {email['sender']}</p>
-        <p style="color: #9ca3af;">Date: {email['timestamp'].strftime('%Y-%m-%d %H:%M')}</p>
-        <hr style="border-color: rgba(255,255,255,0.1);">
-        <p style="white-space: pre-wrap;">{email['body']}</p>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(email_detail_html(email['id'], email['rev'], email), unsafe_allow_html=True)
     
     if email.get('action_items'):
         st.markdown("### 📋 Action Items")
+        due_dates = {task['text']: task['due'] for task in email.get('tasks', []) if task.get('due')}
         for item in email['action_items']:
-            st.markdown(f"- {item}")
+            due = f" — 📅 due {due_dates[item].replace('T', ' ')}" if item in due_dates else ""
+            st.markdown(f"- {item}{due}")
 
     st.markdown("---")
     st.markdown("### 🤖 Agent Actions")
@@ -268,11 +505,12 @@ def render_email_detail(email):
     
     with col1:
         if st.button("📝 Summarize"):
-            process_agent_query(email, "Summarize this email")
+            process_agent_query(email, SUMMARY_QUERY)
             
     with col2:
         if st.button("✍️ Draft Reply"):
-            process_agent_query(email, "Draft a professional reply to this email", save_draft=True)
+            process_agent_query(email, DRAFT_QUERY, save_draft=True)
+            st.rerun(scope="app")  # The sidebar draft count changed
             
     with col3:
         if st.button("📋 Extract Tasks"):
@@ -280,23 +518,35 @@ def render_email_detail(email):
                 service = st.session_state.llm_service
                 prompt = st.session_state.prompts["Action Extraction"]["template"]
                 try:
-                    actions = service.extract_action_items(email['subject'], email['body'], prompt)
+                    thread_text = get_thread_text(email)
+                    # Explicit action sections and deadlines are read locally; the LLM only sees the rest
+                    tasks, confidence = extract_tasks(thread_text, email['timestamp'])
+                    source = "local rules"
+                    if confidence < LOCAL_TASK_CONFIDENCE:
+                        actions = service.extract_action_items(email['subject'], thread_text, prompt)
+                        tasks = [{'text': a, 'due': parse_due(a, email['timestamp'])} for a in actions]
+                        source = "LLM"
+                    actions = [task['text'] for task in tasks]
                     
-                    # Update email
-                    email['action_items'] = actions
-                    storage.save_emails(st.session_state.emails)
+                    # Tasks are extracted once per conversation and stored on every message in it;
+                    # only the selected email carries them in the task index, so they aren't listed twice
+                    members = get_store().thread_for(email['id']) or [email]
+                    get_store().update_emails({
+                        member['id']: {'action_items': actions, 'tasks': tasks if member['id'] == email['id'] else []}
+                        for member in members
+                    })
                     
                     # Show in chat
                     st.session_state.chat_history.append({
                         'role': 'agent',
-                        'content': f"I've extracted the following tasks:\n" + "\n".join([f"- {t}" for t in actions]) if actions else "No specific action items found."
+                        'content': f"I've extracted the following tasks ({source}):\n" + "\n".join([f"- {t}" for t in actions]) if actions else "No specific action items found."
                     })
                 except Exception as e:
                     st.session_state.chat_history.append({
                         'role': 'agent',
                         'content': f"Error extracting tasks: {str(e)}"
                     })
-                st.rerun()
+                st.rerun(scope="app")
 
     # Chat Interface
     st.markdown("### 💬 Chat with Agent")
@@ -311,36 +561,42 @@ def render_email_detail(email):
                  st.text(f"Subject: {msg['draft_data']['subject']}")
                  st.text_area("Body", msg['draft_data']['body'], height=150, key=f"draft_view_{id(msg)}")
                  if st.button("💾 Save to Drafts", key=f"save_{id(msg)}"):
-                     storage.add_draft(email['id'], msg['draft_data']['subject'], msg['draft_data']['body'])
-                     st.session_state.drafts = storage.load_drafts()
+                     get_store().add_draft(email['id'], msg['draft_data']['subject'], msg['draft_data']['body'])
                      st.success("✅ Draft saved!")
-                     st.rerun()
+                     st.rerun(scope="app")
 
     user_query = st.text_input("Ask a question about this email:", key="chat_input")
     if st.button("Send") and user_query:
         process_agent_query(email, user_query)
-        st.rerun()
+        st.rerun(scope="fragment")
+
+def remember_turn(memory, query, response):
+    """Add a question/answer pair to a chat memory, summarizing older turns with the LLM if it can."""
+    summarize = getattr(st.session_state.llm_service, 'summarize_turns', None)
+    memory.add('user', query, summarize)
+    memory.add('agent', response, summarize)
 
 def process_agent_query(email, query, save_draft=False):
     st.session_state.chat_history.append({'role': 'user', 'content': query})
     
     service = st.session_state.llm_service
-    
-    # Prepare context
-    context = {
-        'sender': email['sender'],
-        'subject': email['subject'],
-        'body': email['body'],
-        'category': email['category'],
-        'action_items': json.dumps(email.get('action_items', []))
-    }
+    prefetcher = get_prefetcher()
     
     # Simple prompts dict for the service
-    prompts_dict = {k: v['template'] for k, v in st.session_state.prompts.items()}
+    prompts_dict = get_prompts_dict()
     
     with st.spinner("Thinking..."):
         try:
-            result = service.chat_with_agent(query, context, prompts_dict)
+            memory = st.session_state.chat_memory
+            cacheable = query in (SUMMARY_QUERY, DRAFT_QUERY)
+            result = prefetcher.get(service, email, query, prompts_dict) if cacheable else None
+            if result is None:
+                context = email_context(email, get_thread_text(email))
+                with prefetcher.foreground():
+                    result = service.chat_with_agent(query, context, prompts_dict, history=memory.render())
+                if cacheable:
+                    prefetcher.put(service, email, query, prompts_dict, result)
+            remember_turn(memory, query, result['response'])
             agent_msg = {'role': 'agent', 'content': result['response']}
             
             if result.get('action') == 'draft_generated' and result.get('data'):
@@ -348,8 +604,7 @@ def process_agent_query(email, query, save_draft=False):
                 
                 # Auto-save draft if requested
                 if save_draft:
-                    storage.add_draft(email['id'], result['data']['subject'], result['data']['body'])
-                    st.session_state.drafts = storage.load_drafts()
+                    get_store().add_draft(email['id'], result['data']['subject'], result['data']['body'])
                     agent_msg['content'] += "\n\n✅ Draft has been saved to Review Drafts."
                 
             st.session_state.chat_history.append(agent_msg)
@@ -359,6 +614,96 @@ def process_agent_query(email, query, save_draft=False):
                 'content': f"Error: {str(e)}"
             })
 
+def render_mailbox_chat_page():
+    st.markdown('<h1 class="main-header">💬 Ask Mailbox</h1>', unsafe_allow_html=True)
+    st.caption("Ask about your whole inbox, e.g. \"What deadlines do I have this week?\" "
+               "The most relevant emails are retrieved locally and cited by id.")
+    
+    for msg in st.session_state.mailbox_chat_history:
+        role_class = "user-message" if msg['role'] == 'user' else "agent-message"
+        icon = "👤" if msg['role'] == 'user' else "🤖"
+        st.markdown(f'<div class="chat-message {role_class}">{icon} {msg["content"]}</div>', unsafe_allow_html=True)
+        if msg.get('sources'):
+            with st.expander(f"📎 Sources ({len(msg['sources'])})"):
+                for email_id in msg['sources']:
+                    email = get_store().get(email_id)
+                    if email:
+                        st.markdown(f"**[#{email_id}]** {email['subject']} — {email['sender']}")
+    
+    question = st.text_input("Ask a question about your mailbox:", key="mailbox_chat_input")
+    col1, col2 = st.columns([1, 5])
+    with col1:
+        ask = st.button("Ask")
+    with col2:
+        if st.button("🗑️ Clear Conversation"):
+            st.session_state.mailbox_chat_history = []
+            st.session_state.mailbox_memory.clear()
+            st.rerun()
+    if ask and question:
+        process_mailbox_query(question)
+        st.rerun()
+
+def process_mailbox_query(question):
+    st.session_state.mailbox_chat_history.append({'role': 'user', 'content': question})
+    
+    with st.spinner("Searching your mailbox..."):
+        try:
+            service = st.session_state.llm_service
+            prompts_dict = get_prompts_dict()
+            matches = get_store().semantic_search(question, k=MAILBOX_TOP_K)
+            emails = [{
+                'id': email['id'],
+                'sender': email['sender'],
+                'subject': email['subject'],
+                'date': email['timestamp'].strftime('%Y-%m-%d'),
+                'summary': get_prefetcher().cached_summary(service, email, prompts_dict),
+                'body': storage.get_body(email),
+            } for email in matches]
+            memory = st.session_state.mailbox_memory
+            with get_prefetcher().foreground():
+                result = service.chat_with_mailbox(question, emails, history=memory.render())
+            remember_turn(memory, question, result['response'])
+            st.session_state.mailbox_chat_history.append({
+                'role': 'agent',
+                'content': result['response'],
+                'sources': result.get('sources', [])
+            })
+        except Exception as e:
+            st.session_state.mailbox_chat_history.append({
+                'role': 'agent',
+                'content': f"Error: {str(e)}"
+            })
+
+def render_tasks_page():
+    st.markdown('<h1 class="main-header">✅ Tasks</h1>', unsafe_allow_html=True)
+    st.caption("Action items from across the inbox, ordered by due date.")
+    
+    store = get_store()
+    store.ensure_task_index()
+    today = datetime.now().date()
+    week_end = (today + timedelta(days=7)).isoformat()
+    groups = [
+        ("⚠️ Overdue", store.tasks.between(None, today.isoformat())),
+        ("📌 Today", store.tasks.between(today.isoformat(), (today + timedelta(days=1)).isoformat())),
+        ("🗓️ Next 7 Days", store.tasks.between((today + timedelta(days=1)).isoformat(), week_end)),
+        ("🔭 Later", store.tasks.between(week_end, "~")),
+        ("❔ No Due Date", store.tasks.undated()),
+    ]
+    if not len(store.tasks):
+        st.info("No tasks found yet. Use 📋 Extract Tasks on an email, or import mail with action items.")
+        return
+    for title, tasks in groups:
+        if not tasks:
+            continue
+        st.markdown(f"### {title} ({len(tasks)})")
+        for task in tasks:
+            email = store.get(task['email_id'])
+            if email is None:
+                continue
+            due = f"**{task['due'].replace('T', ' ')}** · " if task.get('due') else ""
+            st.markdown(f"- {due}{task['text']}  \n  <span style='color: #9ca3af;'>{email['subject']} — {email['sender']}</span>",
+                        unsafe_allow_html=True)
+
 def render_prompt_brain_page():
     st.markdown('<h1 class="main-header">🔧 Prompt Brain</h1>', unsafe_allow_html=True)
     
@@ -373,18 +718,15 @@ def render_prompt_brain_page():
             col1, col2 = st.columns([1, 4])
             with col1:
                 if st.button(f"💾 Save {name} Prompt"):
-                    prompts[name]['template'] = new_template
-                    storage.save_prompts(prompts)
-                    st.session_state.prompts = storage.load_prompts()  # Reload from storage to ensure sync
+                    get_store().save_prompt(name, new_template)
+                    sync_session()
                     st.success(f"✅ {name} prompt saved and will be used immediately!")
                     st.info("💡 Click 'Categorize All Emails' to apply changes to existing emails.")
             
             with col2:
                 if st.button(f"🔄 Reset {name} Default"):
                     default_template = storage.DEFAULT_PROMPTS[name]['template']
-                    prompts[name]['template'] = default_template
-                    storage.save_prompts(prompts)
-                    st.session_state.prompts = storage.load_prompts()
+                    get_store().save_prompt(name, default_template)
                     # Force update the widget state to reflect the change
                     st.session_state[f"prompt_{name}"] = default_template
                     st.rerun()
@@ -401,7 +743,7 @@ def render_drafts_page():
     st.markdown(f"### You have {len(drafts)} draft(s)")
     
     for draft in reversed(drafts):  # Show newest first
-        email = next((e for e in st.session_state.emails if e['id'] == draft['email_id']), None)
+        email = get_store().get(draft['email_id'])
         
         with st.expander(f"📧 Draft #{draft['id']}: {draft['subject']}"):
             if email:
@@ -418,18 +760,13 @@ def render_drafts_page():
                 with col1:
                     if st.form_submit_button("💾 Save Changes"):
                         # Update draft
-                        for d in st.session_state.drafts:
-                            if d['id'] == draft['id']:
-                                d['subject'] = subject
-                                d['body'] = body
-                        storage.save_drafts(st.session_state.drafts)
+                        get_store().update_draft(draft['id'], subject, body)
                         st.success("✅ Draft updated!")
                         st.rerun()
                 
                 with col2:
                     if st.form_submit_button("🗑️ Delete"):
-                        st.session_state.drafts = [d for d in st.session_state.drafts if d['id'] != draft['id']]
-                        storage.save_drafts(st.session_state.drafts)
+                        get_store().delete_draft(draft['id'])
                         st.success("🗑️ Draft deleted!")
                         st.rerun()
 
@@ -439,13 +776,165 @@ def render_settings_page():
     st.markdown("### 🔄 Data Management")
         
     if st.button("🗑️ Reset All Data (Clear Emails & Drafts)"):
-        st.session_state.emails = []
-        st.session_state.drafts = []
-        storage.save_emails([])
-        storage.save_drafts([])
+        get_store().clear()
+        get_prefetcher().clear()
+        get_categorizer().clear()
+        clear_render_cache()
         st.success("✅ Cleared!")
         st.rerun()
 
+    st.markdown("---")
+    st.markdown("### 📬 Import Mailbox")
+    st.caption("Re-running an import only processes messages added since the last sync.")
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        mailbox_format = st.selectbox("Format", ["mbox", "Maildir"])
+    with col2:
+        mailbox_path = st.text_input("Path", placeholder="/path/to/mailbox")
+    if st.button("📥 Import") and mailbox_path:
+        importer = import_mbox if mailbox_format == "mbox" else import_maildir
+        with st.spinner("Importing mail..."):
+            try:
+                stats = get_store().import_mailbox(importer, mailbox_path)
+                st.success(
+                    f"✅ Imported {stats['imported']} new message(s) "
+                    f"({stats['duplicates']} duplicate(s) skipped) in {stats['seconds']}s: "
+                    f"{stats['messages_per_sec']} msg/s, {stats['mb_per_sec']} MB/s"
+                )
+            except Exception as e:
+                st.error(f"❌ Import failed: {str(e)}")
+
+    st.markdown("---")
+    st.markdown("### 🗄️ Mail Partitions")
+    st.caption(f"Mail is stored by month. The newest {STARTUP_MONTHS} month(s) load at startup (`STARTUP_MONTHS`); "
+               "older months are paged in from the inbox. Archived months are never loaded or searched.")
+    partitions = get_store().partitions()
+    if partitions:
+        st.dataframe([
+            {"month": p['month'], "emails": p['emails'],
+             "size_mb": round(storage.partition_size(p['month'], p['archived']) / 1e6, 2),
+             "status": "archived" if p['archived'] else ("loaded" if p['loaded'] else "on disk")}
+            for p in partitions
+        ], use_container_width=True, hide_index=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            month = st.selectbox("Partition", [p['month'] for p in partitions])
+        archived = next(p['archived'] for p in partitions if p['month'] == month)
+        with col2:
+            if not archived and st.button("🗄️ Archive Month", disabled=get_categorizer().running):
+                get_store().archive_partition(month)
+                st.rerun()
+            if archived and st.button("♻️ Restore Month"):
+                get_store().restore_partition(month)
+                st.rerun()
+
+    snapshot = get_store().state_snapshot.status()
+    if snapshot['created']:
+        st.caption(f"Warm-start snapshot: {snapshot['months']} month(s), {snapshot['size'] / 1e6:.1f} MB, written "
+                   f"{datetime.fromtimestamp(snapshot['created']).strftime('%Y-%m-%d %H:%M')}; "
+                   f"{snapshot['journal_records']} change(s) journaled since (rewritten after {SNAPSHOT_EVERY}).")
+    else:
+        st.caption("No warm-start snapshot yet; one is written in the background after the next load.")
+    if st.button("💾 Rewrite Snapshot Now"):
+        with st.spinner("Writing snapshot..."):
+            get_store().write_snapshot()
+        st.rerun()
+
+    st.markdown("---")
+    st.markdown("### 🗜️ Body Compression")
+    st.caption(f"New bodies are stored with `{storage.BODY_COMPRESSION}` (set `BODY_COMPRESSION`); "
+               "they are decompressed only when an email is opened, searched or sent to the LLM.")
+    body_stats = storage.body_storage_stats(st.session_state.emails)
+    if body_stats:
+        cols = st.columns(len(body_stats))
+        for col, (codec, row) in zip(cols, body_stats.items()):
+            col.metric(f"{codec} bodies", f"{row['stored_bytes'] / 1e6:.2f} MB",
+                       help=f"{row['emails']} email(s), ~{row['ratio']}x smaller than plain text")
+    if st.button("🗜️ Recompress Stored Bodies", disabled=get_categorizer().running):
+        with st.spinner("Rewriting the body store..."):
+            before, after = get_store().recompress_bodies()
+        st.success(f"✅ Body store: {before / 1e6:.2f} MB → {after / 1e6:.2f} MB")
+
+    st.markdown("---")
+    st.markdown("### 🧬 Near-Duplicate Detection")
+    duplicates = get_store().duplicates
+    dup_stats = duplicates.stats()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Indexed Emails", dup_stats['emails'])
+    col2.metric("Duplicate Clusters", dup_stats['duplicate_clusters'])
+    col3.metric("LLM Calls Avoidable", dup_stats['duplicates'],
+                help="Emails whose label is copied from their cluster's representative")
+    threshold = st.slider("Similarity threshold", 0.5, 1.0, float(duplicates.threshold), 0.05)
+    if st.button("🔁 Rebuild Clusters"):
+        with st.spinner("Clustering emails..."):
+            get_store().rebuild_duplicates(threshold)
+        st.rerun()
+
+    st.markdown("---")
+    st.markdown("### ⚡ Background Prefetch")
+    prefetcher = get_prefetcher()
+    st.caption("Summaries, and drafts for Important / To-Do mail, are generated for the newest "
+               "conversations while you browse, so the Summarize and Draft Reply buttons answer instantly.")
+    prefetcher.enabled = st.checkbox("Enable background prefetch", value=prefetcher.enabled)
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Cached Results", len(prefetcher))
+    col2.metric("Generated", prefetcher.stats['generated'])
+    col3.metric("Instant Hits", prefetcher.stats['hits'])
+    col4.metric("Misses", prefetcher.stats['misses'])
+    st.caption(f"{'🔄 Running' if prefetcher.running else '⏸️ Idle'} · budget {PREFETCH_MAX_CALLS} calls "
+               f"over the newest {PREFETCH_MAX_EMAILS} conversations per run")
+
+    if hasattr(st.session_state.llm_service, 'provider_stats'):
+        router = st.session_state.llm_service
+        st.markdown("---")
+        st.markdown("### 🛰️ Provider Routing")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Requests", router.hedge_stats['requests'])
+        col2.metric("Hedged", router.hedge_stats['hedged'],
+                    help="Requests where the first provider passed its p95 latency and a duplicate was sent")
+        col3.metric("Failovers", router.hedge_stats['failovers'])
+        col4.metric("Answered by Backup", router.hedge_stats['backup_wins'])
+        st.dataframe(router.provider_stats(), use_container_width=True)
+
+    service = st.session_state.llm_service
+    if hasattr(service, 'task_summary'):
+        st.markdown("---")
+        st.markdown("### 🎚️ Model Tiers")
+        st.caption("Classification runs on the fast tier, generation on the strong tier. "
+                   "Pin a model per task with <PROVIDER>_MODEL_<TASK> in .env.")
+        providers = service.services.values() if hasattr(service, 'services') else [service]
+        st.dataframe([dict(provider=p.provider, task=task, **p.task_settings(task))
+                      for p in providers for task in TASK_SETTINGS], use_container_width=True)
+        task_rows = service.task_summary()
+        if task_rows:
+            total_cost = sum(row['cost_usd'] for row in task_rows)
+            st.metric("Estimated Spend (this session)", f"${total_cost:.4f}")
+            st.dataframe(task_rows, use_container_width=True)
+
+    structured = getattr(service, 'structured_stats', None)
+    if structured and structured['requests']:
+        st.markdown("---")
+        st.markdown("### 🧩 Structured Output")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Structured Replies", structured['requests'])
+        col2.metric("Valid First Pass", f"{structured['valid_first_pass'] / structured['requests']:.0%}")
+        col3.metric("Repaired", structured['repaired'], help="Fixed by the single automatic repair call")
+        col4.metric("Malformed", structured['failed'], help="Still invalid after the repair call")
+
+    metrics = getattr(st.session_state.llm_service, 'metrics', None)
+    if metrics:
+        st.markdown("---")
+        st.markdown("### 📉 Prompt Token Savings")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("LLM Calls", metrics['calls'])
+        col2.metric("Body Tokens Sent", metrics['prompt_body_tokens'])
+        col3.metric("Tokens Saved", metrics['tokens_saved'])
+        col4.metric("Cached Prompt Tokens", metrics['cached_tokens'],
+                    help="Prompt-prefix tokens the provider served from its cache")
+        call_log = list(st.session_state.llm_service.call_log)
+        if call_log:
+            st.dataframe(call_log[::-1], use_container_width=True)
+
     st.markdown("---")
     st.markdown("### About")
     st.markdown("**Email Productivity Agent v1.0** (JSON Edition)")
@@ -0,0 +1,433 @@
+"""
+Offline bulk processing through provider batch endpoints.
+
+    python batch_jobs.py run [--adapter local|openai] [--operations categorize,extract]
+                             [--max-tokens N] [--max-cost USD] [--max-minutes M]
+    python batch_jobs.py status
+
+A run writes one JSONL request per conversation (categorize per
+near-duplicate cluster, extract per thread without action items), submits
+the file through an adapter, polls until the batch completes and merges the
+results back into the store. Custom ids are derived from the operation,
+email, model and prompt, so re-running prepares nothing for work that has
+already been merged or is still in flight, and merging the same results
+twice changes nothing.
+
+With a budget, requests are costed from their prompt sizes before
+submission: they move to the provider's cheaper model once the budget is
+tight, and those that don't fit are left for the next run. The deadline
+bounds how long a run waits for the batch; an unfinished batch is merged
+by a later run.
+
+Results are merged through a MailStore of this process. A running app
+notices the rewritten month partitions by their file stats and reloads
+them (MailStore.refresh_partitions) on its next rerun or write, so it
+neither misses the results nor saves over them from its older copy.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import storage
+from budget import BUDGET_MAX_COST, BUDGET_MAX_MINUTES, BUDGET_MAX_TOKENS, Budget, choose_model
+from llm_service import (VARIABLE_MARKER, MockLLMService, build_prompt, clean_action_items,
+                         email_variable, parse_category, task_settings)
+from preprocessing import prepare_body
+from scheduler import plan_categorization
+from schemas import ActionItems, parse_reply
+from task_extraction import LOCAL_TASK_CONFIDENCE, extract_tasks, parse_due
+
+BATCH_DIR = os.path.join(storage.EMAIL_DIR, "batch")
+BATCH_JOBS_FILE = os.path.join(BATCH_DIR, "jobs.json")
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "60"))
+BATCH_OPERATIONS = ("categorize", "extract")
+PROMPT_NAMES = {"categorize": "Categorization", "extract": "Action Extraction"}
+
+
+def custom_id(operation: str, email_id, model: str, prompt: str) -> str:
+    """Deterministic request id: the same work on the same content always gets the same id."""
+    digest = hashlib.sha1(f"{model}\n{prompt}".encode('utf-8')).hexdigest()[:16]
+    return f"{operation}-{email_id}-{digest}"
+
+
+def _request(operation: str, email, targets: List[Any], template: str, provider: str, body: str) -> Dict[str, Any]:
+    body, _ = prepare_body(body, operation)
+    prompt = build_prompt(template, operation, email_variable(email['subject'], body))
+    settings = task_settings(provider, operation)
+    return {
+        "custom_id": custom_id(operation, email['id'], settings["model"], prompt),
+        "operation": operation,
+        "email_id": email['id'],
+        "targets": targets,
+        "model": settings["model"],
+        "temperature": settings["temperature"],
+        "max_tokens": settings["max_tokens"],
+        "json_mode": operation == "extract",
+        "prompt": prompt,
+    }
+
+
+def build_requests(store, prompts: Dict[str, str], provider: str = "openai",
+                   operations=BATCH_OPERATIONS, skip=frozenset()) -> List[Dict[str, Any]]:
+    """Batch requests for the store, one per unit of work, leaving out custom ids in `skip`."""
+    requests = []
+    if "categorize" in operations:
+        for cluster in plan_categorization(store):
+            latest = cluster[0][-1]
+            targets = [email['id'] for members in cluster for email in members]
+            requests.append(_request("categorize", latest, targets, prompts[PROMPT_NAMES["categorize"]],
+                                     provider, store.thread_text(latest)))
+    if "extract" in operations:
+        for members in store.threads().values():
+            latest = members[-1]
+            if latest.get('action_items'):
+                continue
+            body = store.thread_text(latest)
+            # Mail the local extractor handles confidently never needs the LLM
+            if extract_tasks(body, latest['timestamp'])[1] >= LOCAL_TASK_CONFIDENCE:
+                continue
+            requests.append(_request("extract", latest, [email['id'] for email in members],
+                                     prompts[PROMPT_NAMES["extract"]], provider, body))
+    return [request for request in requests if request["custom_id"] not in skip]
+
+
+def fit_budget(requests: List[Dict[str, Any]], budget: Budget, provider: str) -> List[Dict[str, Any]]:
+    """
+    The requests (highest priority first) that fit the budget. A request
+    moved to a cheaper model keeps its custom id, so the work counts as
+    done once merged. Costs are at list prices, so batch discounts leave
+    headroom.
+    """
+    kept = []
+    for request in requests:
+        mode, model, tokens, cost = choose_model(budget, provider, request["operation"], [request["model"]],
+                                                 request["prompt"])
+        if mode is None:
+            budget.deferred += 1
+            continue
+        budget.charge(tokens, cost, mode)
+        kept.append(dict(request, model=model))
+    return kept
+
+
+class BatchAdapter:
+    """
+    A provider batch endpoint. Requests are the JSONL lines written by
+    BatchRunner.prepare(); results are {"custom_id", "text"} or
+    {"custom_id", "error"} dicts.
+    """
+    name = "base"
+
+    def submit(self, requests_file: str) -> str:
+        raise NotImplementedError
+
+    def status(self, batch_id: str) -> str:
+        """"in_progress", "completed" or "failed"."""
+        raise NotImplementedError
+
+    def results(self, batch_id: str) -> Iterator[Dict[str, Any]]:
+        raise NotImplementedError
+
+
+def mock_responder(request: Dict[str, Any]) -> str:
+    """Answers a request offline with MockLLMService, in the format the real provider would."""
+    variable = request["prompt"].split(VARIABLE_MARKER, 1)[-1]
+    subject, _, body = variable.partition("\nEmail Body: ")
+    subject = subject.replace("Email Subject: ", "", 1)
+    mock = MockLLMService()
+    if request["operation"] == "categorize":
+        return mock.categorize_email(subject, body, request["prompt"].split(VARIABLE_MARKER, 1)[0])
+    return json.dumps({"action_items": mock.extract_action_items(subject, body, "")})
+
+
+class LocalFileAdapter(BatchAdapter):
+    """
+    Stand-in batch endpoint backed by files, for running the whole flow
+    offline. The batch is answered by `responder` on the first poll.
+    """
+    name = "local"
+
+    def __init__(self, directory: str = os.path.join(BATCH_DIR, "local"),
+                 responder: Callable[[Dict[str, Any]], str] = mock_responder):
+        self.directory = directory
+        self.responder = responder
+
+    def _path(self, batch_id: str, kind: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, requests_file: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(requests_file, 'rb') as f:
+            batch_id = "local-" + hashlib.sha1(f.read()).hexdigest()[:12]
+        shutil.copyfile(requests_file, self._path(batch_id, "input"))
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        if not os.path.exists(self._path(batch_id, "input")):
+            return "failed"
+        if not os.path.exists(self._path(batch_id, "output")):
+            tmp_file = self._path(batch_id, "output") + ".tmp"
+            with open(self._path(batch_id, "input"), 'r') as f_in, open(tmp_file, 'w') as f_out:
+                for line in f_in:
+                    request = json.loads(line)
+                    try:
+                        result = {"custom_id": request["custom_id"], "text": self.responder(request)}
+                    except Exception as e:
+                        result = {"custom_id": request["custom_id"], "error": str(e)}
+                    f_out.write(json.dumps(result) + "\n")
+            os.replace(tmp_file, self._path(batch_id, "output"))
+        return "completed"
+
+    def results(self, batch_id: str) -> Iterator[Dict[str, Any]]:
+        with open(self._path(batch_id, "output"), 'r') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class OpenAIBatchAdapter(BatchAdapter):
+    """OpenAI Batch API (/v1/chat/completions, 24h completion window)."""
+    name = "openai"
+
+    def __init__(self, client=None):
+        if client is None:
+            import openai
+            client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = client
+
+    def submit(self, requests_file: str) -> str:
+        from llm_service import SYSTEM_PROMPT
+        upload_file = requests_file + ".openai"
+        with open(requests_file, 'r') as f_in, open(upload_file, 'w') as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                body = {
+                    "model": request["model"],
+                    "messages": [
+                        {"role": "system", "content": SYSTEM_PROMPT},
+                        {"role": "user", "content": request["prompt"]},
+                    ],
+                    "temperature": request["temperature"],
+                    "max_tokens": request["max_tokens"],
+                }
+                if request["json_mode"]:
+                    body["response_format"] = {"type": "json_object"}
+                f_out.write(json.dumps({"custom_id": request["custom_id"], "method": "POST",
+                                        "url": "/v1/chat/completions", "body": body}) + "\n")
+        with open(upload_file, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        os.remove(upload_file)
+        batch = self.client.batches.create(input_file_id=uploaded.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        status = self.client.batches.retrieve(batch_id).status
+        if status == "completed":
+            return "completed"
+        if status in ("failed", "expired", "cancelled"):
+            return "failed"
+        return "in_progress"
+
+    def results(self, batch_id: str) -> Iterator[Dict[str, Any]]:
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    yield {"custom_id": item["custom_id"], "error": str(item.get("error") or response)}
+                    continue
+                text = response["body"]["choices"][0]["message"]["content"].strip()
+                yield {"custom_id": item["custom_id"], "text": text}
+
+
+ADAPTERS = {"local": LocalFileAdapter, "openai": OpenAIBatchAdapter}
+
+
+class BatchRunner:
+    """Prepare, submit, poll and merge batches for one store. Job state lives in BATCH_JOBS_FILE."""
+
+    def __init__(self, store, adapter: BatchAdapter):
+        self.store = store
+        self.adapter = adapter
+        self.state = self._load()
+
+    def _load(self) -> Dict[str, Any]:
+        state = {"jobs": {}, "merged": []}
+        if os.path.exists(BATCH_JOBS_FILE):
+            try:
+                with open(BATCH_JOBS_FILE, 'r') as f:
+                    state.update(json.load(f))
+            except Exception as e:
+                print(f"Error loading batch jobs: {e}")
+        return state
+
+    def _save(self):
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        tmp_file = BATCH_JOBS_FILE + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_file, BATCH_JOBS_FILE)
+
+    @staticmethod
+    def _read_requests(requests_file: str) -> Dict[str, Dict[str, Any]]:
+        with open(requests_file, 'r') as f:
+            return {request["custom_id"]: request for request in map(json.loads, f)}
+
+    def _in_flight(self) -> set:
+        ids = set()
+        for job in self.state["jobs"].values():
+            if job["status"] not in ("merged", "failed") and os.path.exists(job["requests_file"]):
+                ids.update(self._read_requests(job["requests_file"]))
+        return ids
+
+    def prepare(self, prompts: Dict[str, str], provider: str = "openai",
+                operations=BATCH_OPERATIONS, budget: Optional[Budget] = None) -> Tuple[Optional[str], int]:
+        """Write the JSONL requests file. Returns (path, count); (None, 0) if there is nothing to do."""
+        skip = set(self.state["merged"]) | self._in_flight()
+        requests = build_requests(self.store, prompts, provider, operations, skip)
+        if budget is not None and budget.limited:
+            requests = fit_budget(requests, budget, provider)
+        if not requests:
+            return None, 0
+        requests.sort(key=lambda request: request["custom_id"])
+        digest = hashlib.sha1("\n".join(r["custom_id"] for r in requests).encode('utf-8')).hexdigest()[:12]
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        requests_file = os.path.join(BATCH_DIR, f"requests-{digest}.jsonl")
+        with open(requests_file, 'w') as f:
+            for request in requests:
+                f.write(json.dumps(request) + "\n")
+        return requests_file, len(requests)
+
+    def submit(self, requests_file: str) -> str:
+        batch_id = self.adapter.submit(requests_file)
+        self.state["jobs"][batch_id] = {
+            "adapter": self.adapter.name,
+            "requests_file": requests_file,
+            "status": "in_progress",
+            "submitted": int(time.time()),
+        }
+        self._save()
+        return batch_id
+
+    def poll(self, batch_id: str, interval: float = BATCH_POLL_SECONDS, timeout: Optional[float] = None) -> str:
+        """Wait until the batch completes or fails (or the timeout passes). Returns the last status."""
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            status = self.adapter.status(batch_id)
+            if status != "in_progress" or (deadline is not None and time.time() >= deadline):
+                break
+            time.sleep(interval)
+        job = self.state["jobs"][batch_id]
+        if job["status"] != "merged":
+            job["status"] = status
+            self._save()
+        return status
+
+    def merge(self, batch_id: str) -> Dict[str, int]:
+        """Apply a completed batch's results to the store. Results already merged are skipped."""
+        job = self.state["jobs"][batch_id]
+        requests = self._read_requests(job["requests_file"])
+        merged = set(self.state["merged"])
+        stats = {"applied": 0, "skipped": 0, "failed": 0}
+        updates: Dict[Any, Dict[str, Any]] = {}
+        for result in self.adapter.results(batch_id):
+            request = requests.get(result["custom_id"])
+            if request is None or result["custom_id"] in merged:
+                stats["skipped"] += 1
+                continue
+            if "error" in result:
+                # Not recorded as merged, so the next prepare() asks again
+                print(f"Batch request {result['custom_id']} failed: {result['error']}")
+                stats["failed"] += 1
+                continue
+            if request["operation"] == "categorize":
+                category = parse_category(result["text"])
+                for email_id in request["targets"]:
+                    updates.setdefault(email_id, {})['category'] = category
+            else:
+                try:
+                    actions = clean_action_items(parse_reply(result["text"], ActionItems))
+                except ValueError as e:
+                    print(f"Batch request {result['custom_id']} returned malformed JSON: {e}")
+                    stats["failed"] += 1
+                    continue
+                email = self.store.get(request["email_id"])
+                received = email['timestamp'] if email else None
+                tasks = [{'text': item, 'due': parse_due(item, received)} for item in actions]
+                # Like Extract Tasks: every message gets the items, only the newest indexes them
+                for email_id in request["targets"]:
+                    updates.setdefault(email_id, {}).update(
+                        action_items=actions, tasks=tasks if email_id == request["email_id"] else [])
+            merged.add(result["custom_id"])
+            stats["applied"] += 1
+        if updates:
+            self.store.update_emails(updates)
+        self.state["merged"] = sorted(merged)
+        job["status"] = "merged"
+        job["merge_stats"] = stats
+        self._save()
+        return stats
+
+    def run(self, prompts: Dict[str, str], provider: str = "openai", operations=BATCH_OPERATIONS,
+            interval: float = BATCH_POLL_SECONDS, budget: Optional[Budget] = None) -> Dict[str, Any]:
+        """Merge any batches that finished since the last run, then prepare, submit, poll and merge a new one."""
+        budget = budget or Budget()
+
+        def time_left():
+            if not budget.max_minutes:
+                return None
+            return max(0.0, budget.started + budget.max_minutes * 60 - time.time())
+
+        for batch_id, job in list(self.state["jobs"].items()):
+            if job["adapter"] == self.adapter.name and job["status"] in ("in_progress", "completed"):
+                if self.poll(batch_id, interval, time_left()) == "completed":
+                    self.merge(batch_id)
+        requests_file, count = self.prepare(prompts, provider, operations, budget)
+        if requests_file is None:
+            return {"requests": 0, "budget": budget.summary()}
+        batch_id = self.submit(requests_file)
+        status = self.poll(batch_id, interval, time_left())
+        stats = self.merge(batch_id) if status == "completed" else {}
+        return dict(stats, requests=count, batch_id=batch_id, status=status, budget=budget.summary())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk categorize / extract through provider batch endpoints")
+    parser.add_argument("command", choices=["run", "status"])
+    parser.add_argument("--adapter", choices=sorted(ADAPTERS), default="local")
+    parser.add_argument("--provider", default="openai", help="Provider whose models and settings the requests use")
+    parser.add_argument("--operations", default=",".join(BATCH_OPERATIONS))
+    parser.add_argument("--poll", type=float, default=BATCH_POLL_SECONDS, help="Seconds between status checks")
+    parser.add_argument("--max-tokens", type=int, default=BUDGET_MAX_TOKENS, help="Token budget (0 = no limit)")
+    parser.add_argument("--max-cost", type=float, default=BUDGET_MAX_COST, help="Cost budget in USD (0 = no limit)")
+    parser.add_argument("--max-minutes", type=float, default=BUDGET_MAX_MINUTES,
+                        help="How long to wait for results; unfinished batches are merged by a later run")
+    args = parser.parse_args(argv)
+
+    from mail_store import MailStore
+    store = MailStore()
+    store.load(months=None)  # Bulk runs cover every active partition, not just recent mail
+    runner = BatchRunner(store, ADAPTERS[args.adapter]())
+    if args.command == "status":
+        for batch_id, job in runner.state["jobs"].items():
+            print(f"{batch_id}  {job['adapter']:<7} {job['status']:<12} {job.get('merge_stats', '')}")
+        print(f"{len(runner.state['merged'])} request(s) merged in total")
+        return
+    prompts = {name: prompt['template'] for name, prompt in store.prompts.items()}
+    operations = [op.strip() for op in args.operations.split(",") if op.strip()]
+    budget = Budget(args.max_tokens, args.max_cost, args.max_minutes)
+    print(runner.run(prompts, args.provider, operations, args.poll, budget))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,252 @@
+"""
+Ad-hoc benchmarks for the storage layer: in-memory record size,
+on-disk codec speed, body compression, partitioned loading, warm start
+from the state snapshot and semantic search latency.
+
+Usage: python benchmarks.py [record_count]
+"""
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import storage
+from dedup import NearDuplicateIndex
+from records import EmailRecord
+from state_snapshot import StateSnapshot
+from vector_index import VECTOR_DIM, VectorIndex
+
+SENDERS = [f"user{i}@example{i % 20}.com" for i in range(500)]
+CATEGORIES = ["Important", "Newsletter", "Spam", "To-Do", "Uncategorized"]
+
+
+def make_headers_json(count):
+    """Serialized header index with a realistic mix of repeated senders/categories."""
+    now = datetime.now()
+    return json.dumps([
+        {
+            "id": i + 1,
+            "sender": random.choice(SENDERS),
+            "subject": f"Subject line number {i}",
+            "timestamp": (now - timedelta(minutes=i)).isoformat(),
+            "category": random.choice(CATEGORIES),
+            "action_items": [],
+            "is_read": False,
+            "body_offset": i * 1000,
+            "body_length": 1000,
+        }
+        for i in range(count)
+    ])
+
+
+def measure(build):
+    """Return (result, bytes allocated) for the object graph built by build()."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def bench_record_memory(count=1_000_000):
+    """Compare memory held by plain header dicts (the old load_emails() shape) vs EmailRecords."""
+    source = make_headers_json(count)
+
+    def build_dicts():
+        data = json.loads(source)
+        for header in data:
+            header['timestamp'] = datetime.fromisoformat(header['timestamp'])
+        return data
+
+    def build_records():
+        return [EmailRecord.from_dict(header) for header in json.loads(source)]
+
+    dicts, dict_bytes = measure(build_dicts)
+    del dicts
+    records, record_bytes = measure(build_records)
+    del records
+
+    print(f"Email headers: {count:,}")
+    print(f"  dict records:    {dict_bytes / 1e6:8.1f} MB")
+    print(f"  EmailRecord:     {record_bytes / 1e6:8.1f} MB")
+    print(f"  reduction:       {(1 - record_bytes / dict_bytes) * 100:8.1f} %")
+
+
+def bench_codecs(count=1_000_000):
+    """Compare header-stream write/read time and file size for each available storage codec."""
+    headers = [EmailRecord.from_dict(header).to_dict() for header in json.loads(make_headers_json(count))]
+    print(f"Header stream codecs ({count:,} records):")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, codec_class in storage.CODECS.items():
+            if name in storage._CODEC_DEPENDENCIES and storage._CODEC_DEPENDENCIES[name]() is None:
+                print(f"  {name:8} (not installed)")
+                continue
+            codec = codec_class()
+            path = os.path.join(tmp, name)
+            start = time.perf_counter()
+            with open(path, 'wb') as f:
+                f.write(codec.magic)
+                codec.write_records(f, headers)
+            write_time = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(path, 'rb') as f:
+                f.seek(len(codec.magic))
+                loaded = sum(1 for _ in codec.iter_records(f))
+            read_time = time.perf_counter() - start
+            assert loaded == count
+            size = os.path.getsize(path)
+            print(f"  {name:8} write {write_time:6.2f}s  read {read_time:6.2f}s  size {size / 1e6:7.1f} MB")
+
+
+def bench_vector_search(count=1_000_000, queries=20):
+    """Query latency over `count` random unit vectors (embedding cost is excluded)."""
+    import numpy as np
+
+    print(f"\nVector search over {count:,} emails ({VECTOR_DIM} dims)")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        index = VectorIndex(directory)
+        index._map(count)
+        for start in range(0, count, 100_000):
+            block = rng.standard_normal((min(100_000, count - start), VECTOR_DIM), dtype=np.float32)
+            index.vectors[start:start + len(block)] = block / np.linalg.norm(block, axis=1, keepdims=True)
+        index.ids[:] = np.arange(count)
+        index.count = count
+        index.search("warm up the page cache", k=20)
+        words = [f"topic{i} budget report meeting" for i in range(queries)]
+        start = time.perf_counter()
+        for query in words:
+            index.search(query, k=20)
+        elapsed = (time.perf_counter() - start) / queries
+        print(f"  top-20 query {elapsed * 1000:6.1f} ms  index {os.path.getsize(index.vectors_file) / 1e6:7.1f} MB")
+
+
+
+def bench_body_compression(count=1_000_000):
+    """Body store size and read latency per body codec, on mock-email bodies (capped at 20k)."""
+    from ingestion import generate_mock_emails
+
+    count = min(count, 20_000)
+    templates = [email['body'] for email in generate_mock_emails(20)]
+    bodies = [templates[i % len(templates)].replace("team", f"team {i}") for i in range(count)]
+    raw_bytes = sum(len(body.encode('utf-8')) for body in bodies)
+    codecs = ["none", "zlib"] + (["zstd"] if storage.zstandard is not None else [])
+    print(f"\nBody compression: {count:,} bodies, {raw_bytes / 1e6:.1f} MB plain text")
+    saved = (storage.PARTITIONS_DIR, storage.BODY_DICT_FILE, storage.BODY_COMPRESSION)
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in codecs:
+            storage.PARTITIONS_DIR = os.path.join(directory, codec)
+            storage.BODY_DICT_FILE = os.path.join(directory, "bodies.zdict")
+            storage.BODY_COMPRESSION = codec
+            records = [EmailRecord(i, "a@b.c", "s", 0, body=body) for i, body in enumerate(bodies)]
+            start = time.perf_counter()
+            for chunk_start in range(0, count, storage.CHUNK_SIZE):
+                storage._write_pending_bodies(records[chunk_start:chunk_start + storage.CHUNK_SIZE])
+            write_time = time.perf_counter() - start
+            storage._read_body.cache_clear()
+            start = time.perf_counter()
+            for record in records:
+                storage.get_body(record)
+            read_time = time.perf_counter() - start
+            size = os.path.getsize(storage._bodies_path(storage.partition_key(records[0])))
+            print(f"  {codec:5s} {size / 1e6:7.2f} MB ({raw_bytes / size:4.1f}x)  write {write_time:6.2f}s  "
+                  f"read {read_time / count * 1e6:6.1f} us/body")
+    storage.PARTITIONS_DIR, storage.BODY_DICT_FILE, storage.BODY_COMPRESSION = saved
+    storage._zstd_dictionary = None
+    storage._read_body.cache_clear()
+
+
+
+def bench_partitioned_load(count=1_000_000, months=60):
+    """Startup load time for the newest partitions vs. the whole history (`count` emails over `months`)."""
+    from mail_store import STARTUP_MONTHS
+
+    count = min(count, 200_000)
+    print(f"\nPartitioned load: {count:,} emails over {months} months")
+    saved = (storage.PARTITIONS_DIR, storage.MANIFEST_FILE)
+    with tempfile.TemporaryDirectory() as directory:
+        storage.PARTITIONS_DIR = os.path.join(directory, "partitions")
+        storage.MANIFEST_FILE = os.path.join(directory, "partitions.json")
+        now = time.time()
+        per_month = count // months
+        for month in range(months):
+            storage.append_emails([
+                EmailRecord(month * per_month + i + 1, random.choice(SENDERS), f"Subject {i}",
+                            now - month * 30.5 * 86400 - i * 60, body_offset=0, body_length=0)
+                for i in range(per_month)
+            ])
+        for label, selection in ((f"newest {STARTUP_MONTHS}", storage.list_partitions()[:STARTUP_MONTHS]),
+                                 ("all", None)):
+            start = time.perf_counter()
+            loaded = storage.load_emails(selection)
+            print(f"  {label:10s} {len(loaded):9,} emails  {(time.perf_counter() - start) * 1000:8.1f} ms")
+    storage.PARTITIONS_DIR, storage.MANIFEST_FILE = saved
+
+
+def bench_warm_start(count=1_000_000, months=60):
+    """Loading every partition from header files vs. from the binary state snapshot plus its journal."""
+    print(f"\nWarm start: {count:,} emails over {months} months")
+    saved = (storage.PARTITIONS_DIR, storage.MANIFEST_FILE)
+    with tempfile.TemporaryDirectory() as directory:
+        storage.PARTITIONS_DIR = os.path.join(directory, "partitions")
+        storage.MANIFEST_FILE = os.path.join(directory, "partitions.json")
+        now = time.time()
+        per_month = count // months
+        for month in range(months):
+            storage.append_emails([
+                EmailRecord(month * per_month + i + 1, random.choice(SENDERS), f"Subject line number {i}",
+                            now - month * 30.5 * 86400 - i * 60, category=random.choice(CATEGORIES),
+                            body_offset=i * 1000, body_length=1000)
+                for i in range(per_month)
+            ])
+        snapshot = StateSnapshot(os.path.join(directory, "snapshot.bin"), os.path.join(directory, "snapshot.journal"))
+        partitions = storage.list_partitions()
+
+        start = time.perf_counter()
+        records = storage.load_emails()
+        print(f"  header files   {len(records):9,} emails  {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        start = time.perf_counter()
+        job = snapshot.prepare(records, NearDuplicateIndex(), os.path.join(directory, "dedup_index.json"))
+        snapshot.write(job)
+        snapshot.install(job)
+        size = os.path.getsize(snapshot.path) / (1024 * 1024)
+        print(f"  write snapshot {size:9.1f} MB      {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        # A day of categorization results in the journal
+        changed = random.sample(records[:per_month * 3], min(2000, per_month * 3))
+        changes = [record.replace(category="Important") for record in changed]
+        consistent = snapshot.consistent({storage.partition_key(record) for record in changes})
+        by_id = {record.id: record for record in changes}
+        storage.save_emails([by_id.get(record.id, record) for record in records
+                             if storage.partition_key(record) in consistent])
+        snapshot.log(changes, consistent)
+
+        del records
+        gc.collect()
+        for label, selection in (("snapshot", partitions), ("snapshot, 3 mo", partitions[:3])):
+            start = time.perf_counter()
+            snapshot.open()
+            loaded, stale = snapshot.load_months(selection)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"  {label:14s} {len(loaded):9,} emails  {elapsed:8.1f} ms  ({len(stale)} months from header files)")
+            del loaded
+            gc.collect()
+        snapshot.close()
+    storage.PARTITIONS_DIR, storage.MANIFEST_FILE = saved
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    bench_record_memory(count)
+    bench_codecs(count)
+    bench_body_compression(count)
+    bench_partitioned_load(count)
+    bench_warm_start(count)
+    bench_vector_search(count)
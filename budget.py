@@ -0,0 +1,266 @@
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from llm_service import MODEL_PRICES, PROVIDER_MODELS, SYSTEM_PROMPT, TASK_SETTINGS, build_prompt, email_variable
+from preprocessing import estimate_tokens, prepare_body
+from task_extraction import extract_tasks
+
+# Run-level limits for bulk LLM work (Categorize All, batch jobs); 0 = no limit
+BUDGET_MAX_TOKENS = int(os.getenv("BUDGET_MAX_TOKENS", "0"))
+BUDGET_MAX_COST = float(os.getenv("BUDGET_MAX_COST", "0"))  # USD, at MODEL_PRICES list prices
+BUDGET_MAX_MINUTES = float(os.getenv("BUDGET_MAX_MINUTES", "0"))
+# Once less than this share of any limit is left, calls move to a cheaper model where there is one
+BUDGET_DOWNGRADE_AT = float(os.getenv("BUDGET_DOWNGRADE_AT", "0.25"))
+# When not even the cheaper model fits, answer with the local rules instead of stopping the run
+BUDGET_LOCAL_FALLBACK = os.getenv("BUDGET_LOCAL_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+# Keyword rules of the local classifier, in priority order
+LOCAL_CATEGORY_RULES = [
+    ("Spam", re.compile(r"\b(winner|lottery|claim your|congratulations|prize|free gift|act now)\b", re.IGNORECASE)),
+    ("Important", re.compile(r"\b(urgent|asap|important|critical|deadline|action required|final notice)\b",
+                             re.IGNORECASE)),
+    ("Newsletter", re.compile(r"\b(newsletter|weekly|digest|unsubscribe|subscribe)\b", re.IGNORECASE)),
+    ("To-Do", re.compile(r"\b(please|review|approve|submit|meeting|task|confirm)\b", re.IGNORECASE)),
+]
+
+
+class BudgetExceeded(Exception):
+    """A run hit its deadline, or its token/cost limit with no cheaper way left to answer."""
+
+
+class Budget:
+    """
+    Limits for one bulk run and what has been spent against them. Spending
+    is charged from the provider-reported usage where there is one and from
+    the pre-call estimate otherwise (mock service, Hugging Face).
+    """
+
+    def __init__(self, max_tokens: int = BUDGET_MAX_TOKENS, max_cost: float = BUDGET_MAX_COST,
+                 max_minutes: float = BUDGET_MAX_MINUTES):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.max_minutes = max_minutes
+        self.started = time.time()
+        self.tokens = 0
+        self.cost = 0.0
+        self.calls = {"primary": 0, "cheaper": 0, "local": 0}
+        self.deferred = 0  # Batch requests left for a later run
+
+    @property
+    def limited(self) -> bool:
+        return bool(self.max_tokens or self.max_cost or self.max_minutes)
+
+    @property
+    def expired(self) -> bool:
+        return bool(self.max_minutes) and time.time() - self.started >= self.max_minutes * 60
+
+    def remaining_share(self) -> float:
+        """Share of the tightest limit still left (1.0 if unlimited)."""
+        shares = [1.0]
+        if self.max_tokens:
+            shares.append(1 - self.tokens / self.max_tokens)
+        if self.max_cost:
+            shares.append(1 - self.cost / self.max_cost)
+        if self.max_minutes:
+            shares.append(1 - (time.time() - self.started) / (self.max_minutes * 60))
+        return max(0.0, min(shares))
+
+    def fits(self, tokens: int, cost: float) -> bool:
+        """Whether a call estimated at tokens/cost still fits the token and cost limits."""
+        if self.max_tokens and self.tokens + tokens > self.max_tokens:
+            return False
+        return not (self.max_cost and self.cost + cost > self.max_cost)
+
+    def charge(self, tokens: int, cost: float, mode: str = "primary"):
+        self.tokens += tokens
+        self.cost += cost
+        self.calls[mode] += 1
+
+    def exceeded_reason(self, tokens: int = 0) -> str:
+        """Which limit stops a call estimated at `tokens` (see fits)."""
+        if self.expired:
+            return f"deadline of {self.max_minutes:g} min reached"
+        if self.max_tokens and self.tokens + tokens > self.max_tokens:
+            return f"token budget of {self.max_tokens:,} used up"
+        return f"cost budget of ${self.max_cost:g} used up"
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "max_tokens": self.max_tokens, "max_cost": self.max_cost, "max_minutes": self.max_minutes,
+            "tokens": self.tokens, "cost_usd": round(self.cost, 4),
+            "minutes": round((time.time() - self.started) / 60, 1),
+            "calls": dict(self.calls), "deferred": self.deferred,
+        }
+
+
+def estimate_call(operation: str, model: Optional[str], prompt: str) -> Tuple[int, float]:
+    """
+    (tokens, USD) a call is expected to use: the prompt as counted locally
+    plus the operation's max_tokens as worst-case output.
+    """
+    prompt_tokens = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt)
+    output_tokens = TASK_SETTINGS[operation]["max_tokens"]
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return prompt_tokens + output_tokens, (prompt_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def cheaper_model(provider: str, operation: str, model: str) -> Optional[str]:
+    """The provider's cheapest configured model for the operation, if it is cheaper than `model`."""
+    if provider not in PROVIDER_MODELS or model not in MODEL_PRICES:
+        return None
+    output_tokens = TASK_SETTINGS[operation]["max_tokens"]
+
+    def price(name):
+        input_price, output_price = MODEL_PRICES[name]
+        return input_price * 1000 + output_price * output_tokens  # ~1k-token prompt
+
+    candidates = [name for name in PROVIDER_MODELS[provider].values() if name in MODEL_PRICES]
+    best = min(candidates, key=price, default=None)
+    return best if best is not None and price(best) < price(model) else None
+
+
+def choose_model(budget: Budget, provider: str, operation: str, models: List[Optional[str]],
+                 prompt: str) -> Tuple[Optional[str], Optional[str], int, float]:
+    """
+    (mode, model, tokens, cost) for one call. mode is "primary" (as
+    configured) or "cheaper" (the provider's cheapest model: preferred once
+    less than BUDGET_DOWNGRADE_AT of the budget is left, and used whenever
+    the configured model no longer fits), or None if neither fits.
+    `models` are those the call may go to; the router's calls are costed at
+    the priciest and never downgraded.
+    """
+    tokens, cost = max((estimate_call(operation, model, prompt) for model in models or [None]),
+                       key=lambda estimate: estimate[1])
+    options = [("primary", models[0] if len(models) == 1 else None, tokens, cost)]
+    cheaper = cheaper_model(provider, operation, models[0]) if len(models) == 1 else None
+    if cheaper:
+        cheaper_option = ("cheaper", cheaper) + estimate_call(operation, cheaper, prompt)
+        if budget.remaining_share() <= BUDGET_DOWNGRADE_AT:
+            options.insert(0, cheaper_option)
+        else:
+            options.append(cheaper_option)
+    for option in options:
+        if budget.fits(option[2], option[3]):
+            return option
+    return None, None, tokens, cost
+
+
+def service_models(service, operation: str) -> List[str]:
+    """Models a service could use for an operation (every provider, for the router); [] for the mock service."""
+    if getattr(service, "services", None):
+        return [member.task_settings(operation)["model"] for member in service.services.values()]
+    if getattr(service, "provider", None) in PROVIDER_MODELS:
+        return [service.task_settings(operation)["model"]]
+    return []
+
+
+def call_prompt(operation: str, subject: str, body: str, template: str) -> str:
+    """The prompt LLMService sends for a bulk operation on one email."""
+    prepared, _ = prepare_body(body, operation)
+    return build_prompt(template, operation, email_variable(subject, prepared))
+
+
+def estimate_service_call(service, operation: str, prompt: str) -> Tuple[int, float]:
+    """Estimate for the model the service would use; the router may pick any provider, so its priciest."""
+    models = service_models(service, operation) or [None]
+    return max((estimate_call(operation, model, prompt) for model in models), key=lambda estimate: estimate[1])
+
+
+def prompt_categories(template: str) -> List[str]:
+    """Category names listed in a categorization prompt ("... into one of these categories: A, B, C.")."""
+    match = re.search(r"categor(?:y|ies)\s*:\s*([^.\n]+)", template or "", re.IGNORECASE)
+    if not match:
+        return []
+    names = re.split(r",|\bor\b", match.group(1))
+    return [name.strip().strip('"\'') for name in names if name.strip()]
+
+
+def local_category(subject: str, body: str, prompt_template: str) -> str:
+    """
+    Keyword classifier used when the budget has no room left for the LLM.
+    Only answers with categories the prompt asks for; "Uncategorized" otherwise.
+    """
+    allowed = {name.lower(): name for name in prompt_categories(prompt_template)}
+    text = f"{subject}\n{body}"
+    for category, pattern in LOCAL_CATEGORY_RULES:
+        if (not allowed or category.lower() in allowed) and pattern.search(text):
+            return allowed.get(category.lower(), category)
+    return "Uncategorized"
+
+
+class BudgetedService:
+    """
+    Budget controller around an LLMService (or LLMRouter / MockLLMService)
+    for bulk runs. Exposes the bulk operations (categorize_email,
+    extract_action_items) and, before each call, estimates its cost from the
+    prompt size:
+
+    - while more than BUDGET_DOWNGRADE_AT of the budget is left, the call
+      runs as configured;
+    - once the budget is tight, it moves to the provider's cheapest model
+      if that is cheaper (e.g. a categorization pinned to gpt-4 goes to
+      gpt-4o-mini);
+    - when not even that fits, it is answered by the local rules
+      (BUDGET_LOCAL_FALLBACK) or BudgetExceeded is raised;
+    - past the deadline BudgetExceeded is always raised, so the caller can
+      checkpoint what it has and stop.
+
+    Each call runs on a with_own_stats() copy of the service and is charged
+    from that copy's usage (then merged into the service's stats for the
+    Settings page), so prefetching and chats using the same service during
+    the run aren't billed to it. Services without per-task stats (the mock)
+    are charged the pre-call estimate.
+    """
+
+    def __init__(self, service, budget: Budget):
+        self.service = service
+        self.budget = budget
+        self.provider = getattr(service, "provider", "mock")
+
+
+    def _route(self, operation: str, subject: str, body: str, template: str):
+        """(mode, service or None for the local rules, estimated tokens, estimated cost) for one call."""
+        if self.budget.expired:
+            raise BudgetExceeded(self.budget.exceeded_reason())
+        prompt = call_prompt(operation, subject, body, template)
+        mode, model, tokens, cost = choose_model(self.budget, self.provider, operation,
+                                                 service_models(self.service, operation), prompt)
+        if mode == "primary":
+            return mode, self.service, tokens, cost
+        if mode == "cheaper":
+            return mode, self.service.with_models({operation: model}), tokens, cost
+        if BUDGET_LOCAL_FALLBACK:
+            return "local", None, 0, 0.0
+        raise BudgetExceeded(self.budget.exceeded_reason(tokens))
+
+    def _call(self, mode: str, service, method: str, args, tokens: int, cost: float):
+        """Make one call and charge the budget with its own usage, or the estimate if there is none."""
+        own = service.with_own_stats() if hasattr(service, "with_own_stats") else None
+        result = getattr(own or service, method)(*args)
+        if own is not None and own.task_stats:
+            service.merge_task_stats(own.task_stats)
+            stats = own.task_stats.values()
+            tokens = sum(s["prompt_tokens"] + s["completion_tokens"] for s in stats)
+            cost = sum(s["cost_usd"] for s in stats)
+        self.budget.charge(tokens, cost, mode)
+        return result
+
+    def categorize_email(self, email_subject: str, email_body: str, prompt_template: str) -> str:
+        mode, service, tokens, cost = self._route("categorize", email_subject, email_body, prompt_template)
+        if service is None:
+            self.budget.charge(0, 0.0, mode)
+            return local_category(email_subject, email_body, prompt_template)
+        return self._call(mode, service, "categorize_email", (email_subject, email_body, prompt_template),
+                          tokens, cost)
+
+    def extract_action_items(self, email_subject: str, email_body: str, prompt_template: str) -> list:
+        mode, service, tokens, cost = self._route("extract", email_subject, email_body, prompt_template)
+        if service is None:
+            self.budget.charge(0, 0.0, mode)
+            tasks, _ = extract_tasks(email_body, None)
+            return [task["text"] for task in tasks]
+        return self._call(mode, service, "extract_action_items", (email_subject, email_body, prompt_template),
+                          tokens, cost)
+
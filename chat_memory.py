@@ -0,0 +1,85 @@
+import os
+import re
+from typing import Callable, List, Optional, Tuple
+
+from preprocessing import estimate_tokens, truncate_to_budget
+
+# Tokens of conversation history sent with each chat prompt (summary + recent turns)
+CHAT_MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", "1200"))
+# Share of the budget reserved for the running summary of older turns
+SUMMARY_SHARE = 0.3
+
+
+def _first_sentence(text: str, limit: int = 160) -> str:
+    text = re.sub(r"\s+", " ", text or "").strip()
+    match = re.match(r"(.+?[.!?])(\s|$)", text)
+    sentence = match.group(1) if match else text
+    return sentence if len(sentence) <= limit else sentence[:limit].rstrip() + "…"
+
+
+def local_summary(summary: str, turns: List[Tuple[str, str]], max_tokens: int) -> str:
+    """Extractive fallback: the first sentence of each folded turn, dropping the oldest lines to fit."""
+    lines = summary.split("\n") if summary else []
+    for role, content in turns:
+        lines.append(f"{'User' if role == 'user' else 'Agent'}: {_first_sentence(content)}")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class ChatMemory:
+    """
+    Bounded conversation history for multi-turn chat.
+
+    The newest turns are kept verbatim. Once they no longer fit the budget,
+    the oldest are folded into a running summary, so the history sent with
+    each prompt stays at most CHAT_MEMORY_TOKENS however long the
+    conversation gets.
+    """
+
+    def __init__(self, budget: int = CHAT_MEMORY_TOKENS):
+        self.budget = budget
+        self.summary = ""
+        self.turns: List[Tuple[str, str]] = []  # (role, content), oldest first
+
+    def add(self, role: str, content: str, summarize: Optional[Callable] = None):
+        """
+        Record a turn, folding older turns into the summary if needed.
+        `summarize(summary, turns) -> str` condenses folded turns (e.g. with the
+        LLM); without it, or if it fails, an extractive summary is used.
+        """
+        self.turns.append((role, content))
+        summary_budget = int(self.budget * SUMMARY_SHARE)
+        recent_budget = self.budget - summary_budget
+        folded = []
+        # Always keep the latest turn, even if it alone is over budget (it gets truncated in render())
+        while len(self.turns) > 1 and sum(estimate_tokens(c) for _, c in self.turns) > recent_budget:
+            folded.append(self.turns.pop(0))
+        if not folded:
+            return
+        summary = None
+        if summarize is not None:
+            try:
+                summary = summarize(self.summary, folded)
+            except Exception as e:
+                print(f"Error summarizing chat history: {e}")
+        if not summary:
+            summary = local_summary(self.summary, folded, summary_budget)
+        self.summary = truncate_to_budget(summary, summary_budget)
+
+    def render(self) -> str:
+        """History block for the prompt ('' for a new conversation)."""
+        if not self.summary and not self.turns:
+            return ""
+        parts = ["Conversation so far:"]
+        if self.summary:
+            parts.append(f"Summary of earlier turns:\n{self.summary}")
+        recent_budget = self.budget - int(self.budget * SUMMARY_SHARE)
+        for role, content in self.turns:
+            content = truncate_to_budget(content, recent_budget)
+            parts.append(f"{'User' if role == 'user' else 'Agent'}: {content}")
+        return "\n".join(parts)
+
+    def clear(self):
+        self.summary = ""
+        self.turns = []
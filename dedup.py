@@ -0,0 +1,125 @@
+import json
+import os
+import random
+import re
+import zlib
+from typing import Dict, List, Optional
+
+from preprocessing import strip_history
+
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+NUM_PERM = 64
+BANDS = 16  # 16 bands x 4 rows: candidates from ~0.5 Jaccard, verified against the threshold
+SHINGLE_SIZE = 3
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1729)  # Fixed seed so signatures are stable across runs
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+
+def normalize_for_hash(text: str) -> str:
+    """Reduce a body to the words that identify its template: no history, URLs or numbers."""
+    text = strip_history(text or "").lower()
+    text = re.sub(r"https?://\S+|www\.\S+|\S+@\S+", " ", text)
+    text = re.sub(r"\d+", "0", text)
+    return re.sub(r"[^\w]+", " ", text).strip()
+
+
+def minhash_signature(text: str) -> List[int]:
+    """MinHash signature of the word shingles of a normalized body."""
+    words = normalize_for_hash(text).split()
+    if len(words) < SHINGLE_SIZE:
+        shingles = {" ".join(words)} if words else {""}
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(sig_a: List[int], sig_b: List[int]) -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+class NearDuplicateIndex:
+    """
+    LSH index over cluster representatives.
+
+    Each new email is either attached to the most similar existing
+    representative (estimated Jaccard >= threshold) or becomes the
+    representative of a new cluster. Only representatives are indexed, so
+    the index grows with the number of distinct templates, not emails.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.representatives: Dict[int, List[int]] = {}
+        self.cluster_sizes: Dict[int, int] = {}
+        self._buckets: Dict[tuple, List[int]] = {}
+
+    def _bands(self, signature):
+        rows = NUM_PERM // BANDS
+        for band in range(BANDS):
+            yield (band, tuple(signature[band * rows:(band + 1) * rows]))
+
+    def find(self, signature) -> Optional[int]:
+        """Representative id of the closest cluster at or above the threshold, if any."""
+        best_id, best_score = None, self.threshold
+        candidates = {rep_id for key in self._bands(signature) for rep_id in self._buckets.get(key, ())}
+        for rep_id in candidates:
+            score = similarity(signature, self.representatives[rep_id])
+            if score >= best_score:
+                best_id, best_score = rep_id, score
+        return best_id
+
+    def add(self, email_id, text: str) -> int:
+        """Index an email and return the id of its cluster's representative."""
+        signature = minhash_signature(text)
+        rep_id = self.find(signature)
+        if rep_id is None:
+            rep_id = email_id
+            self.representatives[rep_id] = signature
+            for key in self._bands(signature):
+                self._buckets.setdefault(key, []).append(rep_id)
+        self.cluster_sizes[rep_id] = self.cluster_sizes.get(rep_id, 0) + 1
+        return rep_id
+
+    def stats(self) -> Dict[str, int]:
+        emails = sum(self.cluster_sizes.values())
+        return {
+            "emails": emails,
+            "clusters": len(self.representatives),
+            "duplicate_clusters": sum(1 for size in self.cluster_sizes.values() if size > 1),
+            "duplicates": emails - len(self.representatives),
+        }
+
+    def save(self, path: str):
+        data = {
+            "threshold": self.threshold,
+            "representatives": {str(k): v for k, v in self.representatives.items()},
+            "cluster_sizes": {str(k): v for k, v in self.cluster_sizes.items()},
+        }
+        tmp_file = path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path: str, threshold: float = DEDUP_THRESHOLD) -> "NearDuplicateIndex":
+        index = cls(threshold)
+        if not os.path.exists(path):
+            return index
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error loading duplicate index: {e}")
+            return index
+        index.threshold = data.get("threshold", threshold)
+        for key, signature in data.get("representatives", {}).items():
+            rep_id = int(key)
+            index.representatives[rep_id] = signature
+            for band in index._bands(signature):
+                index._buckets.setdefault(band, []).append(rep_id)
+        index.cluster_sizes = {int(k): v for k, v in data.get("cluster_sizes", {}).items()}
+        return index
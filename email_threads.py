@@ -0,0 +1,114 @@
+import re
+from typing import Callable, Dict, List
+
+from preprocessing import normalize_whitespace, strip_history, strip_signature_and_footer
+
+REPLY_PREFIX = re.compile(r"^\s*((re|fw|fwd|aw|sv|antw)\s*(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+LIST_TAG = re.compile(r"^\s*\[[^\]]{1,40}\]\s*")
+
+
+def normalize_subject(subject: str) -> str:
+    """Strip reply/forward prefixes and list tags so a conversation shares one subject."""
+    subject = subject or ""
+    previous = None
+    while previous != subject:
+        previous = subject
+        subject = LIST_TAG.sub("", REPLY_PREFIX.sub("", subject))
+    return re.sub(r"\s+", " ", subject).strip().lower()
+
+
+def is_reply(subject: str) -> bool:
+    return bool(REPLY_PREFIX.match(subject or ""))
+
+
+class _UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        self.parent.setdefault(item, item)
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[root_b] = root_a
+
+
+def build_threads(emails) -> Dict[int, List]:
+    """
+    Group emails into conversations.
+
+    Messages are linked through Message-ID / In-Reply-To / References headers.
+    Emails without usable headers (e.g. mock data) fall back to the normalized
+    subject, but only when at least one email with that subject is a reply or
+    forward, so unrelated mail with a common subject isn't merged.
+
+    Returns: {thread_id: [emails oldest first]}, thread_id being the id of the
+    oldest email in the thread.
+    """
+    links = _UnionFind()
+    by_message_id = {}
+    for email in emails:
+        links.find(email['id'])
+        message_id = email.get('message_id')
+        if message_id:
+            by_message_id[message_id] = email['id']
+
+    linked = set()
+    for email in emails:
+        parents = list(email.get('references') or [])
+        if email.get('in_reply_to'):
+            parents.append(email['in_reply_to'])
+        for parent in parents:
+            if parent in by_message_id:
+                links.union(by_message_id[parent], email['id'])
+                linked.update((by_message_id[parent], email['id']))
+
+    by_subject = {}
+    for email in emails:
+        key = normalize_subject(email['subject'])
+        if key:
+            by_subject.setdefault(key, []).append(email)
+    for group in by_subject.values():
+        if len(group) < 2 or not any(is_reply(email['subject']) for email in group):
+            continue
+        # Only emails without a Message-ID join by subject; emails with headers are threaded by them alone
+        headerless = [email for email in group if not email.get('message_id')]
+        if not headerless:
+            continue
+        anchor = next((email for email in group if email['id'] in linked), headerless[0])
+        for email in headerless:
+            links.union(anchor['id'], email['id'])
+
+    groups = {}
+    for email in emails:
+        groups.setdefault(links.find(email['id']), []).append(email)
+    threads = {}
+    for members in groups.values():
+        members.sort(key=lambda e: e.ts if hasattr(e, 'ts') else e['timestamp'])
+        threads[members[0]['id']] = members
+    return threads
+
+
+def thread_content(members, get_body: Callable) -> str:
+    """
+    Deduplicated text for a whole conversation: each message once, newest
+    first, with quoted history, signatures and exact repeats dropped.
+    prepare_body() cuts long text from the end, so over the token budget it
+    is the oldest messages that are left out, not the latest reply.
+    """
+    seen = set()
+    parts = []
+    for email in reversed(members):
+        body = normalize_whitespace(strip_signature_and_footer(strip_history(get_body(email))))
+        if not body or body in seen:
+            continue
+        seen.add(body)
+        parts.append(f"--- {email['sender']} ({email['timestamp'].strftime('%Y-%m-%d %H:%M')}) ---\n{body}")
+    return "\n\n".join(parts)
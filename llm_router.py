@@ -0,0 +1,206 @@
+import copy
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+from llm_service import LLMService
+
+# Providers the router spreads requests over, in order of preference before latency data exists
+ROUTER_PROVIDERS = [p.strip() for p in os.getenv("LLM_ROUTER_PROVIDERS", "openai,gemini,huggingface").split(",") if p.strip()]
+# Hedge delay used until a provider has enough samples of an operation for a meaningful p95
+DEFAULT_HEDGE_DELAY = float(os.getenv("HEDGE_DELAY_SECONDS", "3.0"))
+MIN_LATENCY_SAMPLES = 20
+# Circuit breaker: open after this many consecutive failures, retry after the cooldown
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 30
+
+
+class ProviderHealth:
+    """
+    Rolling latency samples and circuit-breaker state for one provider.
+    Latency is kept per operation as well as overall: a 20-token
+    categorization and a 600-token draft have very different normal
+    latencies, so each is hedged against its own p95.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = deque(maxlen=200)
+        self.operation_latencies: Dict[str, deque] = {}
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.wins = 0  # Requests answered by this provider
+        self._lock = threading.Lock()
+
+    def _samples(self, operation: Optional[str]):
+        if operation is None:
+            return self.latencies
+        return self.operation_latencies.get(operation, ())
+
+    def percentile(self, q: float, operation: Optional[str] = None) -> Optional[float]:
+        """Latency percentile over every call, or over one operation's calls."""
+        samples = sorted(self._samples(operation))
+        if not samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def hedge_delay(self, operation: Optional[str] = None) -> float:
+        """How long to wait for this provider on an operation before sending a hedged duplicate."""
+        if len(self._samples(operation)) < MIN_LATENCY_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        return self.percentile(0.95, operation)
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at < COOLDOWN_SECONDS:
+            return "open"
+        return "half-open"  # Cooldown over: the next request is a trial
+
+    def record_success(self, latency: float, operation: Optional[str] = None):
+        with self._lock:
+            self.calls += 1
+            self.latencies.append(latency)
+            if operation is not None:
+                self.operation_latencies.setdefault(operation, deque(maxlen=200)).append(latency)
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.calls += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= FAILURE_THRESHOLD or self.state == "half-open":
+                self.opened_at = time.time()
+
+    def summary(self) -> Dict[str, Any]:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "provider": self.name,
+            "state": self.state,
+            "calls": self.calls,
+            "failures": self.failures,
+            "wins": self.wins,
+            "p50_s": round(p50, 2) if p50 is not None else None,
+            "p95_s": round(p95, 2) if p95 is not None else None,
+            "hedge_after_s": ", ".join(f"{operation} {self.hedge_delay(operation):.2f}"
+                                       for operation in sorted(self.operation_latencies)),
+        }
+
+
+class LLMRouter(LLMService):
+    """
+    LLMService that routes each call over several configured providers.
+
+    The request goes to the healthy provider with the lowest median latency.
+    If it hasn't answered within its own observed p95 for that operation, a
+    hedged duplicate is sent to the next provider and whichever answers
+    first wins; a failure fails over to the next provider straight away.
+    Providers that fail FAILURE_THRESHOLD times in a row are skipped for
+    COOLDOWN_SECONDS.
+    """
+
+    def __init__(self, providers: Optional[List[str]] = None):
+        self._init_metrics()
+        self.provider = "router"
+        self.services: Dict[str, LLMService] = {}
+        for name in providers or ROUTER_PROVIDERS:
+            try:
+                service = LLMService(provider=name)
+            except Exception as e:
+                print(f"Router: skipping {name}: {e}")
+                continue
+            # Provider-reported usage and per-task stats land in the router's totals
+            service.metrics, service.call_log, service.task_stats = self.metrics, self.call_log, self.task_stats
+            self.services[name] = service
+        if not self.services:
+            raise ValueError("No LLM providers could be configured for the router")
+        self.model = ",".join(self.services)
+        self.health = {name: ProviderHealth(name) for name in self.services}
+        self.hedge_stats = {"requests": 0, "hedged": 0, "failovers": 0, "backup_wins": 0}
+        self._pool = ThreadPoolExecutor(max_workers=4 * len(self.services))
+
+    def with_own_stats(self) -> "LLMRouter":
+        """See LLMService.with_own_stats; the providers' calls land in the copy's stats too."""
+        router = super().with_own_stats()
+        router.services = {}
+        for name, service in self.services.items():
+            member = copy.copy(service)
+            member.task_stats = router.task_stats
+            router.services[name] = member
+        return router
+
+    def _ranked(self, operation: Optional[str] = None) -> List[str]:
+        """
+        Providers to try for an operation, best first (by its median latency
+        where there are samples of it). If every circuit is open, try them
+        anyway (oldest failure first).
+        """
+        available = [name for name, health in self.health.items() if health.state != "open"]
+        if not available:
+            return sorted(self.health, key=lambda name: self.health[name].opened_at)
+
+        def rank(name):
+            health = self.health[name]
+            p50 = health.percentile(0.5, operation)
+            if p50 is None:
+                p50 = health.percentile(0.5)
+            return (health.state != "closed", p50 if p50 is not None else DEFAULT_HEDGE_DELAY)
+        return sorted(available, key=rank)
+
+    def _attempt(self, name: str, prompt: str, operation: str, json_mode: bool, log_entry) -> str:
+        start = time.perf_counter()
+        try:
+            result = self.services[name]._complete(prompt, operation, json_mode, log_entry)
+        except Exception:
+            self.health[name].record_failure()
+            raise
+        self.health[name].record_success(time.perf_counter() - start, operation)
+        return result
+
+    def _complete(self, prompt: str, operation: str = "chat", json_mode: bool = False,
+                  log_entry: Optional[Dict[str, Any]] = None) -> str:
+        self.hedge_stats["requests"] += 1
+        order = self._ranked(operation)
+        primary = order[0]
+        pending = {self._pool.submit(self._attempt, primary, prompt, operation, json_mode, log_entry): primary}
+        backups = order[1:]
+        timeout = self.health[primary].hedge_delay(operation)
+        last_error = None
+        while pending:
+            done, _ = wait(pending, timeout=timeout if backups else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # Slower than its p95: hedge with the next provider, keep waiting on both
+                name = backups.pop(0)
+                self.hedge_stats["hedged"] += 1
+                pending[self._pool.submit(self._attempt, name, prompt, operation, json_mode, log_entry)] = name
+                timeout = self.health[name].hedge_delay(operation)
+                continue
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"LLM Error ({name}): {str(e)}")
+                    last_error = e
+                    if backups and not pending:
+                        backup = backups.pop(0)
+                        self.hedge_stats["failovers"] += 1
+                        pending[self._pool.submit(self._attempt, backup, prompt, operation, json_mode, log_entry)] = backup
+                        timeout = self.health[backup].hedge_delay(operation)
+                    continue
+                self.health[name].wins += 1
+                if name != primary:
+                    self.hedge_stats["backup_wins"] += 1
+                return result
+        raise last_error
+
+    def provider_stats(self) -> List[Dict[str, Any]]:
+        return [health.summary() for health in self.health.values()]
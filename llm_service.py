@@ -1,173 +1,453 @@
+import copy
 import os
 import json
-from typing import Dict, Any, Optional
+import time
+from collections import deque
+from typing import Dict, Any, List, Optional, Tuple
 from dotenv import load_dotenv
+from preprocessing import estimate_tokens, prepare_body, pack_emails
+from schemas import ActionItems, DraftReply, parse_reply, schema_json
 
 load_dotenv()
 
+# Static system instruction shared by every request. Keeping it (and the
+# template + output spec that follow it) byte-identical across calls lets
+# providers reuse their cached prompt prefix.
+SYSTEM_PROMPT = "You are a helpful email assistant."
+
+# Output-format specs appended after the user-editable template
+OUTPUT_SPECS = {
+    "categorize": "Respond with the category name only.",
+    "extract": 'Respond with JSON only, in the form {"action_items": ["..."]}.',
+    "draft": 'Respond with JSON only, in the form {"subject": "...", "body": "..."}.',
+    "summarize": "Please provide a concise summary of the following email.",
+    "chat": "Please answer the user's question based on the email context.",
+    "mailbox": (
+        "Answer the user's question using only the emails below. Cite every email you "
+        "rely on by its id in square brackets, e.g. [#12]. If the emails don't contain "
+        "the answer, say so."
+    ),
+    "repair": "Your previous reply did not match the required JSON schema. Respond with the corrected JSON only.",
+    "memory": (
+        "Update the running summary of this conversation with the new turns. Keep facts, "
+        "decisions and open questions. Respond with the summary only, in under 150 words."
+    ),
+}
+
+# Generation settings per operation. High-volume classification runs on the
+# provider's fast tier with deterministic sampling; generation uses the strong tier.
+TASK_SETTINGS = {
+    "categorize": {"tier": "fast", "temperature": 0.0, "max_tokens": 20},
+    "extract": {"tier": "fast", "temperature": 0.0, "max_tokens": 300},
+    "memory": {"tier": "fast", "temperature": 0.2, "max_tokens": 250},
+    "repair": {"tier": "fast", "temperature": 0.0, "max_tokens": 600},
+    "summarize": {"tier": "strong", "temperature": 0.3, "max_tokens": 400},
+    "draft": {"tier": "strong", "temperature": 0.7, "max_tokens": 600},
+    "chat": {"tier": "strong", "temperature": 0.5, "max_tokens": 600},
+    "mailbox": {"tier": "strong", "temperature": 0.3, "max_tokens": 600},
+}
+
+# Model per provider and tier. A single operation can be pinned with
+# <PROVIDER>_MODEL_<OPERATION>, e.g. OPENAI_MODEL_DRAFT=gpt-4o.
+PROVIDER_MODELS = {
+    "openai": {
+        "strong": os.getenv("OPENAI_MODEL", "gpt-4"),
+        "fast": os.getenv("OPENAI_FAST_MODEL", "gpt-4o-mini"),
+    },
+    "gemini": {
+        "strong": os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite"),
+        "fast": os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash-lite"),
+    },
+    "huggingface": {
+        "strong": os.getenv("HUGGINGFACE_MODEL", "mistralai/Mistral-7B-Instruct-v0.2"),
+        "fast": os.getenv("HUGGINGFACE_FAST_MODEL", os.getenv("HUGGINGFACE_MODEL", "mistralai/Mistral-7B-Instruct-v0.2")),
+    },
+}
+
+# OpenAI models that reject response_format (JSON mode); others that turn out to are added at runtime
+JSON_MODE_UNSUPPORTED = {"gpt-4", "gpt-4-0613", "gpt-4-0314", "gpt-4-32k", "gpt-3.5-turbo-0613"}
+
+# USD per 1M (input, output) tokens, for the cost estimates on the Settings page
+MODEL_PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gemini-2.5-flash": (0.3, 2.5),
+    "gemini-2.5-flash-lite": (0.1, 0.4),
+}
+
+# Separates the static prefix from the per-request content at the end of the prompt
+VARIABLE_MARKER = "\n\n=== INPUT ===\n"
+
+def task_settings(provider: str, operation: str) -> Dict[str, Any]:
+    """Model, temperature and max_tokens for an operation on a provider."""
+    settings = dict(TASK_SETTINGS.get(operation, TASK_SETTINGS["chat"]))
+    override = os.getenv(f"{provider.upper()}_MODEL_{operation.upper()}")
+    settings["model"] = override or PROVIDER_MODELS[provider][settings["tier"]]
+    return settings
+
+def build_prompt(template: str, operation: str, variable: str) -> str:
+    """
+    Assemble a prompt with the static parts first (template, output spec)
+    and the per-request content in a fixed position at the end.
+    """
+    prefix = "\n\n".join(part for part in (template.strip(), OUTPUT_SPECS[operation]) if part)
+    return f"{prefix}{VARIABLE_MARKER}{variable.strip()}"
+
+def email_variable(email_subject: str, email_body: str) -> str:
+    return f"Email Subject: {email_subject}\nEmail Body: {email_body}"
+
+def parse_category(response: str) -> str:
+    """Category name from a categorization reply, or "Uncategorized" if it is empty."""
+    # Remove quotes, extra whitespace, and take only the first line
+    category = response.strip().strip('"').strip("'").split('\n')[0].strip()
+    
+    # Remove any common prefixes like "Category: " or "Answer: "
+    for prefix in ["Category:", "Answer:", "Response:"]:
+        if category.startswith(prefix):
+            category = category[len(prefix):].strip()
+    return category if category else "Uncategorized"
+
+def clean_action_items(result: Optional[ActionItems]) -> list:
+    if result is None:
+        return []
+    return [item.strip() for item in result.action_items if item.strip()]
+
 class LLMService:
     """
     Service to handle LLM interactions for email processing.
     Supports OpenAI, Google Gemini, and Hugging Face.
     """
     
+    # {operation: model} pinned on a copy made by with_models()
+    model_overrides: Dict[str, str] = {}
+    
     def __init__(self, provider: str = "openai"):
         self.provider = provider.lower()
         
         if self.provider == "openai":
             import openai
             self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            self.model = os.getenv("OPENAI_MODEL", "gpt-4")
         elif self.provider == "gemini":
             import google.generativeai as genai
             genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-            self.model = genai.GenerativeModel(os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite"))
+            self._genai = genai
+            self._gemini_models = {}
         elif self.provider == "huggingface":
             from huggingface_hub import InferenceClient
             self.client = InferenceClient(token=os.getenv("HUGGINGFACE_API_KEY"))
-            # Use a good instruction-tuned model that is free/available on Inference API
-            self.model = os.getenv("HUGGINGFACE_MODEL", "mistralai/Mistral-7B-Instruct-v0.2")
         else:
             raise ValueError(f"Unsupported provider: {provider}")
+        # The strong-tier model, used for generation and shown in the UI
+        self.model = PROVIDER_MODELS[self.provider]["strong"]
+        # Models that are sent JSON prompts without JSON mode (shared with with_models() copies)
+        self.json_mode_unsupported = set(JSON_MODE_UNSUPPORTED)
+        
+        self._init_metrics()
+    
+    def _init_metrics(self):
+        # Running totals plus a short per-call log for the Settings page
+        self.metrics = {
+            "calls": 0, "original_tokens": 0, "prompt_body_tokens": 0, "tokens_saved": 0,
+            "provider_prompt_tokens": 0, "cached_tokens": 0
+        }
+        self.call_log = deque(maxlen=100)
+        # {(operation, model): calls, latency and estimated cost}
+        self.task_stats = {}
+        # Schema-validated replies: how many parsed first time, needed a repair call, or failed
+        self.structured_stats = {"requests": 0, "valid_first_pass": 0, "repaired": 0, "failed": 0}
+    
+    def task_settings(self, operation: str) -> Dict[str, Any]:
+        """Model, temperature and max_tokens for an operation on this provider."""
+        settings = task_settings(self.provider, operation)
+        if operation in self.model_overrides:
+            settings["model"] = self.model_overrides[operation]
+        return settings
+    
+    def with_models(self, models: Dict[str, str]) -> "LLMService":
+        """A copy that runs the given operations on other models, sharing this service's client and stats."""
+        service = copy.copy(self)
+        service.model_overrides = dict(self.model_overrides, **models)
+        return service
+    
+    def with_own_stats(self) -> "LLMService":
+        """
+        A copy that records per-task stats in a dict of its own, so one
+        caller can read its calls' usage apart from calls made through this
+        service at the same time (see merge_task_stats).
+        """
+        service = copy.copy(self)
+        service.task_stats = {}
+        return service
+    
+    def merge_task_stats(self, stats: Dict[Any, Dict[str, Any]]):
+        """Add per-task stats collected on a with_own_stats() copy to this service's."""
+        for key, source in stats.items():
+            target = self.task_stats.setdefault(key, dict(
+                source, calls=0, seconds=0.0, prompt_tokens=0, completion_tokens=0, cost_usd=0.0))
+            for field in ("calls", "seconds", "prompt_tokens", "completion_tokens", "cost_usd"):
+                target[field] += source[field]
+    
+    def _record_task(self, operation: str, model: str, seconds: float, prompt_tokens: int, completion_tokens: int):
+        stats = self.task_stats.setdefault((operation, model), {
+            "operation": operation, "model": model, "calls": 0, "seconds": 0.0,
+            "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0
+        })
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        stats["cost_usd"] += (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+    
+    def task_summary(self) -> List[Dict[str, Any]]:
+        """Per operation/model rows for the Settings page."""
+        return [{
+            "operation": s["operation"], "model": s["model"], "calls": s["calls"],
+            "avg_latency_s": round(s["seconds"] / s["calls"], 2),
+            "tokens_in": s["prompt_tokens"], "tokens_out": s["completion_tokens"],
+            "cost_usd": round(s["cost_usd"], 4),
+        } for s in self.task_stats.values()]
+    
+    def _log_call(self, stats: Dict[str, Any]) -> Dict[str, Any]:
+        """Add a call's body-size stats to the totals and the call log. Returns the log entry."""
+        self.metrics["calls"] += 1
+        self.metrics["original_tokens"] += stats["original_tokens"]
+        self.metrics["prompt_body_tokens"] += stats["final_tokens"]
+        self.metrics["tokens_saved"] += stats["tokens_saved"]
+        self.call_log.append(stats)
+        return stats
+    
+    def _prepare_body(self, email_body: str, operation: str) -> Tuple[str, Dict[str, Any]]:
+        """
+        Strip history/boilerplate from an email body and record the tokens saved.
+        Returns: (body, the call's log entry, for _call_llm to add provider usage to)
+        """
+        body, stats = prepare_body(email_body, operation)
+        return body, self._log_call(stats)
+    
+    def _build_prompt(self, template: str, operation: str, variable: str) -> str:
+        return build_prompt(template, operation, variable)
+    
+    def _record_usage(self, prompt_tokens: Optional[int], cached_tokens: Optional[int],
+                      log_entry: Optional[Dict[str, Any]] = None):
+        """
+        Record provider-reported prompt and cached-prefix token counts, on the
+        given call log entry too (a repair or hedged call adds to its entry).
+        """
+        self.metrics["provider_prompt_tokens"] += prompt_tokens or 0
+        self.metrics["cached_tokens"] += cached_tokens or 0
+        if log_entry is not None:
+            log_entry["cached_tokens"] = log_entry.get("cached_tokens", 0) + (cached_tokens or 0)
     
-    def _call_llm(self, prompt: str) -> str:
-        """Call the configured LLM with the given prompt."""
+    def _call_llm(self, prompt: str, operation: str = "chat", json_mode: bool = False,
+                  log_entry: Optional[Dict[str, Any]] = None) -> str:
+        """Call the configured LLM with the given prompt, using the operation's model tier."""
         try:
-            if self.provider == "openai":
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful email assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7
-                )
-                return response.choices[0].message.content.strip()
-            
-            elif self.provider == "gemini":
-                response = self.model.generate_content(prompt)
-                return response.text.strip()
-            
-            elif self.provider == "huggingface":
-                # Using text-generation for HF
-                response = self.client.text_generation(
-                    prompt,
-                    model=self.model,
-                    max_new_tokens=500,
-                    temperature=0.7,
-                    return_full_text=False
-                )
-                return response.strip()
-                
+            return self._complete(prompt, operation, json_mode, log_entry)
         except Exception as e:
             print(f"LLM Error ({self.provider}): {str(e)}")
             return f"Error calling LLM: {str(e)}"
     
-    def categorize_email(self, email_subject: str, email_body: str, prompt_template: str) -> str:
+    def _call_structured(self, prompt: str, operation: str, schema, log_entry: Optional[Dict[str, Any]] = None):
         """
-        Categorize an email using the provided prompt template.
-        Returns: Category name as determined by the LLM based on the prompt
+        Call the LLM in JSON mode and validate the reply against a schema,
+        with at most one repair call if it doesn't match.
+        Returns: (parsed model or None, raw reply text)
+        """
+        self.structured_stats["requests"] += 1
+        response = self._call_llm(prompt, operation, json_mode=True, log_entry=log_entry)
+        try:
+            result = parse_reply(response, schema)
+            self.structured_stats["valid_first_pass"] += 1
+            return result, response
+        except ValueError as e:
+            error = str(e)[:500]
+        if response.startswith("Error calling LLM"):
+            self.structured_stats["failed"] += 1
+            return None, response
+        repair_prompt = self._build_prompt(
+            "", "repair",
+            f"Schema: {schema_json(schema)}\n\nError: {error}\n\nPrevious reply:\n{response}"
+        )
+        repaired = self._call_llm(repair_prompt, "repair", json_mode=True, log_entry=log_entry)
+        try:
+            result = parse_reply(repaired, schema)
+            self.structured_stats["repaired"] += 1
+            return result, repaired
+        except ValueError:
+            self.structured_stats["failed"] += 1
+            return None, response
+    
+    def _complete(self, prompt: str, operation: str = "chat", json_mode: bool = False,
+                  log_entry: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Send one prompt to the provider. Raises on failure (see _call_llm).
+        json_mode asks the provider for a JSON object where it supports that;
+        provider usage is added to log_entry, the call's row in call_log.
         """
-        full_prompt = f"{prompt_template}\n\nEmail Subject: {email_subject}\nEmail Body: {email_body}\n\nCategory:"
-        response = self._call_llm(full_prompt)
+        settings = self.task_settings(operation)
+        model = settings["model"]
+        start = time.perf_counter()
+        if self.provider == "openai":
+            request = dict(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=settings["temperature"],
+                max_tokens=settings["max_tokens"],
+            )
+            if json_mode and model not in self.json_mode_unsupported:
+                request["response_format"] = {"type": "json_object"}
+            try:
+                response = self.client.chat.completions.create(**request)
+            except Exception as e:
+                if "response_format" not in request or "response_format" not in str(e):
+                    raise
+                # The model has no JSON mode; the output spec still asks for JSON, and replies are validated
+                self.json_mode_unsupported.add(model)
+                del request["response_format"]
+                response = self.client.chat.completions.create(**request)
+            text = response.choices[0].message.content.strip()
+            usage = getattr(response, "usage", None)
+            prompt_tokens = usage.prompt_tokens if usage is not None else estimate_tokens(prompt)
+            completion_tokens = usage.completion_tokens if usage is not None else estimate_tokens(text)
+            if usage is not None:
+                details = getattr(usage, "prompt_tokens_details", None)
+                self._record_usage(usage.prompt_tokens, getattr(details, "cached_tokens", 0), log_entry)
         
-        # Clean up response to get just the category name
-        # Remove quotes, extra whitespace, and take only the first line
-        category = response.strip().strip('"').strip("'").split('\n')[0].strip()
+        elif self.provider == "gemini":
+            if model not in self._gemini_models:
+                self._gemini_models[model] = self._genai.GenerativeModel(model, system_instruction=SYSTEM_PROMPT)
+            config = {"temperature": settings["temperature"], "max_output_tokens": settings["max_tokens"]}
+            if json_mode:
+                config["response_mime_type"] = "application/json"
+            response = self._gemini_models[model].generate_content(prompt, generation_config=config)
+            text = response.text.strip()
+            usage = getattr(response, "usage_metadata", None)
+            prompt_tokens = usage.prompt_token_count if usage is not None else estimate_tokens(prompt)
+            completion_tokens = usage.candidates_token_count if usage is not None else estimate_tokens(text)
+            if usage is not None:
+                self._record_usage(usage.prompt_token_count,
+                                   getattr(usage, "cached_content_token_count", 0), log_entry)
         
-        # Remove any common prefixes like "Category: " or "Answer: "
-        for prefix in ["Category:", "Answer:", "Response:"]:
-            if category.startswith(prefix):
-                category = category[len(prefix):].strip()
+        elif self.provider == "huggingface":
+            # Using text-generation for HF; the system instruction leads the prompt
+            full_prompt = f"{SYSTEM_PROMPT}\n\n{prompt}"
+            response = self.client.text_generation(
+                full_prompt,
+                model=model,
+                max_new_tokens=settings["max_tokens"],
+                # The Inference API rejects a temperature of exactly 0
+                temperature=max(settings["temperature"], 0.01),
+                return_full_text=False
+            )
+            text = response.strip()
+            prompt_tokens, completion_tokens = estimate_tokens(full_prompt), estimate_tokens(text)
         
-        # Return the category name, or "Uncategorized" if empty
-        return category if category else "Uncategorized"
+        else:
+            raise ValueError(f"Unsupported provider: {self.provider}")
+        
+        self._record_task(operation, model, time.perf_counter() - start, prompt_tokens, completion_tokens)
+        return text
+    
+    def categorize_email(self, email_subject: str, email_body: str, prompt_template: str) -> str:
+        """
+        Categorize an email using the provided prompt template.
+        Returns: Category name as determined by the LLM based on the prompt
+        """
+        email_body, log_entry = self._prepare_body(email_body, "categorize")
+        full_prompt = self._build_prompt(prompt_template, "categorize", email_variable(email_subject, email_body))
+        return parse_category(self._call_llm(full_prompt, "categorize", log_entry=log_entry))
     
     def extract_action_items(self, email_subject: str, email_body: str, prompt_template: str) -> list:
         """
         Extract action items from an email.
         Returns: List of action items
         """
-        full_prompt = f"{prompt_template}\n\nEmail Subject: {email_subject}\nEmail Body: {email_body}\n\nAction Items (JSON):"
-        response = self._call_llm(full_prompt)
-        
-        try:
-            # Clean response to find JSON content
-            response = response.strip()
-            if "```json" in response:
-                response = response.split("```json")[1].split("```")[0].strip()
-            elif "```" in response:
-                response = response.split("```")[1].split("```")[0].strip()
-                
-            # Try to parse as JSON
-            if response.startswith('['):
-                return json.loads(response)
-            else:
-                # Extract JSON from response if it's embedded in text
-                start_idx = response.find('[')
-                end_idx = response.rfind(']') + 1
-                if start_idx != -1 and end_idx != 0:
-                    return json.loads(response[start_idx:end_idx])
-                else:
-                    # Return as single item list if not JSON but has content
-                    return [line.strip("- *") for line in response.split('\n') if line.strip()] if response else []
-        except json.JSONDecodeError:
-            # If parsing fails, return as list of lines
-            return [line.strip("- *") for line in response.split('\n') if line.strip()]
+        email_body, log_entry = self._prepare_body(email_body, "extract")
+        full_prompt = self._build_prompt(prompt_template, "extract", email_variable(email_subject, email_body))
+        result, _ = self._call_structured(full_prompt, "extract", ActionItems, log_entry)
+        return clean_action_items(result)
     
     def generate_draft(self, email_subject: str, email_body: str, email_sender: str, 
                       prompt_template: str, user_instruction: Optional[str] = None) -> Dict[str, str]:
         """
         Generate a draft reply to an email.
         Returns: Dict with 'subject' and 'body'
+        Raises RuntimeError if the LLM couldn't be reached, so an error is never saved as a draft.
         """
+        email_body, log_entry = self._prepare_body(email_body, "draft")
         context = f"Original Email:\nFrom: {email_sender}\nSubject: {email_subject}\nBody: {email_body}"
-        
         if user_instruction:
-            full_prompt = f"{prompt_template}\n\n{context}\n\nUser Instructions: {user_instruction}\n\nPlease provide a subject line and body for the reply."
-        else:
-            full_prompt = f"{prompt_template}\n\n{context}\n\nPlease provide a subject line and body for the reply."
-        
-        response = self._call_llm(full_prompt)
-        
-        # Parse the response to extract subject and body
-        subject = f"Re: {email_subject}"
-        body = response
-        
-        # Try to extract subject if mentioned
-        lines = response.split('\n')
-        for i, line in enumerate(lines):
-            if 'subject:' in line.lower():
-                subject = line.split(':', 1)[1].strip()
-                body = '\n'.join(lines[i+1:]).strip()
-                break
+            context += f"\n\nUser Instructions: {user_instruction}"
+        full_prompt = self._build_prompt(prompt_template, "draft", context)
         
+        result, response = self._call_structured(full_prompt, "draft", DraftReply, log_entry)
+        if result is None and response.startswith("Error calling LLM"):
+            raise RuntimeError(response)
+        if result is None:
+            # Keep the raw reply so nothing is lost; the user can still edit it in Review Drafts
+            return {"subject": f"Re: {email_subject}", "body": response}
         return {
-            "subject": subject,
-            "body": body
+            "subject": result.subject.strip() or f"Re: {email_subject}",
+            "body": result.body.strip()
         }
     
+    def _email_info(self, email_context: Dict[str, Any], operation: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Format the email context block used by chat prompts, always in the same shape.
+        Returns: (context block, the call's log entry or None if there was no body)
+        """
+        body, log_entry = email_context.get('body', ''), None
+        if body:
+            body, log_entry = self._prepare_body(body, operation)
+        else:
+            body = 'No content'
+        action_items = email_context.get('action_items', '[]')
+        if not isinstance(action_items, str):
+            action_items = json.dumps(action_items)
+        return (
+            "Email Context:\n"
+            f"From: {email_context.get('sender', 'Unknown')}\n"
+            f"Subject: {email_context.get('subject', 'No Subject')}\n"
+            f"Category: {email_context.get('category', 'Uncategorized')}\n"
+            f"Action Items: {action_items}\n"
+            f"Body: {body}"
+        ), log_entry
+    
+    def _with_history(self, history: str, variable: str, log_entry: Optional[Dict[str, Any]] = None) -> str:
+        """Prepend the conversation history to the per-request content and log its size on the call's entry."""
+        if not history:
+            return variable
+        if log_entry is not None:
+            log_entry["history_tokens"] = estimate_tokens(history)
+        return f"{history}\n\n{variable}"
+    
+    def summarize_turns(self, summary: str, turns: List[Tuple[str, str]]) -> str:
+        """Fold older chat turns into the running conversation summary (used by ChatMemory)."""
+        new_turns = "\n".join(f"{'User' if role == 'user' else 'Agent'}: {content}" for role, content in turns)
+        prompt = self._build_prompt("", "memory", f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{new_turns}")
+        response = self._call_llm(prompt, "memory")
+        # An empty result makes ChatMemory fall back to its local summary
+        return "" if response.startswith("Error calling LLM") else response
+    
     def chat_with_agent(self, query: str, email_context: Dict[str, Any], 
-                       prompts: Dict[str, str]) -> Dict[str, Any]:
+                       prompts: Dict[str, str], history: str = "") -> Dict[str, Any]:
         """
         Handle conversational queries about an email.
+        `history` is the bounded conversation so far (see ChatMemory.render).
         Returns: Dict with 'response', 'action', and optional 'data'
         """
-        email_info = f"""
-Email Context:
-From: {email_context.get('sender', 'Unknown')}
-Subject: {email_context.get('subject', 'No Subject')}
-Body: {email_context.get('body', 'No content')}
-Category: {email_context.get('category', 'Uncategorized')}
-Action Items: {email_context.get('action_items', '[]')}
-"""
-        
         query_lower = query.lower()
         
         # Handle summarization
         if "summarize" in query_lower or "summary" in query_lower:
-            prompt = f"Please provide a concise summary of the following email:\n{email_info}"
-            response = self._call_llm(prompt)
+            email_info, log_entry = self._email_info(email_context, "summarize")
+            prompt = self._build_prompt("", "summarize", email_info)
+            response = self._call_llm(prompt, "summarize", log_entry=log_entry)
             return {
                 "response": response,
                 "action": "none"
@@ -175,13 +455,19 @@ Action Items: {email_context.get('action_items', '[]')}
         
         # Handle draft generation
         if "draft" in query_lower or "reply" in query_lower:
-            draft_data = self.generate_draft(
-                email_context.get('subject', ''),
-                email_context.get('body', ''),
-                email_context.get('sender', ''),
-                prompts.get('Auto-Reply', 'Draft a professional reply.'),
-                user_instruction=query
-            )
+            try:
+                draft_data = self.generate_draft(
+                    email_context.get('subject', ''),
+                    email_context.get('body', ''),
+                    email_context.get('sender', ''),
+                    prompts.get('Auto-Reply', 'Draft a professional reply.'),
+                    user_instruction=query
+                )
+            except RuntimeError as e:
+                return {
+                    "response": f"I couldn't generate a draft. {e}",
+                    "action": "none"
+                }
             return {
                 "response": "I've generated a draft reply for you.",
                 "action": "draft_generated",
@@ -209,13 +495,30 @@ Action Items: {email_context.get('action_items', '[]')}
             }
         
         # General query
-        prompt = f"{email_info}\n\nUser Question: {query}\n\nPlease answer based on the email context."
-        response = self._call_llm(prompt)
+        email_info, log_entry = self._email_info(email_context, "chat")
+        variable = self._with_history(history, f"{email_info}\n\nUser Question: {query}", log_entry)
+        prompt = self._build_prompt("", "chat", variable)
+        response = self._call_llm(prompt, "chat", log_entry=log_entry)
         
         return {
             "response": response,
             "action": "none"
         }
+    
+    def chat_with_mailbox(self, query: str, emails: List[Dict[str, Any]], history: str = "") -> Dict[str, Any]:
+        """
+        Answer a question about the whole mailbox from retrieved emails.
+        `emails` are the best matches first (see pack_emails for the fields);
+        only as many as fit the mailbox token budget are sent.
+        Returns: Dict with 'response', 'action' and 'sources' (email ids in the prompt)
+        """
+        context, used_ids, stats = pack_emails(emails)
+        log_entry = self._log_call(stats)
+        if not used_ids:
+            return {"response": "I couldn't find any emails related to that question.", "action": "none", "sources": []}
+        variable = self._with_history(history, f"Emails:\n{context}\n\nUser Question: {query}", log_entry)
+        prompt = self._build_prompt("", "mailbox", variable)
+        return {"response": self._call_llm(prompt, "mailbox", log_entry=log_entry), "action": "none", "sources": used_ids}
 
 
 # Mock LLM Service for testing without API keys
@@ -279,7 +582,7 @@ class MockLLMService:
         }
     
     def chat_with_agent(self, query: str, email_context: Dict[str, Any], 
-                       prompts: Dict[str, str]) -> Dict[str, Any]:
+                       prompts: Dict[str, str], history: str = "") -> Dict[str, Any]:
         """Mock chat agent."""
         query_lower = query.lower()
         
@@ -324,6 +627,18 @@ class MockLLMService:
             "response": "I can help you summarize this email, draft a reply, or extract tasks. What would you like?",
             "action": "none"
         }
+    
+    def chat_with_mailbox(self, query: str, emails: List[Dict[str, Any]], history: str = "") -> Dict[str, Any]:
+        """Mock mailbox chat: lists the retrieved emails that fit the budget."""
+        _, used_ids, _ = pack_emails(emails)
+        if not used_ids:
+            return {"response": "I couldn't find any emails related to that question.", "action": "none", "sources": []}
+        lines = [f"- {email['subject']} [#{email['id']}]" for email in emails if email['id'] in used_ids]
+        return {
+            "response": "These emails look relevant to your question:\n" + "\n".join(lines),
+            "action": "none",
+            "sources": used_ids
+        }
 
 
 def get_llm_service(use_mock: bool = False) -> Any:
@@ -0,0 +1,562 @@
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+import storage
+from dedup import NearDuplicateIndex
+from email_threads import build_threads, thread_content
+from records import EmailRecord
+from state_snapshot import StateSnapshot
+from task_extraction import LOCAL_TASK_CONFIDENCE, TaskIndex, extract_tasks
+from vector_index import VectorIndex
+
+# How many per-email changes are remembered for delta syncs. Sessions that fall
+# further behind than this reload the full snapshot instead.
+CHANGE_LOG_SIZE = 10000
+DEDUP_INDEX_FILE = os.path.join(storage.EMAIL_DIR, "dedup_index.json")
+TASK_INDEX_FILE = os.path.join(storage.EMAIL_DIR, "task_index.json")
+# Fields shown in the inbox; changing one bumps the record's rev
+RENDERED_FIELDS = ('category', 'action_items', 'is_read', 'tasks')
+# Fields that go into summary and draft prompts; changing one bumps labels_version
+LABEL_FIELDS = ('category', 'action_items')
+# Month partitions loaded at startup; older months are paged in on demand
+STARTUP_MONTHS = int(os.getenv("STARTUP_MONTHS", "3"))
+
+
+def _content(record: EmailRecord) -> Dict[str, Any]:
+    """A record's stored fields, less the render rev."""
+    data = record.to_dict()
+    data.pop('rev', None)
+    return data
+
+
+class MailStore:
+    """
+    Process-wide store for emails, prompts and drafts, shared by every
+    Streamlit session (see get_store() in app.py).
+
+    Records handed out are treated as immutable: updates replace a record
+    with a modified copy and bump the version counter, so a session can keep
+    reading the snapshot it has and only fetch the changed records when the
+    version moves on. All writes go through the store, under one lock, so
+    concurrent sessions no longer overwrite each other's saves.
+
+    Emails are stored in month partitions. Only the newest STARTUP_MONTHS
+    are loaded at startup; older ones are paged in with load_partitions() /
+    load_older(). A partition is always loaded whole, so saves can rewrite
+    just the partitions they touch.
+
+    Loads come from the binary state snapshot (state_snapshot.py) where it
+    is current; every partition write is journaled for it, and it is
+    rewritten in the background once the journal grows or a load had to
+    fall back to the header files.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._records: List[EmailRecord] = []
+        self._index: Dict[Any, int] = {}
+        self._snapshot: Optional[Tuple[EmailRecord, ...]] = None
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)  # (version, email_id)
+        self._base_version = 0  # Deltas can't be computed from versions before this
+        self.version = 0
+        self.prompts: Dict[str, Dict[str, str]] = {}
+        self.prompts_version = 0
+        self.drafts: List[Dict[str, Any]] = []
+        self.drafts_version = 0
+        # Threads only change when emails are added or reloaded, not on label updates
+        self._structure_version = 0
+        # Moves when an email's category or action items change (both feed summaries and drafts)
+        self.labels_version = 0
+        self._threads = None  # (structure_version, {thread_id: members}, {email_id: thread_id})
+        self.duplicates = NearDuplicateIndex()
+        self.vectors = None
+        # Loaded ids that may be missing from the search index; None until the first full scan
+        self._unindexed: Optional[set] = None
+        self.tasks = TaskIndex()
+        self.loaded_months = set()
+        self.state_snapshot = StateSnapshot()
+        self._snapshot_writer: Optional[threading.Thread] = None
+        self._import_lock = threading.Lock()
+        # Header file stat of each loaded month as of this store's last read or write of it
+        self._partition_stats: Dict[str, Optional[list]] = {}
+
+    def load(self, months: Optional[int] = STARTUP_MONTHS):
+        """Load from storage, replacing the current contents: the newest `months` partitions, or all if None."""
+        with self._lock:
+            available = storage.list_partitions()
+            self.loaded_months = set(available if months is None else available[:months])
+            self._partition_stats = {month: storage.partition_stat(month) for month in self.loaded_months}
+            self.state_snapshot.open()
+            records, stale = self.state_snapshot.load_months(sorted(self.loaded_months, reverse=True))
+            self._set_records(records)
+            self.duplicates = (self.state_snapshot.load_duplicates(DEDUP_INDEX_FILE)
+                               or NearDuplicateIndex.load(DEDUP_INDEX_FILE))
+            self.vectors = VectorIndex(storage.EMAIL_DIR)
+            self._unindexed = None
+            self.tasks = TaskIndex.load(TASK_INDEX_FILE)
+            self.prompts = storage.load_prompts()
+            self.prompts_version += 1
+            self.drafts = storage.load_drafts()
+            self.drafts_version += 1
+            if available and (stale or self.state_snapshot.due):
+                self.schedule_snapshot()
+
+    def _set_records(self, records):
+        self._records = list(records)
+        self._index = {record.id: i for i, record in enumerate(self._records)}
+        if self._unindexed is not None:
+            self._unindexed &= self._index.keys()
+        self._snapshot = None
+        self._changes.clear()
+        self.version += 1
+        self._base_version = self.version
+        self._structure_version += 1
+
+    def _log_change(self, email_id):
+        if len(self._changes) == self._changes.maxlen:
+            # The oldest entry is about to drop off; sessions older than it must resync fully
+            self._base_version = max(self._base_version, self._changes[0][0])
+        self._changes.append((self.version, email_id))
+
+    # Partitions
+
+    def partitions(self) -> List[Dict[str, Any]]:
+        """Every month partition, newest first, with its size and whether it is loaded or archived."""
+        manifest = storage.load_manifest()
+        return [{
+            "month": month,
+            "emails": entry["emails"],
+            "loaded": month in self.loaded_months,
+            "archived": entry.get("archived", False),
+        } for month, entry in sorted(manifest.items(), reverse=True)]
+
+    def unloaded_months(self) -> List[str]:
+        """Active partitions not in memory yet, newest first."""
+        return [month for month in storage.list_partitions() if month not in self.loaded_months]
+
+    def load_partitions(self, months) -> int:
+        """Page in the given month partitions (skipping loaded ones). Returns the number of emails added."""
+        with self._lock:
+            months = [month for month in months if month not in self.loaded_months]
+            if not months:
+                return 0
+            self._partition_stats.update((month, storage.partition_stat(month)) for month in months)
+            records, stale = self.state_snapshot.load_months(months)
+            if stale:
+                self.schedule_snapshot()
+            self.loaded_months.update(months)
+            self.version += 1
+            for record in records:
+                self._index[record.id] = len(self._records)
+                self._records.append(record)
+                self._log_change(record.id)
+            if self._unindexed is not None:
+                self._unindexed.update(record.id for record in records)
+            self._snapshot = None
+            self._structure_version += 1
+            return len(records)
+
+    def load_older(self) -> int:
+        """Page in the newest partition that isn't loaded yet."""
+        return self.load_partitions(self.unloaded_months()[:1])
+
+    def load_all(self) -> int:
+        return self.load_partitions(self.unloaded_months())
+
+    def archive_partition(self, month: str):
+        """Move a month to the archive and drop it from memory."""
+        with self._lock:
+            storage.archive_partition(month)
+            self._partition_stats.pop(month, None)
+            if month in self.loaded_months:
+                self.loaded_months.discard(month)
+                self._set_records(record for record in self._records if storage.partition_key(record) != month)
+
+    def restore_partition(self, month: str):
+        """Bring an archived month back into the active store and page it in."""
+        with self._lock:
+            storage.restore_partition(month)
+            self.load_partitions([month])
+
+    def refresh_partitions(self, months=None) -> int:
+        """
+        Reload loaded months whose header files another process (e.g. a
+        batch_jobs.py merge) has written since this store last read or wrote
+        them, so their changes show up here and aren't overwritten by the next
+        save from memory. Only stats the files when nothing changed. Returns
+        the number of emails that changed.
+        """
+        with self._lock:
+            months = self.loaded_months if months is None else set(months) & self.loaded_months
+            stats = {month: storage.partition_stat(month) for month in months}
+            changed_months = [month for month, stat in stats.items() if stat != self._partition_stats.get(month)]
+            if not changed_months:
+                return 0
+            records = storage.load_emails(changed_months)
+            self._partition_stats.update((month, stats[month]) for month in changed_months)
+            self.version += 1
+            changed = 0
+            for record in records:
+                position = self._index.get(record.id)
+                if position is None:
+                    self._index[record.id] = len(self._records)
+                    self._records.append(record)
+                    self._structure_version += 1
+                    if self._unindexed is not None:
+                        self._unindexed.add(record.id)
+                else:
+                    previous = self._records[position]
+                    if _content(previous) == _content(record):
+                        continue
+                    # The other process counted revs from its own copy; never reuse one this store has shown
+                    record.rev = max(record.rev, previous.rev) + 1
+                    if any(previous.get(field) != record.get(field) for field in LABEL_FIELDS):
+                        self.labels_version += 1
+                    self._records[position] = record
+                    if record.get('tasks') != previous.get('tasks'):
+                        self.tasks.set(record.id, record.get('tasks') or [])
+                self._log_change(record.id)
+                changed += 1
+            self._snapshot = None
+            return changed
+
+    def _save_partitions(self, records):
+        """Rewrite the partitions the given records belong to (each passed whole from memory)."""
+        months = {storage.partition_key(record) for record in records}
+        consistent = self.state_snapshot.consistent(months)
+        storage.save_emails([record for record in self._records if storage.partition_key(record) in months])
+        self._partition_stats.update((month, storage.partition_stat(month)) for month in months
+                                     if month in self.loaded_months)
+        self._journal(records, consistent)
+
+    # State snapshot
+
+    def _journal(self, records, consistent):
+        self.state_snapshot.log(records, consistent)
+        if self.state_snapshot.due:
+            self.schedule_snapshot()
+
+    def write_snapshot(self):
+        """
+        Write every active partition and the duplicate index to the state
+        snapshot. Months that aren't paged in are read from their header
+        files without the lock; only capturing the in-memory records holds
+        it, so encoding and writing the file don't block other sessions.
+        """
+        on_disk = {}
+        for month in self.unloaded_months():
+            stat = storage.partition_stat(month)
+            records = storage.load_emails([month])
+            if stat is not None and storage.partition_stat(month) == stat:
+                on_disk[month] = (stat, records)
+        with self._lock:
+            records = list(self._records)
+            # A month written to (or paged in) since it was read is left out; loads read it from its header file
+            for month, (stat, month_records) in on_disk.items():
+                if month not in self.loaded_months and storage.partition_stat(month) == stat:
+                    records.extend(month_records)
+            job = self.state_snapshot.prepare(records, self.duplicates, DEDUP_INDEX_FILE)
+        if self.state_snapshot.write(job):
+            with self._lock:
+                self.state_snapshot.install(job)
+
+    def schedule_snapshot(self):
+        """Rewrite the snapshot in a background thread (unless a rewrite is already running)."""
+        if self._snapshot_writer is not None and self._snapshot_writer.is_alive():
+            return
+        self._snapshot_writer = threading.Thread(target=self.write_snapshot, daemon=True)
+        self._snapshot_writer.start()
+
+    # Emails
+
+    @property
+    def structure_version(self) -> int:
+        """Moves when emails are added, removed or paged in/out; label updates leave it alone."""
+        return self._structure_version
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, email_id) -> Optional[EmailRecord]:
+        position = self._index.get(email_id)
+        return self._records[position] if position is not None else None
+
+    def snapshot(self) -> Tuple[int, Tuple[EmailRecord, ...]]:
+        """Return (version, records). The tuple is shared by all sessions at that version."""
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = tuple(self._records)
+            return self.version, self._snapshot
+
+    def changes_since(self, version: int):
+        """
+        Return (version, [(position, record), ...]) for emails changed or added
+        after the given version, or None if the caller needs a full snapshot.
+        Emails are only ever replaced in place or appended (clear() resets the
+        base version), so positions stay valid for a session's existing list.
+        """
+        with self._lock:
+            if version < self._base_version:
+                return None
+            changed = {}
+            for change_version, email_id in self._changes:
+                if change_version > version:
+                    position = self._index[email_id]
+                    changed[position] = self._records[position]
+            return self.version, sorted(changed.items())
+
+    def threads(self) -> Dict[Any, List[EmailRecord]]:
+        """Conversations as {thread_id: [emails oldest first]}, rebuilt only when emails are added."""
+        with self._lock:
+            if self._threads is None or self._threads[0] != self._structure_version:
+                threads = build_threads(self._records)
+                by_email = {email.id: thread_id for thread_id, members in threads.items() for email in members}
+                self._threads = (self._structure_version, threads, by_email)
+            return self._threads[1]
+
+    def thread_ids(self) -> Dict[Any, Any]:
+        """{email_id: thread_id} for every email."""
+        with self._lock:
+            self.threads()
+            return self._threads[2]
+
+    def thread_for(self, email_id) -> List[EmailRecord]:
+        """Current records of every email in the same conversation as email_id."""
+        with self._lock:
+            self.threads()
+            thread_id = self._threads[2].get(email_id)
+            if thread_id is None:
+                return []
+            return [self.get(email.id) for email in self._threads[1][thread_id]]
+
+    def thread_text(self, email) -> str:
+        """Body text for the LLM: the deduplicated conversation if the email is part of a thread."""
+        members = self.thread_for(email['id'])
+        if len(members) > 1:
+            return thread_content(members, storage.get_body)
+        return storage.get_body(email)
+
+    def _scan_tasks(self, record, body: str):
+        """Index an email's locally extracted tasks; confident results also become its action items."""
+        tasks, confidence = extract_tasks(body, record['timestamp'])
+        if confidence < LOCAL_TASK_CONFIDENCE:
+            tasks = []  # Indexed as scanned, with nothing trustworthy found
+        elif not record.action_items:
+            record['action_items'] = [task['text'] for task in tasks]
+            record['tasks'] = tasks
+        self.tasks.set(record.id, tasks)
+
+    def ensure_task_index(self):
+        """Scan emails the task index hasn't seen (stores created before it existed). Runs once per email."""
+        with self._lock:
+            missing = [record for record in self._records if record.id not in self.tasks]
+            for record in missing:
+                tasks, confidence = extract_tasks(storage.get_body(record), record['timestamp'])
+                self.tasks.set(record.id, tasks if confidence >= LOCAL_TASK_CONFIDENCE else [])
+            if missing:
+                self.tasks.save(TASK_INDEX_FILE)
+
+    def update_email(self, email_id, **fields) -> Optional[EmailRecord]:
+        """Replace one email with a copy that has the given fields changed, then save."""
+        return self.update_emails({email_id: fields}).get(email_id)
+
+    def update_emails(self, updates: Dict[Any, Dict[str, Any]], save: bool = True) -> Dict[Any, EmailRecord]:
+        """Apply {email_id: {field: value}} updates as one version bump and one save."""
+        with self._lock:
+            # Changes another process saved to these months are picked up first, then updated on top of
+            self.refresh_partitions({storage.partition_key(self.get(email_id)) for email_id in updates
+                                     if email_id in self._index})
+            updated = {}
+            self.version += 1
+            for email_id, fields in updates.items():
+                position = self._index.get(email_id)
+                if position is None:
+                    continue
+                previous = self._records[position]
+                record = previous.replace(**fields)
+                if any(previous.get(field) != record.get(field) for field in fields if field in RENDERED_FIELDS):
+                    record.rev += 1
+                if any(previous.get(field) != record.get(field) for field in fields if field in LABEL_FIELDS):
+                    self.labels_version += 1
+                self._records[position] = record
+                if 'tasks' in fields:
+                    self.tasks.set(email_id, fields['tasks'])
+                self._log_change(email_id)
+                updated[email_id] = record
+            self._snapshot = None
+            if save:
+                self._save_partitions(updated.values())
+            if any('tasks' in fields for fields in updates.values()):
+                self.tasks.save(TASK_INDEX_FILE)
+            return updated
+
+    def add_emails(self, emails):
+        """Add new emails (dicts or EmailRecords) and persist them."""
+        with self._lock:
+            records = [email if isinstance(email, EmailRecord) else EmailRecord.from_dict(email)
+                       for email in emails]
+            # Cluster near-duplicates while the bodies are still in memory
+            for record in records:
+                body = storage.get_body(record)
+                record['dup_of'] = self.duplicates.add(record.id, body)
+                self._scan_tasks(record, body)
+            if self.vectors is not None:
+                self.vectors.add((record.id, f"{record.subject}\n{storage.get_body(record)}") for record in records)
+            existing = storage.load_manifest()
+            touched = {storage.partition_key(record) for record in records}
+            self.refresh_partitions(touched)
+            consistent = self.state_snapshot.consistent(touched)
+            storage.append_emails(records)
+            self._journal(records, consistent)
+            self.duplicates.save(DEDUP_INDEX_FILE)
+            self.tasks.save(TASK_INDEX_FILE)
+            # Mail for an older month that isn't paged in stays on disk until that month is loaded
+            months = {record.id: storage.partition_key(record) for record in records}
+            self.loaded_months.update(month for month in months.values() if month not in existing)
+            self._partition_stats.update((month, storage.partition_stat(month)) for month in touched
+                                         if month in self.loaded_months)
+            records = [record for record in records if months[record.id] in self.loaded_months]
+            if self.vectors is None and self._unindexed is not None:
+                self._unindexed.update(record.id for record in records)
+            self.version += 1
+            for record in records:
+                self._index[record.id] = len(self._records)
+                self._records.append(record)
+                self._log_change(record.id)
+            self._snapshot = None
+            self._structure_version += 1
+            return records
+
+    def next_id(self):
+        with self._lock:
+            stored = max((entry["max_id"] for entry in storage.load_manifest().values()), default=0)
+            return max(max(self._index, default=0), stored) + 1
+
+    def import_mailbox(self, importer, path, **kwargs):
+        """
+        Run an ingestion importer (ingestion.import_mbox / import_maildir)
+        against this store. Reading and parsing run without the store lock;
+        each batch takes its id range and is added under the lock, so ids
+        stay unique while other sessions keep working. Imports run one at a
+        time, as they share the import state.
+        """
+        def add_batch(emails):
+            with self._lock:
+                first = self.next_id()
+                for offset, email in enumerate(emails):
+                    email['id'] = first + offset
+                return self.add_emails(emails)
+
+        with self._import_lock:
+            return importer(path, add_batch, self.next_id(), **kwargs)
+
+    def ensure_vector_index(self):
+        """
+        Embed any emails missing from the search index (e.g. stores created
+        before it existed). Every loaded email is checked once; after that
+        only the ones paged in or reloaded since, so a query doesn't scan
+        the whole store under the lock.
+        """
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = VectorIndex(storage.EMAIL_DIR)
+                self._unindexed = None
+            ids = self._index.keys() if self._unindexed is None else self._unindexed
+            missing = [self._records[self._index[email_id]] for email_id in ids
+                       if email_id in self._index and email_id not in self.vectors]
+            for start in range(0, len(missing), storage.CHUNK_SIZE):
+                chunk = missing[start:start + storage.CHUNK_SIZE]
+                self.vectors.add((record.id, f"{record.subject}\n{storage.get_body(record)}") for record in chunk)
+            self._unindexed = set()
+
+    def semantic_search(self, query: str, k: int = 50) -> List[EmailRecord]:
+        """Emails most similar to the query, best first."""
+        self.ensure_vector_index()
+        results = [self.get(email_id) for email_id, _ in self.vectors.search(query, k)]
+        return [record for record in results if record is not None]
+
+    def rebuild_duplicates(self, threshold: float):
+        """Re-cluster every email at a new similarity threshold (reads all bodies)."""
+        with self._lock:
+            index = NearDuplicateIndex(threshold)
+            updates = {record.id: {'dup_of': index.add(record.id, storage.get_body(record))}
+                       for record in sorted(self._records, key=lambda r: r.ts)}
+            self.duplicates = index
+            index.save(DEDUP_INDEX_FILE)
+            self.update_emails(updates)
+            return index.stats()
+
+    def recompress_bodies(self):
+        """
+        Rewrite the body stores of every active partition under the current
+        BODY_COMPRESSION setting (e.g. after switching it on for an existing
+        mailbox). Every record gets a new offset, so sessions reload the full
+        snapshot afterwards. Returns (bytes before, bytes after).
+        """
+        with self._lock:
+            self.refresh_partitions()
+            records = [record.replace() for record in self._records]
+            before, after = storage.recompress_bodies(records)
+            storage.save_emails(records)
+            self._partition_stats = {month: storage.partition_stat(month) for month in self.loaded_months}
+            self._set_records(records)
+            # Partitions that aren't paged in are rewritten one at a time from disk
+            for month in self.unloaded_months():
+                month_records = storage.load_emails([month])
+                month_before, month_after = storage.recompress_bodies(month_records)
+                storage.save_emails(month_records)
+                before, after = before + month_before, after + month_after
+            self.schedule_snapshot()
+            return before, after
+
+    def clear(self):
+        """Delete all emails and drafts."""
+        with self._lock:
+            self.duplicates = NearDuplicateIndex(self.duplicates.threshold)
+            self.duplicates.save(DEDUP_INDEX_FILE)
+            if self.vectors is not None:
+                self.vectors.clear()
+            self.tasks = TaskIndex()
+            self.tasks.save(TASK_INDEX_FILE)
+            storage.delete_all_emails()
+            self.state_snapshot.clear()
+            storage.save_drafts([])
+            self.loaded_months = set()
+            self._partition_stats = {}
+            self._set_records([])
+            self.drafts = []
+            self.drafts_version += 1
+
+    # Prompts
+
+    def save_prompt(self, name: str, template: str):
+        with self._lock:
+            prompts = {key: dict(value) for key, value in self.prompts.items()}
+            prompts[name]['template'] = template
+            storage.save_prompts(prompts)
+            self.prompts = prompts
+            self.prompts_version += 1
+
+    # Drafts
+
+    def add_draft(self, email_id, subject: str, body: str) -> Dict[str, Any]:
+        with self._lock:
+            draft = storage.add_draft(email_id, subject, body)
+            self.drafts = storage.load_drafts()
+            self.drafts_version += 1
+            return draft
+
+    def update_draft(self, draft_id, subject: str, body: str):
+        with self._lock:
+            self.drafts = [dict(d, subject=subject, body=body) if d['id'] == draft_id else d
+                           for d in self.drafts]
+            storage.save_drafts(self.drafts)
+            self.drafts_version += 1
+
+    def delete_draft(self, draft_id):
+        with self._lock:
+            self.drafts = [d for d in self.drafts if d['id'] != draft_id]
+            storage.save_drafts(self.drafts)
+            self.drafts_version += 1
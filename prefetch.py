@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+import storage
+
+PREFETCH_CACHE_FILE = os.path.join(storage.EMAIL_DIR, "prefetch_cache.json")
+# Budget per background run: how far down the inbox (newest first) to look, and how many LLM calls to spend
+PREFETCH_MAX_EMAILS = int(os.getenv("PREFETCH_MAX_EMAILS", "50"))
+PREFETCH_MAX_CALLS = int(os.getenv("PREFETCH_MAX_CALLS", "20"))
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+
+# The queries behind the "Summarize" and "Draft Reply" buttons in the email detail view
+SUMMARY_QUERY = "Summarize this email"
+DRAFT_QUERY = "Draft a professional reply to this email"
+DRAFT_CATEGORIES = ("Important", "To-Do")
+
+
+def email_context(email, body: str) -> Dict[str, Any]:
+    """The email_context dict chat_with_agent expects."""
+    return {
+        'sender': email['sender'],
+        'subject': email['subject'],
+        'body': body,
+        'category': email['category'],
+        'action_items': json.dumps(list(email.get('action_items', [])))
+    }
+
+
+def service_id(service) -> str:
+    """Identifies the provider/model behind a service, so output from one isn't served for another."""
+    return f"{type(service).__name__}:{getattr(service, 'provider', '')}:{getattr(service, 'model', '')}"
+
+
+class Prefetcher:
+    """
+    Generates summaries (and drafts for Important / To-Do mail) in a
+    background thread, newest conversations first, so the detail-view
+    buttons can answer instantly.
+
+    Each cached result carries a validity key derived from the provider,
+    the query, the prompt template it used, the ids of the messages in the
+    conversation and the email's category and action items (both are part
+    of the prompt). Editing a prompt, switching provider, re-categorizing or
+    a new reply arriving makes the entry stale, and it is regenerated on the
+    next run. A run starts when emails are added or removed or a category or
+    action items change (e.g. after Categorize All checkpoints), not when
+    mail is only marked read. Background calls pause while a foreground
+    request is running.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.enabled = PREFETCH_ENABLED
+        self._lock = threading.Lock()
+        self._cache: Dict[str, Dict[str, Any]] = self._load()
+        self._thread: Optional[threading.Thread] = None
+        self._last_run = None
+        self._foreground = 0
+        self._idle = threading.Event()
+        self._idle.set()
+        self.stats = {"hits": 0, "misses": 0, "generated": 0, "runs": 0}
+
+    def _load(self):
+        if not os.path.exists(PREFETCH_CACHE_FILE):
+            return {}
+        try:
+            with open(PREFETCH_CACHE_FILE, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading prefetch cache: {e}")
+            return {}
+
+    def _save(self):
+        os.makedirs(storage.EMAIL_DIR, exist_ok=True)
+        tmp_file = PREFETCH_CACHE_FILE + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self._cache, f)
+        os.replace(tmp_file, PREFETCH_CACHE_FILE)
+
+    def _validity_key(self, service, email, query: str, prompts: Dict[str, str]) -> str:
+        template = prompts.get('Auto-Reply', '') if query == DRAFT_QUERY else ''
+        members = [member['id'] for member in self.store.thread_for(email['id'])] or [email['id']]
+        raw = json.dumps([service_id(service), query, template, members,
+                          email['category'], list(email.get('action_items') or [])])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def lookup(self, service, email, query: str, prompts: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """Cached chat_with_agent result for this query, if it is still valid."""
+        entry = self._cache.get(f"{query}:{email['id']}")
+        if entry and entry['key'] == self._validity_key(service, email, query, prompts):
+            return entry['result']
+        return None
+
+    def get(self, service, email, query: str, prompts: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """lookup() for a user request, counted in the hit/miss stats."""
+        result = self.lookup(service, email, query, prompts)
+        self.stats["hits" if result is not None else "misses"] += 1
+        return result
+
+    def put(self, service, email, query: str, prompts: Dict[str, str], result: Dict[str, Any]):
+        if "Error calling LLM" in json.dumps(result):
+            return
+        with self._lock:
+            self._cache[f"{query}:{email['id']}"] = {
+                "key": self._validity_key(service, email, query, prompts),
+                "result": result,
+                "created": int(time.time()),
+            }
+            self._save()
+
+    def cached_summary(self, service, email, prompts: Dict[str, str]) -> Optional[str]:
+        result = self.lookup(service, email, SUMMARY_QUERY, prompts)
+        return result['response'] if result else None
+
+    @contextmanager
+    def foreground(self):
+        """Hold background generation while an interactive request runs."""
+        with self._lock:
+            self._foreground += 1
+            self._idle.clear()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._foreground -= 1
+                if not self._foreground:
+                    self._idle.set()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, service, prompts: Dict[str, str]):
+        """Start a background run unless one is in progress or nothing has changed since the last."""
+        run_key = (self.store.structure_version, self.store.labels_version,
+                   json.dumps(prompts, sort_keys=True), service_id(service))
+        if self.running or run_key == self._last_run:
+            return
+        self._last_run = run_key
+        self._thread = threading.Thread(target=self._run, args=(service, dict(prompts)), daemon=True)
+        self._thread.start()
+
+    def _candidates(self):
+        """Newest message of each conversation, newest conversations first, within the budget."""
+        thread_ids = self.store.thread_ids()
+        seen = set()
+        _, records = self.store.snapshot()
+        for email in sorted(records, key=lambda e: e.ts, reverse=True):
+            thread_id = thread_ids.get(email.id, email.id)
+            if thread_id in seen:
+                continue
+            seen.add(thread_id)
+            yield email
+            if len(seen) >= PREFETCH_MAX_EMAILS:
+                return
+
+    def _run(self, service, prompts: Dict[str, str]):
+        self.stats["runs"] += 1
+        calls = 0
+        for email in self._candidates():
+            queries = [SUMMARY_QUERY]
+            if email['category'] in DRAFT_CATEGORIES:
+                queries.append(DRAFT_QUERY)
+            for query in queries:
+                if calls >= PREFETCH_MAX_CALLS:
+                    return
+                if self.lookup(service, email, query, prompts) is not None:
+                    continue
+                self._idle.wait()
+                try:
+                    context = email_context(email, self.store.thread_text(email))
+                    result = service.chat_with_agent(query, context, prompts)
+                except Exception as e:
+                    print(f"Error prefetching {query!r} for email {email['id']}: {e}")
+                    continue
+                calls += 1
+                self.put(service, email, query, prompts, result)
+                self.stats["generated"] += 1
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        with self._lock:
+            self._cache = {}
+            self._last_run = None
+            self._save()
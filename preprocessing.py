@@ -0,0 +1,175 @@
+import re
+from typing import Dict, Any, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Approximate prompt-token budget for the email body, per LLM operation.
+# Categorization only needs the gist; drafts and summaries need more context.
+TOKEN_BUDGETS = {
+    "categorize": 400,
+    "extract": 1200,
+    "summarize": 1500,
+    "draft": 1500,
+    "chat": 2000,
+    # Whole-mailbox chat: shared by all retrieved emails, so the prompt stays the
+    # same size however large the mailbox gets
+    "mailbox": 3000,
+}
+
+# Cap per retrieved email in mailbox chat, so one long email can't crowd out the rest
+MAILBOX_EMAIL_TOKENS = 400
+
+# Lines that start a quoted/forwarded history block. Everything after them is dropped.
+HISTORY_MARKERS = [
+    re.compile(r"^-{2,}\s*(forwarded message|original message)\s*-{2,}$", re.IGNORECASE),
+    re.compile(r"^begin forwarded message:?$", re.IGNORECASE),
+    re.compile(r"^on .{5,200} wrote:$", re.IGNORECASE),
+]
+
+# Signature delimiter ("-- ") and mobile client signatures.
+SIGNATURE_MARKERS = [
+    re.compile(r"^--\s?$"),
+    re.compile(r"^sent from my (iphone|ipad|android|mobile).*$", re.IGNORECASE),
+]
+
+# Mailing-list footer boilerplate. Matching lines are collapsed into a single
+# marker so the model still sees that the email came from a list.
+FOOTER_PATTERN = re.compile(
+    r"(unsubscribe|manage preferences|update your preferences|view in browser|"
+    r"you are receiving this (email|message)|to stop receiving|privacy policy)",
+    re.IGNORECASE,
+)
+FOOTER_MARKER = "[mailing-list footer removed]"
+
+_encoder = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of prompt tokens in text using a local tokenizer."""
+    global _encoder
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoder is None:
+            _encoder = tiktoken.get_encoding("cl100k_base")
+        return len(_encoder.encode(text, disallowed_special=()))
+    # Roughly 4 characters per token for English prose
+    return (len(text) + 3) // 4
+
+
+def strip_history(body: str) -> str:
+    """Remove quoted reply chains and forwarded message blocks."""
+    kept = []
+    for line in body.split('\n'):
+        stripped = line.strip()
+        if any(marker.match(stripped) for marker in HISTORY_MARKERS):
+            break
+        if stripped.startswith('>'):
+            continue
+        kept.append(line)
+    return '\n'.join(kept)
+
+
+def strip_signature_and_footer(body: str) -> str:
+    """Remove the signature block and collapse mailing-list footers."""
+    lines = body.split('\n')
+    for i, line in enumerate(lines):
+        if any(marker.match(line.strip()) for marker in SIGNATURE_MARKERS):
+            lines = lines[:i]
+            break
+
+    kept = []
+    footer_seen = False
+    for line in lines:
+        if FOOTER_PATTERN.search(line) and len(line) < 200:
+            footer_seen = True
+            continue
+        kept.append(line)
+    if footer_seen:
+        kept.append(FOOTER_MARKER)
+    return '\n'.join(kept)
+
+
+def normalize_whitespace(body: str) -> str:
+    """Trim trailing spaces and collapse runs of blank lines."""
+    lines = [re.sub(r"[ \t]+", " ", line).strip() for line in body.split('\n')]
+    text = '\n'.join(lines)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def truncate_to_budget(text: str, max_tokens: int) -> str:
+    """Cut text down to at most max_tokens, preferring paragraph boundaries."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if tiktoken is not None:
+        tokens = _encoder.encode(text, disallowed_special=())
+        truncated = _encoder.decode(tokens[:max_tokens])
+    else:
+        truncated = text[:max_tokens * 4]
+    # Avoid ending mid-paragraph when there is a boundary reasonably close by
+    cut = truncated.rfind('\n\n')
+    if cut > len(truncated) * 0.7:
+        truncated = truncated[:cut]
+    return truncated.rstrip() + "\n[truncated]"
+
+
+def prepare_body(body: str, operation: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Clean an email body and fit it into the token budget for an operation.
+    Returns: (prepared body, stats dict with original/final token counts)
+    """
+    original_tokens = estimate_tokens(body or "")
+    text = strip_history(body or "")
+    text = strip_signature_and_footer(text)
+    text = normalize_whitespace(text)
+    # Never hand the model an empty body just because everything looked like history
+    if not text and body:
+        text = normalize_whitespace(body)
+    text = truncate_to_budget(text, TOKEN_BUDGETS.get(operation, TOKEN_BUDGETS["chat"]))
+    final_tokens = estimate_tokens(text)
+    return text, {
+        "operation": operation,
+        "original_tokens": original_tokens,
+        "final_tokens": final_tokens,
+        "tokens_saved": max(original_tokens - final_tokens, 0),
+    }
+
+
+def pack_emails(emails, budget: int = None, per_email: int = MAILBOX_EMAIL_TOKENS) -> Tuple[str, list, Dict[str, Any]]:
+    """
+    Fit retrieved emails (best match first) into one context block.
+
+    Each email is a dict with id, sender, subject, date and either a cached
+    'summary' or a 'body'. Emails are cleaned, capped at per_email tokens and
+    added until the budget runs out.
+    Returns: (context text, ids of the emails included, stats dict)
+    """
+    budget = budget or TOKEN_BUDGETS["mailbox"]
+    remaining = budget
+    blocks, used_ids = [], []
+    original_tokens = 0
+    for email in emails:
+        header = f"[#{email['id']}] From: {email.get('sender', 'Unknown')} | Subject: {email.get('subject', '')} | Date: {email.get('date', '')}"
+        header_tokens = estimate_tokens(header)
+        if remaining - header_tokens < 50:
+            break
+        text = email.get('summary') or email.get('body') or ""
+        original_tokens += estimate_tokens(text)
+        text = normalize_whitespace(strip_signature_and_footer(strip_history(text))) or normalize_whitespace(text)
+        # Leave room for the "[truncated]" marker and the blank line between emails
+        text = truncate_to_budget(text, min(per_email, remaining - header_tokens - 6))
+        block = f"{header}\n{text}"
+        blocks.append(block)
+        used_ids.append(email['id'])
+        remaining -= estimate_tokens(block) + 1
+    context = "\n\n".join(blocks)
+    final_tokens = estimate_tokens(context)
+    return context, used_ids, {
+        "operation": "mailbox",
+        "original_tokens": original_tokens,
+        "final_tokens": final_tokens,
+        "tokens_saved": max(original_tokens - final_tokens, 0),
+    }
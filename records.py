@@ -0,0 +1,194 @@
+import copy
+import sys
+from datetime import datetime
+from typing import Any, Dict, List
+
+
+def _to_epoch(value) -> int:
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp())
+    return int(value or 0)
+
+
+class EmailRecord:
+    """
+    Compact in-memory email header.
+
+    Uses __slots__ instead of a per-record dict, interns sender and category
+    strings (they repeat heavily across a mailbox) and stores the timestamp as
+    integer epoch seconds. Supports the dict-style access used throughout
+    app.py, e.g. email['subject'], email.get('action_items', []) and
+    email['timestamp'] (returned as a datetime).
+    """
+
+    __slots__ = ('id', 'sender', 'subject', 'ts', 'category', 'action_items', 'is_read',
+                 'body_offset', 'body_length', 'body_codec', 'rev', '_body', '_extra')
+
+    # Keys that map straight onto a slot
+    FIELDS = ('id', 'sender', 'subject', 'category', 'action_items', 'is_read',
+              'body_offset', 'body_length', 'body_codec', 'rev')
+
+    def __init__(self, id, sender, subject, ts, category="Uncategorized", action_items=(),
+                 is_read=False, body_offset=None, body_length=None, body=None, extra=None, body_codec=None,
+                 rev=0):
+        self.id = id
+        self.sender = sys.intern(sender)
+        self.subject = subject
+        self.ts = _to_epoch(ts)
+        self.category = sys.intern(category)
+        self.action_items = tuple(action_items) if action_items else ()
+        self.is_read = is_read
+        self.body_offset = body_offset
+        self.body_length = body_length  # Bytes on disk, i.e. the compressed size
+        self.body_codec = sys.intern(body_codec) if body_codec else None  # None = stored uncompressed
+        self.rev = rev  # Bumped whenever a displayed field changes (keys the UI render cache)
+        # Body is only held in memory until it has been written to the body store
+        self._body = body
+        self._extra = extra or None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "EmailRecord":
+        known = {'id', 'sender', 'subject', 'timestamp', 'category', 'action_items', 'is_read',
+                 'body_offset', 'body_length', 'body_codec', 'rev', 'body'}
+        extra = {k: v for k, v in data.items() if k not in known}
+        return cls(
+            data['id'], data.get('sender', ''), data.get('subject', ''), data.get('timestamp'),
+            category=data.get('category', "Uncategorized"),
+            action_items=data.get('action_items', ()),
+            is_read=data.get('is_read', False),
+            body_offset=data.get('body_offset'),
+            body_length=data.get('body_length'),
+            body=data.get('body'),
+            extra=extra,
+            body_codec=data.get('body_codec'),
+            rev=data.get('rev', 0),
+        )
+
+    @classmethod
+    def from_columns(cls, ids, senders, subjects, timestamps, categories, action_items, is_read,
+                     body_offsets, body_lengths, body_codecs, revs, extras) -> List["EmailRecord"]:
+        """
+        Bulk constructor for already-normalized values (e.g. a binary snapshot):
+        epoch timestamps, interned strings, tuples of action items. Skips the
+        per-field conversion in __init__.
+        """
+        records = []
+        new = cls.__new__
+        for values in zip(ids, senders, subjects, timestamps, categories, action_items, is_read,
+                          body_offsets, body_lengths, body_codecs, revs, extras):
+            record = new(cls)
+            (record.id, record.sender, record.subject, record.ts, record.category, record.action_items,
+             record.is_read, record.body_offset, record.body_length, record.body_codec, record.rev,
+             record._extra) = values
+            record._body = None
+            records.append(record)
+        return records
+
+    @staticmethod
+    def to_columns(records) -> Dict[str, List[Any]]:
+        """Inverse of from_columns: {argument name: [value per record]}."""
+        columns = {name: [] for name in ('ids', 'senders', 'subjects', 'timestamps', 'categories', 'action_items',
+                                         'is_read', 'body_offsets', 'body_lengths', 'body_codecs', 'revs', 'extras')}
+        for record in records:
+            for name, value in zip(columns, (
+                    record.id, record.sender, record.subject, record.ts, record.category, record.action_items,
+                    record.is_read, record.body_offset, record.body_length, record.body_codec, record.rev,
+                    record._extra)):
+                columns[name].append(value)
+        return columns
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializable header dict (timestamp as epoch seconds, no in-memory body)."""
+        data = {
+            'id': self.id,
+            'sender': self.sender,
+            'subject': self.subject,
+            'timestamp': self.ts,
+            'category': self.category,
+            'action_items': list(self.action_items),
+            'is_read': self.is_read,
+        }
+        if self.body_offset is not None:
+            data['body_offset'] = self.body_offset
+            data['body_length'] = self.body_length
+            if self.body_codec:
+                data['body_codec'] = self.body_codec
+        if self.rev:
+            data['rev'] = self.rev
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def replace(self, **changes) -> "EmailRecord":
+        """Return a copy with the given fields changed, leaving this record untouched."""
+        clone = copy.copy(self)
+        if clone._extra:
+            clone._extra = dict(clone._extra)
+        for key, value in changes.items():
+            clone[key] = value
+        return clone
+
+    # Dict-style access
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is None and key.startswith('body_'):
+                raise KeyError(key)
+            return value
+        if key == 'timestamp':
+            return datetime.fromtimestamp(self.ts)
+        if key == 'body':
+            if self._body is None:
+                raise KeyError(key)
+            return self._body
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in ('sender', 'category'):
+            setattr(self, key, sys.intern(value))
+        elif key == 'action_items':
+            self.action_items = tuple(value) if value else ()
+        elif key in self.FIELDS:
+            setattr(self, key, value)
+        elif key == 'timestamp':
+            self.ts = _to_epoch(value)
+        elif key == 'body':
+            self._body = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        if key == 'body' and self._body is not None:
+            body, self._body = self._body, None
+            return body
+        if self._extra and key in self._extra:
+            return self._extra.pop(key)
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def __repr__(self):
+        return f"EmailRecord(id={self.id!r}, sender={self.sender!r}, subject={self.subject!r})"
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import storage
+from budget import Budget, BudgetedService, BudgetExceeded, call_prompt, estimate_service_call
+
+CATEGORIZE_RUN_FILE = os.path.join(storage.EMAIL_DIR, "categorize_run.json")
+# Results are written to the store (and the run state to disk) after this many LLM calls
+CHECKPOINT_EVERY = int(os.getenv("CATEGORIZE_CHECKPOINT_EVERY", "10"))
+# Conversations whose prompts are sized to extrapolate a run's cost
+ESTIMATE_SAMPLE = 200
+
+URGENT_KEYWORDS = re.compile(
+    r"\b(urgent|asap|immediately|action required|required action|deadline|due|overdue|today|tomorrow|eod"
+    r"|final notice|reminder|important|critical|expires?|approval)\b", re.IGNORECASE)
+BULK_SENDERS = re.compile(r"(no-?reply|newsletter|news@|marketing|notifications?@|digest|promo|mailer)", re.IGNORECASE)
+
+# A day of age costs as much as one urgent keyword; unread and personal senders rank higher
+AGE_WEIGHT_PER_DAY = 1.0
+URGENT_WEIGHT = 1.0
+UNREAD_WEIGHT = 0.5
+BULK_SENDER_WEIGHT = -3.0
+
+
+def priority(email, now: Optional[float] = None) -> float:
+    """Heuristic processing priority: newest and likely-urgent mail first (higher is sooner)."""
+    now = now or time.time()
+    age_days = max(0.0, (now - email.ts) / 86400)
+    score = -AGE_WEIGHT_PER_DAY * age_days
+    score += URGENT_WEIGHT * min(3, len(URGENT_KEYWORDS.findall(email['subject'])))
+    if not email.get('is_read', False):
+        score += UNREAD_WEIGHT
+    if BULK_SENDERS.search(email['sender']):
+        score += BULK_SENDER_WEIGHT
+    return score
+
+
+def plan_categorization(store) -> List[List[List[Any]]]:
+    """
+    Units of work for Categorize All, highest priority first. One unit is a
+    near-duplicate cluster of conversations: a single LLM call on its first
+    conversation's newest message labels every message in it.
+    """
+    clusters: Dict[Any, List[List[Any]]] = {}
+    for members in store.threads().values():
+        latest = members[-1]
+        clusters.setdefault(latest.get('dup_of', latest['id']), []).append(members)
+    now = time.time()
+    units = []
+    for cluster in clusters.values():
+        cluster.sort(key=lambda members: members[-1].ts, reverse=True)
+        units.append((max(priority(members[-1], now) for members in cluster), cluster))
+    units.sort(key=lambda unit: unit[0], reverse=True)
+    return [cluster for _, cluster in units]
+
+
+class CategorizeRun:
+    """
+    Categorize All as a background job.
+
+    Works through plan_categorization() in priority order and writes results
+    to the store every CHECKPOINT_EVERY calls, so the inbox fills in while the
+    run is going. The run state (prompt, representatives done so far) is kept
+    in CATEGORIZE_RUN_FILE; a run that didn't finish - the server was
+    restarted or crashed - can be resumed and skips everything already done.
+
+    Each start or resume gets its own Budget (token, cost and time limits,
+    see budget.py). A run that hits the budget stops the same way as a
+    user stop: results so far are checkpointed and it can be resumed.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.budget: Optional[Budget] = None
+        self.state: Dict[str, Any] = self._load()
+
+    def _load(self) -> Dict[str, Any]:
+        if not os.path.exists(CATEGORIZE_RUN_FILE):
+            return {}
+        try:
+            with open(CATEGORIZE_RUN_FILE, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading categorize run state: {e}")
+            return {}
+
+    def _save(self):
+        os.makedirs(storage.EMAIL_DIR, exist_ok=True)
+        tmp_file = CATEGORIZE_RUN_FILE + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_file, CATEGORIZE_RUN_FILE)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def resumable(self) -> bool:
+        """A previous run stopped before finishing (and isn't running in this process)."""
+        return not self.running and self.state.get('status') in ("running", "stopped")
+
+    def start(self, service, prompt_template: str, resume: bool = False, budget: Optional[Budget] = None):
+        if self.running:
+            return
+        self.budget = budget or Budget()
+        if self.budget.limited:
+            service = BudgetedService(service, self.budget)
+        with self._lock:
+            if resume and self.resumable:
+                prompt_template = self.state['prompt']
+            else:
+                self.state = {
+                    'run_id': hashlib.sha1(f"{time.time()}:{prompt_template}".encode('utf-8')).hexdigest()[:12],
+                    'prompt': prompt_template,
+                    'started': int(time.time()),
+                    'done': [],
+                    'total': 0,
+                    'emails': 0,
+                    'threads': 0,
+                    'llm_calls': 0,
+                    'errors': 0,
+                }
+            self.state['status'] = "running"
+            self.state.pop('stop_reason', None)
+            self.state['budget'] = self.budget.summary()
+            self._save()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(service, prompt_template), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the current call; finished results are checkpointed first."""
+        self._stop.set()
+
+    def _checkpoint(self, updates: Dict[Any, Dict[str, Any]], done: List[Any], status: str = "running"):
+        with self._lock:
+            if not self.state:
+                return  # Cleared while running
+        if updates:
+            self.store.update_emails(updates)
+        with self._lock:
+            self.state['done'].extend(done)
+            self.state['status'] = status
+            if self.budget is not None:
+                self.state['budget'] = self.budget.summary()
+            if status == "done":
+                self.state['finished'] = int(time.time())
+            self._save()
+
+    def _run(self, service, prompt_template: str):
+        plan = plan_categorization(self.store)
+        done = set(self.state['done'])
+        self.state['total'] = len(plan)
+        updates, finished = {}, []
+        for cluster in plan:
+            latest = cluster[0][-1]
+            if latest['id'] in done:
+                continue
+            if self._stop.is_set():
+                self._checkpoint(updates, finished, "stopped")
+                return
+            try:
+                category = service.categorize_email(latest['subject'], self.store.thread_text(latest), prompt_template)
+            except BudgetExceeded as e:
+                self.state['stop_reason'] = str(e)
+                self._checkpoint(updates, finished, "stopped")
+                return
+            except Exception as e:
+                print(f"Error categorizing email {latest['id']}: {str(e)}")
+                self.state['errors'] += 1
+                category = "Uncategorized"
+            for members in cluster:
+                for email in members:
+                    updates[email['id']] = {'category': category}
+            self.state['llm_calls'] += 1
+            self.state['threads'] += len(cluster)
+            self.state['emails'] += sum(len(members) for members in cluster)
+            finished.append(latest['id'])
+            if len(finished) >= CHECKPOINT_EVERY:
+                self._checkpoint(updates, finished)
+                updates, finished = {}, []
+        self._checkpoint(updates, finished, "done")
+
+    def estimate(self, service, prompt_template: str, sample: int = ESTIMATE_SAMPLE) -> Dict[str, Any]:
+        """
+        Expected LLM calls, tokens and cost of categorizing what is left,
+        from the prompt sizes of an evenly spaced sample of the plan.
+        """
+        done = set(self.state.get('done', [])) if self.resumable else set()
+        todo = [cluster for cluster in plan_categorization(self.store) if cluster[0][-1]['id'] not in done]
+        if not todo:
+            return {'calls': 0, 'tokens': 0, 'cost_usd': 0.0}
+        sampled = todo[::max(1, len(todo) // sample)][:sample]
+        tokens, cost = 0, 0.0
+        for cluster in sampled:
+            latest = cluster[0][-1]
+            prompt = call_prompt("categorize", latest['subject'], self.store.thread_text(latest), prompt_template)
+            call_tokens, call_cost = estimate_service_call(service, "categorize", prompt)
+            tokens, cost = tokens + call_tokens, cost + call_cost
+        scale = len(todo) / len(sampled)
+        return {'calls': len(todo), 'tokens': int(tokens * scale), 'cost_usd': round(cost * scale, 4)}
+
+    def progress(self) -> Dict[str, Any]:
+        state = dict(self.state)
+        if not state:
+            return state
+        state['completed'] = len(state.get('done', []))
+        return state
+
+    def clear(self):
+        self.stop()
+        with self._lock:
+            self.state = {}
+            if os.path.exists(CATEGORIZE_RUN_FILE):
+                os.remove(CATEGORIZE_RUN_FILE)
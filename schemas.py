@@ -1,3 +1,5 @@
+import json
+import re
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from datetime import datetime
@@ -54,3 +56,36 @@ class ChatResponse(BaseModel):
     response: str
     action: Optional[str] = None
     data: Optional[Dict[str, Any]] = None
+
+# Structured LLM replies (see LLMService._call_structured)
+
+class ActionItems(BaseModel):
+    action_items: List[str] = []
+
+class DraftReply(BaseModel):
+    subject: str
+    body: str
+
+def _fence_free(text: str) -> str:
+    text = (text or "").strip()
+    match = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+    return match.group(1) if match else text
+
+def schema_json(schema) -> str:
+    """Compact JSON schema text for prompts (pydantic v1 or v2)."""
+    build = getattr(schema, "model_json_schema", None) or schema.schema
+    return json.dumps(build(), separators=(",", ":"))
+
+def parse_reply(text: str, schema):
+    """
+    Parse and validate an LLM reply in one pass: optional code fence, JSON,
+    then the schema. A bare JSON list is accepted for a schema with a single
+    list field, since older prompt templates ask for "a JSON list".
+    Raises ValueError (JSON or validation error) if the reply doesn't match.
+    """
+    data = json.loads(_fence_free(text))
+    fields = getattr(schema, "model_fields", None) or schema.__fields__
+    if isinstance(data, list) and len(fields) == 1:
+        data = {next(iter(fields)): data}
+    validate = getattr(schema, "model_validate", None) or schema.parse_obj
+    return validate(data)
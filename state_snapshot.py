@@ -0,0 +1,413 @@
+import gc
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import storage
+from dedup import NUM_PERM, NearDuplicateIndex
+from records import EmailRecord
+
+SNAPSHOT_FILE = os.path.join(storage.EMAIL_DIR, "snapshot.bin")
+JOURNAL_FILE = os.path.join(storage.EMAIL_DIR, "snapshot.journal")
+# The snapshot is rewritten once the journal holds this many changed records
+SNAPSHOT_EVERY = int(os.getenv("SNAPSHOT_EVERY", "5000"))
+
+MAGIC = b"EPSNAP01"
+ALIGN = 64  # Arrays start on cache-line boundaries so they can be viewed in place
+
+# Numeric columns of a month, in EmailRecord.from_columns order where they map onto one
+COLUMNS = {
+    'ids': np.int64,
+    'timestamps': np.int64,
+    'is_read': np.uint8,
+    'body_offsets': np.int64,  # -1 = no body stored
+    'body_lengths': np.int64,
+    'body_codecs': np.int32,   # String table index, -1 = uncompressed
+    'revs': np.int32,
+    'senders': np.int32,       # String table index
+    'categories': np.int32,    # String table index
+}
+
+
+def _align(position: int) -> int:
+    return (position + ALIGN - 1) // ALIGN * ALIGN
+
+
+class _Blobs:
+    """Collects the data section of a snapshot file, handing out aligned offsets."""
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.size = 0
+
+    def add(self, data: bytes) -> List[int]:
+        offset = _align(self.size)
+        if offset > self.size:
+            self.parts.append(b"\0" * (offset - self.size))
+        self.parts.append(data)
+        self.size = offset + len(data)
+        return [offset, len(data)]
+
+    def array(self, values, dtype) -> List[Any]:
+        array = np.asarray(values, dtype=dtype)
+        offset, _ = self.add(array.tobytes())
+        return [offset, array.dtype.str, len(array)]
+
+    def json(self, value) -> List[int]:
+        return self.add(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+class StateSnapshot:
+    """
+    Binary snapshot of the email store for fast warm starts.
+
+    One file holds every active month partition as columns (numeric columns
+    as raw arrays that are memory-mapped and viewed in place, subjects and
+    the rare extra fields as one JSON array per month, senders and
+    categories as indexes into a shared string table) plus the near-
+    duplicate index. Changes made after the snapshot was written go to a
+    small append-only journal, and startup reads the snapshot plus the
+    journal instead of parsing every header file.
+
+    Each month in the snapshot (and each journal entry) records the size and
+    mtime of the partition's header file it matches. A month whose file has
+    changed in a way the journal doesn't account for is read from the header
+    file instead, so a stale or missing snapshot only costs speed.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_FILE, journal_path: str = JOURNAL_FILE):
+        self.path = path
+        self.journal_path = journal_path
+        self.header: Dict[str, Any] = {}
+        self.strings: List[str] = []
+        self.expected: Dict[str, Optional[list]] = {}  # month -> header file stat the snapshot + journal match
+        self.pending: Dict[str, Dict[Any, Dict[str, Any]]] = {}  # month -> {email_id: record dict} from the journal
+        self.journal_records = 0
+        self.generation = 0  # Bumped by clear(), so a snapshot prepared before it is never installed
+        self._map = None
+        self._base = 0
+        self.open()
+
+    # Reading
+
+    def open(self):
+        """(Re)read the snapshot header and replay the journal."""
+        self.close()
+        self.header, self.strings, self.expected, self.pending, self.journal_records = {}, [], {}, {}, 0
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a snapshot file")
+            (length,) = struct.unpack_from("<Q", self._map, len(MAGIC))
+            start = len(MAGIC) + 8
+            self.header = json.loads(self._map[start:start + length])
+            self._base = _align(start + length)
+            self.strings = [sys.intern(value) for value in self._json(self.header['strings'])]
+            self.expected = {month: entry['stat'] for month, entry in self.header['months'].items()}
+            self._replay()
+        except Exception as e:
+            print(f"Error loading state snapshot: {e}")
+            self.close()
+            self.header, self.strings, self.expected, self.pending = {}, [], {}, {}
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                entry = json.loads(line)
+                for month, change in entry.items():
+                    self.expected[month] = change['stat']
+                    if change['stat'] is None:
+                        self.pending.pop(month, None)
+                        continue
+                    records = self.pending.setdefault(month, {})
+                    for record in change['records']:
+                        records[record['id']] = record
+                    self.journal_records += len(change['records'])
+
+    def _array(self, spec) -> np.ndarray:
+        offset, dtype, count = spec
+        return np.frombuffer(self._map, dtype=dtype, count=count, offset=self._base + offset)
+
+    def _json(self, spec):
+        offset, length = spec
+        start = self._base + offset
+        return json.loads(self._map[start:start + length])
+
+    @property
+    def due(self) -> bool:
+        """The snapshot is missing or the journal has grown enough that it should be rewritten."""
+        return not self.header or self.journal_records >= SNAPSHOT_EVERY
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'created': self.header.get('created'),
+            'months': len(self.header.get('months', {})),
+            'journal_records': self.journal_records,
+            'size': os.path.getsize(self.path) if self.header and os.path.exists(self.path) else 0,
+        }
+
+    def current(self, month: str) -> bool:
+        """The snapshot plus journal match the month's header file on disk."""
+        stat = self.expected.get(month)
+        return stat is not None and month in self.header.get('months', {}) and stat == storage.partition_stat(month)
+
+    def consistent(self, months) -> set:
+        return {month for month in months if self.current(month)}
+
+    def _month_records(self, month: str) -> List[EmailRecord]:
+        entry = self.header['months'][month]
+        columns = {name: self._array(spec).tolist() for name, spec in entry['arrays'].items()}
+        strings = self.strings
+        rest = self._json(entry['rest'])
+        records = EmailRecord.from_columns(
+            columns['ids'],
+            [strings[code] for code in columns['senders']],
+            self._json(entry['subjects']),
+            columns['timestamps'],
+            [strings[code] for code in columns['categories']],
+            [tuple(extra[0]) if extra and extra[0] else () for extra in rest],
+            [bool(value) for value in columns['is_read']],
+            [offset if offset >= 0 else None for offset in columns['body_offsets']],
+            [length if length >= 0 else None for length in columns['body_lengths']],
+            [strings[code] if code >= 0 else None for code in columns['body_codecs']],
+            columns['revs'],
+            [extra[1] if extra else None for extra in rest],
+        )
+        changes = self.pending.get(month)
+        if changes:
+            positions = {record.id: i for i, record in enumerate(records)}
+            for email_id, data in changes.items():
+                record = EmailRecord.from_dict(data)
+                if email_id in positions:
+                    records[positions[email_id]] = record
+                else:
+                    records.append(record)
+        return records
+
+    def load_months(self, months) -> Tuple[List[EmailRecord], List[str]]:
+        """
+        Records of the given months, in the same order storage.load_emails()
+        returns them. Months the snapshot can't vouch for are read from their
+        header files. Returns (records, months read from header files).
+        """
+        records, stale = [], []
+        # Allocating a million records would otherwise set off repeated full GC passes
+        paused = gc.isenabled()
+        gc.disable()
+        try:
+            self._load_into(records, stale, months)
+        finally:
+            if paused:
+                gc.enable()
+        return records, stale
+
+    def _load_into(self, records, stale, months):
+        for month in months:
+            month_records = None
+            if self.current(month):
+                try:
+                    month_records = self._month_records(month)
+                except Exception as e:
+                    print(f"Error reading {month} from state snapshot: {e}")
+            if month_records is None:
+                stale.append(month)
+                month_records = storage.load_emails([month])
+            records.extend(month_records)
+
+    def load_duplicates(self, path: str) -> Optional[NearDuplicateIndex]:
+        """The near-duplicate index, if the snapshot's copy matches the index file at path."""
+        entry = self.header.get('duplicates')
+        if not entry or entry['num_perm'] != NUM_PERM or entry['stat'] != _file_stat(path):
+            return None
+        try:
+            index = NearDuplicateIndex(entry['threshold'])
+            ids = self._array(entry['ids']).tolist()
+            signatures = self._array(entry['signatures']).reshape(len(ids), NUM_PERM).tolist()
+            for rep_id, signature in zip(ids, signatures):
+                index.representatives[rep_id] = signature
+                for band in index._bands(signature):
+                    index._buckets.setdefault(band, []).append(rep_id)
+            index.cluster_sizes = dict(zip(self._array(entry['cluster_ids']).tolist(),
+                                           self._array(entry['cluster_sizes']).tolist()))
+            return index
+        except Exception as e:
+            print(f"Error reading duplicate index from state snapshot: {e}")
+            return None
+
+    # Journal
+
+    def log(self, records, consistent: set):
+        """
+        Journal records just written to their partitions. consistent holds the
+        months that matched the snapshot before the write; any other month
+        touched is marked stale until the next snapshot.
+        """
+        if not self.header:
+            return
+        entry = {}
+        for month, group in _by_month(records).items():
+            stat = storage.partition_stat(month) if month in consistent else None
+            entry[month] = {'stat': stat, 'records': [record.to_dict() for record in group] if stat else []}
+        try:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(entry, separators=(',', ':')) + "\n")
+        except Exception as e:
+            print(f"Error writing snapshot journal: {e}")
+            return
+        for month, change in entry.items():
+            self.expected[month] = change['stat']
+            if change['stat'] is None:
+                self.pending.pop(month, None)
+                continue
+            pending = self.pending.setdefault(month, {})
+            for record in change['records']:
+                pending[record['id']] = record
+            self.journal_records += len(change['records'])
+
+    # Writing
+
+    def prepare(self, records, duplicates: NearDuplicateIndex, duplicates_path: str) -> Dict[str, Any]:
+        """
+        Capture what a new snapshot will contain. Must run while the caller
+        holds the lock its writes go through, so the file stats and journal
+        position match the records; write() can then run without it.
+        """
+        groups = _by_month(records)
+        return {
+            'months': {month: (storage.partition_stat(month), group) for month, group in groups.items()},
+            'duplicates': (duplicates.threshold, dict(duplicates.representatives), dict(duplicates.cluster_sizes),
+                           _file_stat(duplicates_path)),
+            'journal_position': os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0,
+            'generation': self.generation,
+        }
+
+    def write(self, job: Dict[str, Any]) -> bool:
+        """Encode a prepared snapshot to a temporary file; install() puts it in place."""
+        try:
+            blobs = _Blobs()
+            strings: Dict[str, int] = {}
+
+            def code(value):
+                if value is None:
+                    return -1
+                index = strings.get(value)
+                if index is None:
+                    index = strings[value] = len(strings)
+                return index
+
+            months = {}
+            for month, (stat, group) in job['months'].items():
+                if stat is None:
+                    continue
+                columns = EmailRecord.to_columns(group)
+                arrays = {
+                    'ids': blobs.array(columns['ids'], COLUMNS['ids']),
+                    'timestamps': blobs.array(columns['timestamps'], COLUMNS['timestamps']),
+                    'is_read': blobs.array(columns['is_read'], COLUMNS['is_read']),
+                    'body_offsets': blobs.array([-1 if v is None else v for v in columns['body_offsets']],
+                                                COLUMNS['body_offsets']),
+                    'body_lengths': blobs.array([-1 if v is None else v for v in columns['body_lengths']],
+                                                COLUMNS['body_lengths']),
+                    'body_codecs': blobs.array([code(v) for v in columns['body_codecs']], COLUMNS['body_codecs']),
+                    'revs': blobs.array(columns['revs'], COLUMNS['revs']),
+                    'senders': blobs.array([code(v) for v in columns['senders']], COLUMNS['senders']),
+                    'categories': blobs.array([code(v) for v in columns['categories']], COLUMNS['categories']),
+                }
+                rest = [[list(items), extra] if items or extra else None
+                        for items, extra in zip(columns['action_items'], columns['extras'])]
+                months[month] = {
+                    'stat': stat,
+                    'rows': len(group),
+                    'arrays': arrays,
+                    'subjects': blobs.json(columns['subjects']),
+                    'rest': blobs.json(rest),
+                }
+
+            threshold, representatives, cluster_sizes, stat = job['duplicates']
+            header = {
+                'format': 1,
+                'created': int(time.time()),
+                'months': months,
+                'strings': blobs.json(list(strings)),
+                'duplicates': {
+                    'threshold': threshold,
+                    'num_perm': NUM_PERM,
+                    'stat': stat,
+                    'ids': blobs.array(list(representatives), np.int64),
+                    'signatures': blobs.array([value for signature in representatives.values() for value in signature],
+                                              np.uint64),
+                    'cluster_ids': blobs.array(list(cluster_sizes), np.int64),
+                    'cluster_sizes': blobs.array(list(cluster_sizes.values()), np.int64),
+                },
+            }
+            head = json.dumps(header, separators=(',', ':')).encode('utf-8')
+            start = len(MAGIC) + 8 + len(head)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack("<Q", len(head)))
+                f.write(head)
+                f.write(b"\0" * (_align(start) - start))
+                for part in blobs.parts:
+                    f.write(part)
+            return True
+        except Exception as e:
+            print(f"Error writing state snapshot: {e}")
+            return False
+
+    def install(self, job: Dict[str, Any]):
+        """Put a written snapshot in place and drop the journal entries it covers."""
+        if job['generation'] != self.generation:
+            if os.path.exists(self.path + ".tmp"):
+                os.remove(self.path + ".tmp")
+            return
+        self.close()
+        os.replace(self.path + ".tmp", self.path)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                f.seek(job['journal_position'])
+                newer = f.read()
+            tmp_file = self.journal_path + ".tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(newer)
+            os.replace(tmp_file, self.journal_path)
+        self.open()
+
+    def clear(self):
+        self.generation += 1
+        self.close()
+        for path in (self.path, self.path + ".tmp", self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.header, self.strings, self.expected, self.pending, self.journal_records = {}, [], {}, {}, 0
+
+
+def _file_stat(path: str) -> Optional[list]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _by_month(records) -> Dict[str, List[EmailRecord]]:
+    groups = {}
+    for record in records:
+        groups.setdefault(storage.partition_key(record), []).append(record)
+    return groups
@@ -1,9 +1,53 @@
 import json
 import os
-from datetime import datetime
+import shutil
+import threading
+import zlib
+from datetime import datetime, timezone
+from functools import lru_cache
+from records import EmailRecord
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-DATA_FILE = "emails.json"
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DATA_FILE = "emails.json"  # Legacy single-file format, migrated on first load
+EMAIL_DIR = "mailstore"
+# Emails are stored in one directory per month, each with a header index (one
+# header per line, or a msgpack stream) and a body store read by offset
+PARTITIONS_DIR = os.path.join(EMAIL_DIR, "partitions")
+ARCHIVE_DIR = os.path.join(EMAIL_DIR, "archive")
+MANIFEST_FILE = os.path.join(EMAIL_DIR, "partitions.json")
+# Older single-index layout, migrated to partitions on first load
+HEADERS_FILE = os.path.join(EMAIL_DIR, "headers.ndjson")
+LEGACY_HEADERS_FILE = os.path.join(EMAIL_DIR, "headers.json")
+BODIES_FILE = os.path.join(EMAIL_DIR, "bodies.dat")
+BODY_DICT_FILE = os.path.join(EMAIL_DIR, "bodies.zdict")  # Shared zstd dictionary, trained once
+# Mailbox import progress (see ingestion.py): a compacted state file plus an append-only batch log
+IMPORT_STATE_FILE = os.path.join(EMAIL_DIR, "import_state.json")
+IMPORT_LOG_FILE = IMPORT_STATE_FILE + ".log"
+# Compression for newly stored bodies: zlib, zstd (trained dictionary, needs `pip install zstandard`) or none.
+# Each record carries its own codec, so bodies written under different settings stay readable.
+BODY_COMPRESSION = os.getenv("BODY_COMPRESSION", "zlib")
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+ZSTD_DICT_SIZE = 112 * 1024
+ZSTD_MIN_SAMPLES = 200  # Bodies needed before a dictionary is worth training; zlib is used until then
+CHUNK_SIZE = 1000
+# Codec used for writes: json, orjson or msgpack. Reads detect the format from the file itself.
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "json")
 PROMPTS_FILE = "prompts.json"
 DRAFTS_FILE = "drafts.json"
 
@@ -14,7 +58,7 @@ DEFAULT_PROMPTS = {
     },
     "Action Extraction": {
         "description": "Extracts tasks from emails",
-        "template": "Extract any action items or tasks from the following email. Return them as a JSON list of strings. If none, return []."
+        "template": "Extract any action items or tasks from the following email, each as a short imperative sentence. If there are none, return an empty list."
     },
     "Auto-Reply": {
         "description": "Generates draft replies",
@@ -22,62 +66,583 @@ DEFAULT_PROMPTS = {
     }
 }
 
-def load_emails():
-    if not os.path.exists(DATA_FILE):
-        return []
+# Data files are either JSON (a document, or one record per line) or msgpack.
+# msgpack files start with MSGPACK_MAGIC; 0xC1 is never a valid first byte for
+# msgpack or JSON, so loads can tell the formats apart from the file itself.
+MSGPACK_MAGIC = b"\xc1EPM"
+
+class JsonCodec:
+    """Standard-library JSON. Compact output, one record per line for streams."""
+    name = "json"
+    magic = b""
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+    def write_records(self, f, records):
+        for record in records:
+            f.write(self.dumps(record))
+            f.write(b'\n')
+
+    def iter_records(self, f):
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield self.loads(line)
+            except ValueError as e:
+                print(f"Skipping bad record on line {line_no}: {e}")
+
+class OrjsonCodec(JsonCodec):
+    """orjson: same on-disk format as JsonCodec, several times faster, native datetimes."""
+    name = "orjson"
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: bytes):
+        return orjson.loads(data)
+
+class MsgpackCodec:
+    """Compact binary msgpack. Record streams are concatenated msgpack objects."""
+    name = "msgpack"
+    magic = MSGPACK_MAGIC
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True, datetime=True)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data, raw=False, timestamp=3)
+
+    def write_records(self, f, records):
+        packer = msgpack.Packer(use_bin_type=True, datetime=True)
+        for record in records:
+            f.write(packer.pack(record))
+
+    def iter_records(self, f):
+        yield from msgpack.Unpacker(f, raw=False, timestamp=3)
+
+CODECS = {"json": JsonCodec, "orjson": OrjsonCodec, "msgpack": MsgpackCodec}
+_CODEC_DEPENDENCIES = {"orjson": lambda: orjson, "msgpack": lambda: msgpack}
+
+def get_codec(name=None):
+    """Return the codec to write with, falling back to json if its library is missing."""
+    name = (name or STORAGE_CODEC).lower()
+    if name not in CODECS:
+        raise ValueError(f"Unsupported storage codec: {name}")
+    if name in _CODEC_DEPENDENCIES and _CODEC_DEPENDENCIES[name]() is None:
+        print(f"Storage codec '{name}' is not installed. Falling back to json.")
+        name = "json"
+    return CODECS[name]()
+
+def detect_codec(path):
+    """Pick the codec for an existing file from its leading bytes."""
+    with open(path, 'rb') as f:
+        head = f.read(len(MSGPACK_MAGIC))
+    if head == MSGPACK_MAGIC:
+        if msgpack is None:
+            raise RuntimeError(f"{path} is msgpack-encoded but msgpack is not installed")
+        return MsgpackCodec()
+    return OrjsonCodec() if orjson is not None else JsonCodec()
+
+def _load_document(path):
+    codec = detect_codec(path)
+    with open(path, 'rb') as f:
+        return codec.loads(f.read()[len(codec.magic):])
+
+def _dump_document(path, obj, codec=None):
+    codec = codec or get_codec()
+    tmp_file = path + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(codec.magic)
+        f.write(codec.dumps(obj))
+    os.replace(tmp_file, path)
+
+def _iter_record_file(path):
+    codec = detect_codec(path)
+    with open(path, 'rb') as f:
+        f.seek(len(codec.magic))
+        yield from codec.iter_records(f)
+
+def _iter_json_array(path, read_size=1 << 16):
+    """Stream the elements of a top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    with open(path, 'r') as f:
+        while True:
+            chunk = f.read(read_size)
+            buffer += chunk
+            while True:
+                buffer = buffer.lstrip()
+                if not started:
+                    if not buffer:
+                        break
+                    if buffer[0] != '[':
+                        raise ValueError(f"{path} is not a JSON array")
+                    buffer = buffer[1:]
+                    started = True
+                    continue
+                buffer = buffer.lstrip(", \n\r\t")
+                if not buffer or buffer[0] == ']':
+                    break
+                try:
+                    item, end = decoder.raw_decode(buffer)
+                except ValueError as e:
+                    if not chunk:
+                        # Nothing more to read, so the element is malformed rather than cut off by the chunk
+                        raise ValueError(f"{path}: malformed array element: {e}") from e
+                    break  # Element continues in the next chunk
+                yield item
+                buffer = buffer[end:]
+            if not chunk:
+                if started and not buffer.lstrip(", \n\r\t").startswith(']'):
+                    raise ValueError(f"{path}: JSON array is not terminated")
+                return
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def partition_key(email) -> str:
+    """Month partition an email is stored in ("2025-11", by UTC timestamp)."""
+    ts = email.ts if isinstance(email, EmailRecord) else EmailRecord.from_dict(email).ts
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m")
+
+def _partition_dir(month, archived=False):
+    return os.path.join(ARCHIVE_DIR if archived else PARTITIONS_DIR, month)
+
+def _headers_path(month, archived=False):
+    return os.path.join(_partition_dir(month, archived), "headers.ndjson")
+
+def _bodies_path(month, archived=False):
+    return os.path.join(_partition_dir(month, archived), "bodies.dat")
+
+def _group_by_partition(emails):
+    groups = {}
+    for email in emails:
+        groups.setdefault(partition_key(email), []).append(email)
+    return groups
+
+def load_manifest():
+    """{month: {"emails", "max_id", "archived"}} for every partition, archived ones included."""
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    try:
+        return _load_document(MANIFEST_FILE)
+    except Exception as e:
+        print(f"Error loading partition manifest: {e}")
+        return {}
+
+def _update_manifest(groups, replace):
+    manifest = load_manifest()
+    for month, group in groups.items():
+        entry = manifest.setdefault(month, {"emails": 0, "max_id": 0, "archived": False})
+        entry["emails"] = len(group) if replace else entry["emails"] + len(group)
+        entry["max_id"] = max([entry["max_id"]] + [email['id'] for email in group])
+    _dump_document(MANIFEST_FILE, manifest)
+
+def _migrate_legacy_emails():
+    """
+    One-time streaming conversion of older layouts into month partitions:
+    the original single-file emails.json, the JSON-array header index
+    (mailstore/headers.json) and the single NDJSON index + body store
+    (mailstore/headers.ndjson, bodies.dat).
+    """
+    if os.path.exists(MANIFEST_FILE):
+        return
+    if os.path.exists(LEGACY_HEADERS_FILE):
+        source = LEGACY_HEADERS_FILE
+    elif os.path.exists(DATA_FILE):
+        source = DATA_FILE
+    elif os.path.exists(HEADERS_FILE):
+        source = HEADERS_FILE
+    else:
+        return
     try:
-        with open(DATA_FILE, 'r') as f:
-            data = json.load(f)
-            # Convert timestamp strings back to datetime objects
-            for email in data:
-                if 'timestamp' in email and isinstance(email['timestamp'], str):
-                    try:
-                        email['timestamp'] = datetime.fromisoformat(email['timestamp'])
-                    except ValueError:
-                        pass
-            return data
+        if source == DATA_FILE:
+            for chunk in _chunked(_iter_json_array(source), CHUNK_SIZE):
+                append_emails([EmailRecord.from_dict(email) for email in chunk])
+        else:
+            # Both header index layouts point into the single body store; bodies are copied into the partitions
+            headers = _iter_record_file(source) if source == HEADERS_FILE else _iter_json_array(source)
+            bodies = open(BODIES_FILE, 'rb') if os.path.exists(BODIES_FILE) else None
+            for chunk in _chunked(headers, CHUNK_SIZE):
+                records = [EmailRecord.from_dict(header) for header in chunk]
+                for record in records:
+                    if record.body_offset is not None and bodies is not None:
+                        bodies.seek(record.body_offset)
+                        record['body'] = _decode_body(bodies.read(record.body_length), record.body_codec)
+                    record.body_offset = record.body_length = record.body_codec = None
+                append_emails(records)
+            if bodies is not None:
+                bodies.close()
+                os.replace(BODIES_FILE, BODIES_FILE + ".migrated")
+    except Exception as e:
+        print(f"Error migrating emails: {e}")
+        # Start over on the next load rather than keep a half-migrated store
+        shutil.rmtree(PARTITIONS_DIR, ignore_errors=True)
+        if os.path.exists(MANIFEST_FILE):
+            os.remove(MANIFEST_FILE)
+        return
+    os.replace(source, source + ".migrated")
+
+def migration_pending():
+    """An older layout is still waiting to be migrated (e.g. the last attempt failed on a malformed file)."""
+    return not os.path.exists(MANIFEST_FILE) and any(
+        os.path.exists(path) for path in (LEGACY_HEADERS_FILE, DATA_FILE, HEADERS_FILE))
+
+def list_partitions(include_archived=False):
+    """Months that hold email, newest first."""
+    _migrate_legacy_emails()
+    manifest = load_manifest()
+    return sorted((month for month, entry in manifest.items()
+                   if include_archived or not entry.get("archived")), reverse=True)
+
+def iter_email_chunks(chunk_size=CHUNK_SIZE, months=None):
+    """
+    Stream the header index as lists of up to chunk_size EmailRecords,
+    newest partition first (or just the given months). Memory stays bounded
+    by the chunk size, so batch jobs can walk mailboxes larger than RAM.
+    """
+    for month in (list_partitions() if months is None else months):
+        path = _headers_path(month)
+        if not os.path.exists(path):
+            continue
+        chunk = []
+        for header in _iter_record_file(path):
+            try:
+                chunk.append(EmailRecord.from_dict(header))
+            except (ValueError, KeyError) as e:
+                print(f"Skipping bad email record: {e}")
+                continue
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def iter_emails(chunk_size=CHUNK_SIZE, months=None):
+    """Stream EmailRecords one at a time from the header index."""
+    for chunk in iter_email_chunks(chunk_size, months):
+        yield from chunk
+
+def load_emails(months=None):
+    """
+    Load email headers as EmailRecords: every active partition, or only the
+    given months. Bodies stay on disk and are read on demand through
+    get_body(), so startup cost scales with the number of emails loaded
+    rather than total mailbox size.
+    """
+    try:
+        return list(iter_emails(months=months))
     except Exception as e:
         print(f"Error loading emails: {e}")
         return []
 
-def save_emails(emails):
-    # Convert datetime objects to strings for JSON serialization
-    serializable_emails = []
+_zstd_dictionary = None
+# Per-thread (dictionary, compressor) and (dictionary, decompressor): zstd contexts aren't thread-safe,
+# and setting one up from the dictionary costs far more than compressing a single body
+_zstd_contexts = threading.local()
+
+def _body_dictionary():
+    """The shared zstd dictionary, if one has been trained."""
+    global _zstd_dictionary
+    if _zstd_dictionary is None and zstandard is not None and os.path.exists(BODY_DICT_FILE):
+        with open(BODY_DICT_FILE, 'rb') as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+        dictionary.precompute_compress(level=ZSTD_LEVEL)
+        _zstd_dictionary = dictionary
+    return _zstd_dictionary
+
+def _zstd_context(kind):
+    """This thread's ZstdCompressor ("compressor") or ZstdDecompressor for the current dictionary."""
+    dictionary = _body_dictionary()
+    cached = getattr(_zstd_contexts, kind, None)
+    if cached is None or cached[0] is not dictionary:
+        if kind == "compressor":
+            context = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+        else:
+            context = zstandard.ZstdDecompressor(dict_data=dictionary)
+        cached = (dictionary, context)
+        setattr(_zstd_contexts, kind, cached)
+    return cached[1]
+
+def _train_body_dictionary(samples):
+    """Train the zstd dictionary from a batch of bodies. Done once; bodies already written refer to it."""
+    global _zstd_dictionary
+    try:
+        dictionary = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples)
+    except zstandard.ZstdError as e:
+        print(f"Could not train body dictionary: {e}")
+        return None
+    tmp_file = BODY_DICT_FILE + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(dictionary.as_bytes())
+    os.replace(tmp_file, BODY_DICT_FILE)
+    dictionary.precompute_compress(level=ZSTD_LEVEL)
+    _zstd_dictionary = dictionary
+    return dictionary
+
+def _body_codec(samples):
+    """Codec for a batch of bodies about to be written (trains the zstd dictionary on first use)."""
+    if BODY_COMPRESSION == "zstd" and zstandard is not None:
+        if _body_dictionary() is not None:
+            return "zstd"
+        if len(samples) >= ZSTD_MIN_SAMPLES and _train_body_dictionary(samples) is not None:
+            return "zstd"
+    if BODY_COMPRESSION in ("zlib", "zstd"):
+        return "zlib"
+    return None
+
+def _encode_body(text, codec):
+    data = text.encode('utf-8')
+    if codec == "zlib":
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == "zstd":
+        return _zstd_context("compressor").compress(data)
+    return data
+
+def _decode_body(data, codec):
+    if codec == "zlib":
+        data = zlib.decompress(data)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise OSError("body is zstd-compressed; pip install zstandard to read it")
+        data = _zstd_context("decompressor").decompress(data)
+    return data.decode('utf-8')
+
+@lru_cache(maxsize=256)
+def _read_body(path, offset, length, codec=None):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return _decode_body(f.read(length), codec)
+
+def get_body(email):
+    """
+    Return an email's body, reading (and decompressing) it from its
+    partition's body store if not in memory. Every reader of bodies -
+    display, search, dedup, the LLM - goes through here.
+    """
+    if 'body' in email:
+        return email['body']
+    if 'body_offset' not in email:
+        return ""
+    try:
+        return _read_body(_bodies_path(partition_key(email)), email['body_offset'], email['body_length'],
+                          email.get('body_codec'))
+    except (OSError, ValueError, zlib.error) as e:
+        # ValueError: a stale record still pointing into a body store that has since been rewritten
+        print(f"Error reading body for email {email.get('id')}: {e}")
+        return ""
+
+def _write_bodies(f, emails, bodies):
+    """Write bodies at the end of f and point each email at its (compressed) copy."""
+    codec = _body_codec([body.encode('utf-8') for body in bodies])
+    offset = f.tell()
+    for email, body in zip(emails, bodies):
+        data = _encode_body(body, codec)
+        f.write(data)
+        email['body_offset'] = offset
+        email['body_length'] = len(data)
+        if codec:
+            email['body_codec'] = codec
+        elif 'body_codec' in email:
+            email['body_codec'] = None
+        offset += len(data)
+
+def _write_pending_bodies(emails):
+    """Append bodies still held in memory to their partition's body store and record their offsets."""
+    pending = [email for email in emails if 'body' in email]
+    for month, group in _group_by_partition(pending).items():
+        os.makedirs(_partition_dir(month), exist_ok=True)
+        with open(_bodies_path(month), 'ab') as f:
+            _write_bodies(f, group, [email.pop('body') for email in group])
+
+def recompress_bodies(emails):
+    """
+    Rewrite the body stores of the partitions `emails` belong to (pass
+    whole partitions) under the current BODY_COMPRESSION setting. `emails`
+    are modified in place (new offsets, sizes and codecs), so pass copies
+    and save their headers afterwards. Returns (bytes before, bytes after).
+    """
+    before = after = 0
+    stored = [email for email in emails if 'body_offset' in email]
+    for month, group in _group_by_partition(stored).items():
+        path = _bodies_path(month)
+        before += os.path.getsize(path)
+        tmp_file = path + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            for start in range(0, len(group), CHUNK_SIZE):
+                chunk = group[start:start + CHUNK_SIZE]
+                _write_bodies(f, chunk, [get_body(email) for email in chunk])
+        os.replace(tmp_file, path)
+        _read_body.cache_clear()
+        after += os.path.getsize(path)
+    return before, after
+
+def body_storage_stats(emails, sample=500):
+    """
+    Stored body bytes per codec, with the compression ratio measured on up
+    to `sample` bodies of each (decompressing everything would defeat the point).
+    """
+    stats = {}
     for email in emails:
-        email_copy = email.copy()
-        if 'timestamp' in email_copy and isinstance(email_copy['timestamp'], datetime):
-            email_copy['timestamp'] = email_copy['timestamp'].isoformat()
-        serializable_emails.append(email_copy)
-        
-    with open(DATA_FILE, 'w') as f:
-        json.dump(serializable_emails, f, indent=2)
+        if 'body_offset' not in email:
+            continue
+        row = stats.setdefault(email.get('body_codec') or "none",
+                               {"emails": 0, "stored_bytes": 0, "sampled_stored": 0, "sampled_raw": 0})
+        row["emails"] += 1
+        row["stored_bytes"] += email['body_length']
+        if row["emails"] <= sample:
+            row["sampled_stored"] += email['body_length']
+            row["sampled_raw"] += len(get_body(email).encode('utf-8'))
+    for row in stats.values():
+        row["ratio"] = round(row.pop("sampled_raw") / max(row.pop("sampled_stored"), 1), 2)
+    return stats
+
+def _write_header_records(f, codec, emails):
+    # Plain dicts (e.g. fresh from ingestion) are converted so timestamps serialize as epoch seconds
+    codec.write_records(f, (
+        (email if isinstance(email, EmailRecord) else EmailRecord.from_dict(email)).to_dict()
+        for email in emails
+    ))
+
+def save_emails(emails):
+    """
+    Rewrite the header files of the partitions the given emails belong to;
+    each of those partitions must be passed complete. Bodies that are only
+    held in memory (new emails) are appended to the body store first and
+    then dropped from the record.
+    """
+    _write_pending_bodies(emails)
+    codec = get_codec()
+    groups = _group_by_partition(emails)
+    for month, group in groups.items():
+        os.makedirs(_partition_dir(month), exist_ok=True)
+        tmp_file = _headers_path(month) + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(codec.magic)
+            _write_header_records(f, codec, group)
+        os.replace(tmp_file, _headers_path(month))
+    _update_manifest(groups, replace=True)
+
+def append_emails(emails):
+    """Append new emails to their month partitions without rewriting existing headers."""
+    emails = [email if isinstance(email, EmailRecord) else EmailRecord.from_dict(email) for email in emails]
+    groups = _group_by_partition(emails)
+    manifest = load_manifest()
+    for month in groups:
+        if manifest.get(month, {}).get("archived"):
+            restore_partition(month)  # New mail for an archived month brings it back
+    _write_pending_bodies(emails)
+    for month, group in groups.items():
+        os.makedirs(_partition_dir(month), exist_ok=True)
+        path = _headers_path(month)
+        # Appends must match whatever format the existing partition was written in
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            codec = detect_codec(path)
+            with open(path, 'ab') as f:
+                _write_header_records(f, codec, group)
+        else:
+            codec = get_codec()
+            with open(path, 'wb') as f:
+                f.write(codec.magic)
+                _write_header_records(f, codec, group)
+    _update_manifest(groups, replace=False)
+
+def partition_stat(month):
+    """[size, mtime_ns] of an active partition's header file, or None. Tells whether a cached copy is current."""
+    try:
+        stat = os.stat(_headers_path(month))
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def partition_size(month, archived=False):
+    """Bytes on disk for one partition (headers + bodies)."""
+    directory = _partition_dir(month, archived)
+    if not os.path.isdir(directory):
+        return 0
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+def _move_partition(month, archived):
+    manifest = load_manifest()
+    if month not in manifest:
+        raise ValueError(f"No partition for {month}")
+    source, target = _partition_dir(month, not archived), _partition_dir(month, archived)
+    if os.path.isdir(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+    manifest[month]["archived"] = archived
+    _dump_document(MANIFEST_FILE, manifest)
+    _read_body.cache_clear()
+
+def archive_partition(month):
+    """Move a month to the archive: it is no longer loaded or searched until restored."""
+    _move_partition(month, archived=True)
+
+def restore_partition(month):
+    _move_partition(month, archived=False)
+
+def delete_all_emails():
+    """
+    Remove every partition (archived ones included), the manifest, the body
+    dictionary and the import state, so a mailbox imported before can be
+    imported again.
+    """
+    global _zstd_dictionary
+    shutil.rmtree(PARTITIONS_DIR, ignore_errors=True)
+    shutil.rmtree(ARCHIVE_DIR, ignore_errors=True)
+    for path in (MANIFEST_FILE, BODY_DICT_FILE, IMPORT_STATE_FILE, IMPORT_LOG_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    _zstd_dictionary = None
+    _read_body.cache_clear()
+
+# Earlier defaults that contradict the current output specs; replaced on load if never edited
+OUTDATED_PROMPTS = {
+    "Action Extraction": "Extract any action items or tasks from the following email. Return them as a JSON list of strings. If none, return [].",
+}
 
 def load_prompts():
     if not os.path.exists(PROMPTS_FILE):
         save_prompts(DEFAULT_PROMPTS)
         return DEFAULT_PROMPTS
     try:
-        with open(PROMPTS_FILE, 'r') as f:
-            return json.load(f)
+        prompts = _load_document(PROMPTS_FILE)
     except:
         return DEFAULT_PROMPTS
+    outdated = [name for name, template in OUTDATED_PROMPTS.items()
+                if prompts.get(name, {}).get('template') == template]
+    for name in outdated:
+        prompts[name] = dict(prompts[name], template=DEFAULT_PROMPTS[name]['template'])
+    if outdated:
+        save_prompts(prompts)
+    return prompts
 
 def save_prompts(prompts):
-    with open(PROMPTS_FILE, 'w') as f:
-        json.dump(prompts, f, indent=2)
+    _dump_document(PROMPTS_FILE, prompts)
 
 def load_drafts():
     if not os.path.exists(DRAFTS_FILE):
         return []
     try:
-        with open(DRAFTS_FILE, 'r') as f:
-            return json.load(f)
+        return _load_document(DRAFTS_FILE)
     except:
         return []
 
 def save_drafts(drafts):
-    with open(DRAFTS_FILE, 'w') as f:
-        json.dump(drafts, f, indent=2)
+    _dump_document(DRAFTS_FILE, drafts)
 
 def add_draft(email_id, subject, body):
     drafts = load_drafts()
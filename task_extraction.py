@@ -0,0 +1,236 @@
+import bisect
+import json
+import os
+import re
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+# Local results at or above this confidence are used as-is; below it the LLM is asked
+LOCAL_TASK_CONFIDENCE = float(os.getenv("LOCAL_TASK_CONFIDENCE", "0.5"))
+
+# Confidence of each kind of local evidence
+SECTION_CONFIDENCE = 0.9    # Items under an "ACTION ITEMS:" style header, or checkboxes
+DEADLINE_CONFIDENCE = 0.6   # "... must be submitted by Friday, Nov 29"
+OBLIGATION_CONFIDENCE = 0.3  # "Please confirm receipt" (no date: a guess, the LLM decides)
+
+HEADER_KEYWORDS = re.compile(r"\b(action|actions|required|to-?do|tasks?|next steps|deliverables|preparation)\b", re.IGNORECASE)
+LIST_ITEM = re.compile(r"^\s*(?:\d{1,2}[.)]|[-*•]|□|☐|\[ \])\s+(.*\S)")
+CHECKBOX_ITEM = re.compile(r"^\s*(?:□|☐|\[ \])\s+(.*\S)")
+DEADLINE_CUE = re.compile(r"\b(by|due|before|until|deadline|no later than)\b", re.IGNORECASE)
+OBLIGATION_CUE = re.compile(r"\b(please|must|need to|needs to|required to|make sure|don't forget)\b", re.IGNORECASE)
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+
+MONTHS = {name: i + 1 for i, names in enumerate([
+    ("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"), ("may",),
+    ("jun", "june"), ("jul", "july"), ("aug", "august"), ("sep", "sept", "september"),
+    ("oct", "october"), ("nov", "november"), ("dec", "december"),
+]) for name in names}
+WEEKDAYS = {name: i for i, name in enumerate(["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"])}
+
+MONTH_DATE = re.compile(r"\b(" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?\s+(\d{1,2})(?:st|nd|rd|th)?\b(?:,?\s+(\d{4}))?", re.IGNORECASE)
+ISO_DATE = re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b")
+WEEKDAY = re.compile(r"\b(next\s+)?(" + "|".join(WEEKDAYS) + r")\b", re.IGNORECASE)
+RELATIVE_DAY = re.compile(r"\b(today|tonight|tomorrow|eod|end of (?:the )?day|cob|end of (?:the )?week)\b", re.IGNORECASE)
+TIME_OF_DAY = re.compile(r"\b(\d{1,2})(?::(\d{2}))?\s*([ap])\.?m\.?\b|\b(noon|midnight)\b", re.IGNORECASE)
+
+
+def parse_due(text: str, received: datetime) -> Optional[str]:
+    """
+    Normalize the first deadline in text to an ISO date ("2025-11-29"), or a
+    date and time ("2025-11-29T17:00") when a time is given. Relative dates
+    ("tomorrow", "Friday") are resolved against the email's received time.
+    """
+    base = received.date() if isinstance(received, datetime) else received or date.today()
+    due = None
+    match = MONTH_DATE.search(text)
+    if match:
+        month, day = MONTHS[match.group(1).lower()], int(match.group(2))
+        year = int(match.group(3)) if match.group(3) else base.year
+        try:
+            due = date(year, month, day)
+        except ValueError:
+            due = None
+        if due and not match.group(3) and due < base - timedelta(days=60):
+            due = due.replace(year=year + 1)  # "Jan 5" in a December email
+    if due is None:
+        match = ISO_DATE.search(text)
+        if match:
+            try:
+                due = date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+            except ValueError:
+                due = None
+    if due is None:
+        match = WEEKDAY.search(text)
+        if match:
+            ahead = (WEEKDAYS[match.group(2).lower()] - base.weekday()) % 7
+            due = base + timedelta(days=ahead + (7 if match.group(1) and ahead < 7 else 0))
+    if due is None:
+        match = RELATIVE_DAY.search(text)
+        if match:
+            word = match.group(1).lower()
+            if word == "tomorrow":
+                due = base + timedelta(days=1)
+            elif word.startswith("end of") and word.endswith("week"):
+                due = base + timedelta(days=(4 - base.weekday()) % 7)
+            else:
+                due = base
+    if due is None:
+        return None
+
+    match = TIME_OF_DAY.search(text)
+    if not match:
+        return due.isoformat()
+    if match.group(4):
+        hour, minute = (12, 0) if match.group(4).lower() == "noon" else (23, 59)
+    else:
+        hour, minute = int(match.group(1)) % 12, int(match.group(2) or 0)
+        if match.group(3).lower() == "p":
+            hour += 12
+    if hour > 23 or minute > 59:
+        return due.isoformat()
+    return f"{due.isoformat()}T{hour:02d}:{minute:02d}"
+
+
+def _is_header(line: str) -> bool:
+    """'ACTION ITEMS:', 'REQUIRED DOCUMENTATION (Due by Friday, Nov 29):', 'Please send me by 5 PM today:'"""
+    stripped = line.strip()
+    if not stripped.endswith(":") or len(stripped) > 120 or LIST_ITEM.match(stripped):
+        return False
+    return bool(HEADER_KEYWORDS.search(stripped)) or stripped.lower().startswith("please")
+
+
+def extract_tasks(body: str, received: datetime) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    Deterministic action-item extraction.
+
+    Picks up items listed under action headers ("ACTION ITEMS:", "REQUIRED
+    ACTION:", "Please send me by 5 PM today:"), checkbox lines and sentences
+    that combine an obligation with a deadline. Each task gets a normalized
+    due date from its own text, else from its section header.
+    Returns: ([{"text", "due"}], confidence); confidence is 0.0 if nothing was found.
+    """
+    tasks: List[Dict[str, Any]] = []
+    seen = set()
+    confidence = 0.0
+
+    def add(text, due, level):
+        nonlocal confidence
+        text = re.sub(r"\s+", " ", text).strip().rstrip(":")
+        key = text.lower()
+        if len(text) < 3 or key in seen:
+            return
+        seen.add(key)
+        tasks.append({"text": text[:200], "due": due, "confidence": level})
+        confidence = max(confidence, level)
+
+    lines = (body or "").split("\n")
+    in_section = set()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if _is_header(line):
+            header_due = parse_due(line, received)
+            j = i + 1
+            while j < len(lines) and not lines[j].strip():
+                j += 1
+            if j < len(lines) and not LIST_ITEM.match(lines[j]) and not _is_header(lines[j]):
+                # "REQUIRED ACTION:" followed by a single paragraph
+                add(lines[j], parse_due(lines[j], received) or header_due, SECTION_CONFIDENCE)
+                in_section.add(j)
+                i = j + 1
+                continue
+            while j < len(lines):
+                match = LIST_ITEM.match(lines[j])
+                if not match:
+                    break
+                add(match.group(1), parse_due(match.group(1), received) or header_due, SECTION_CONFIDENCE)
+                in_section.add(j)
+                j += 1
+            i = j
+            continue
+        match = CHECKBOX_ITEM.match(line)
+        if match:
+            add(match.group(1), parse_due(match.group(1), received), SECTION_CONFIDENCE)
+            in_section.add(i)
+        i += 1
+
+    # Sentences outside the sections: an obligation with a deadline, or (weakly) without one
+    for index, line in enumerate(lines):
+        if index in in_section or _is_header(line) or LIST_ITEM.match(line):
+            continue
+        for sentence in SENTENCE_SPLIT.split(line.strip()):
+            if not OBLIGATION_CUE.search(sentence):
+                continue
+            due = parse_due(sentence, received) if DEADLINE_CUE.search(sentence) else None
+            add(sentence, due, DEADLINE_CONFIDENCE if due else OBLIGATION_CONFIDENCE)
+
+    # Undated "please ..." sentences are only kept when there is nothing better
+    if confidence > OBLIGATION_CONFIDENCE:
+        tasks = [task for task in tasks if task["confidence"] > OBLIGATION_CONFIDENCE]
+    for task in tasks:
+        del task["confidence"]
+    return tasks, confidence
+
+
+class TaskIndex:
+    """
+    Tasks from every email, kept sorted by due date so the cross-inbox task
+    list is a range lookup rather than a scan of every email. Tasks without
+    a due date sort last. Persisted as {email_id: [tasks]}.
+    """
+
+    def __init__(self):
+        self.by_email: Dict[int, List[Dict[str, Any]]] = {}
+        self._sorted: Optional[List[Tuple[str, int, int]]] = None  # (due, email_id, position)
+
+    def set(self, email_id, tasks: List[Dict[str, Any]]):
+        self.by_email[email_id] = list(tasks)
+        self._sorted = None
+
+    def remove(self, email_id):
+        if self.by_email.pop(email_id, None) is not None:
+            self._sorted = None
+
+    def __contains__(self, email_id) -> bool:
+        return email_id in self.by_email
+
+    def _entries(self):
+        if self._sorted is None:
+            self._sorted = sorted(
+                (task.get("due") or "~", email_id, position)  # "~" sorts after any ISO date
+                for email_id, tasks in self.by_email.items()
+                for position, task in enumerate(tasks)
+            )
+        return self._sorted
+
+    def between(self, start: Optional[str] = None, end: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Tasks with start <= due < end (ISO strings; None = unbounded), earliest first."""
+        entries = self._entries()
+        lo = bisect.bisect_left(entries, (start,)) if start else 0
+        hi = bisect.bisect_left(entries, (end,)) if end else len(entries)
+        return [dict(self.by_email[email_id][position], email_id=email_id)
+                for _, email_id, position in entries[lo:hi]]
+
+    def undated(self) -> List[Dict[str, Any]]:
+        return self.between("~")
+
+    def __len__(self):
+        return len(self._entries())
+
+    def save(self, path: str):
+        tmp_file = path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({str(k): v for k, v in self.by_email.items()}, f)
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TaskIndex":
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        try:
+            with open(path, 'r') as f:
+                index.by_email = {int(k): v for k, v in json.load(f).items()}
+        except Exception as e:
+            print(f"Error loading task index: {e}")
+        return index
@@ -0,0 +1,160 @@
+import json
+import math
+import os
+import re
+import zlib
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+VECTOR_DIM = int(os.getenv("VECTOR_DIM", "128"))
+DF_BUCKETS = 1 << 20  # Hash space for document frequencies (idf), independent of VECTOR_DIM
+TOKEN_PATTERN = re.compile(r"[a-z0-9][a-z0-9'_-]+")
+STOPWORDS = frozenset(
+    "the and for you your with this that are was from have has will our not but all can "
+    "any its been they their there what when which who would about into more also".split()
+)
+
+
+def _tokens(text: str) -> List[str]:
+    words = [w for w in TOKEN_PATTERN.findall((text or "").lower()) if w not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def _feature(token: str) -> Tuple[int, int, float]:
+    """(df bucket, vector dimension, sign) for a token, all derived from one CRC."""
+    h = zlib.crc32(token.encode('utf-8'))
+    return h % DF_BUCKETS, (h >> 1) % VECTOR_DIM, 1.0 if h & 1 else -1.0
+
+
+class VectorIndex:
+    """
+    CPU-only semantic search index.
+
+    Each email is embedded as a hashed TF-IDF vector (unigrams + bigrams,
+    sublinear tf, signed feature hashing into VECTOR_DIM dimensions) and
+    L2-normalized, so a query is a single matrix-vector product over a
+    contiguous float32 matrix followed by a top-k partition.
+
+    Vectors live in a memory-mapped file that grows by doubling; idf is
+    computed from document frequencies at the time an email is added, so
+    adding emails never requires re-embedding existing ones.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.meta_file = os.path.join(directory, "vectors.json")
+        self.vectors_file = os.path.join(directory, "vectors.f32")
+        self.ids_file = os.path.join(directory, "vector_ids.i64")
+        self.df_file = os.path.join(directory, "vector_df.i32")
+        self.count = 0
+        self.capacity = 0
+        self.vectors = None
+        self.ids = None
+        self.df = np.zeros(DF_BUCKETS, dtype=np.int32)
+        self._id_set = set()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.meta_file):
+            return
+        try:
+            with open(self.meta_file, 'r') as f:
+                meta = json.load(f)
+            if meta.get("dim") != VECTOR_DIM:
+                print("Vector dimension changed; the search index will be rebuilt.")
+                return
+            self.count = meta["count"]
+            self._map(meta["capacity"])
+            self.df = np.fromfile(self.df_file, dtype=np.int32)
+            self._id_set = set(self.ids[:self.count].tolist())
+        except Exception as e:
+            print(f"Error loading vector index: {e}")
+            self.count, self.capacity, self.vectors, self.ids = 0, 0, None, None
+
+    def _map(self, capacity: int):
+        """Memory-map the vector and id files at the given capacity (creating/growing them)."""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.ids.flush()
+        for path, itemsize in ((self.vectors_file, 4 * VECTOR_DIM), (self.ids_file, 8)):
+            with open(path, 'ab') as f:
+                f.truncate(capacity * itemsize)
+        self.vectors = np.memmap(self.vectors_file, dtype=np.float32, mode='r+', shape=(capacity, VECTOR_DIM))
+        self.ids = np.memmap(self.ids_file, dtype=np.int64, mode='r+', shape=(capacity,))
+        self.capacity = capacity
+
+    def __contains__(self, email_id) -> bool:
+        return email_id in self._id_set
+
+    def __len__(self) -> int:
+        return self.count
+
+    def embed(self, text: str, update_df: bool = False) -> np.ndarray:
+        counts = {}
+        for token in _tokens(text):
+            counts[token] = counts.get(token, 0) + 1
+        vector = np.zeros(VECTOR_DIM, dtype=np.float32)
+        if not counts:
+            return vector
+        features = [(_feature(token), count) for token, count in counts.items()]
+        if update_df:
+            for (bucket, _, _), _ in features:
+                self.df[bucket] += 1
+        total = max(self.count, 1)
+        for (bucket, dim, sign), count in features:
+            idf = math.log((1 + total) / (1 + self.df[bucket])) + 1.0
+            vector[dim] += sign * (1.0 + math.log(count)) * idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def add(self, items: Iterable[Tuple[int, str]]):
+        """Embed and append (email_id, text) pairs; ids already indexed are skipped."""
+        items = [(email_id, text) for email_id, text in items if email_id not in self._id_set]
+        if not items:
+            return
+        needed = self.count + len(items)
+        if needed > self.capacity:
+            capacity = max(1024, self.capacity)
+            while capacity < needed:
+                capacity *= 2
+            self._map(capacity)
+        for email_id, text in items:
+            self.vectors[self.count] = self.embed(text, update_df=True)
+            self.ids[self.count] = email_id
+            self._id_set.add(email_id)
+            self.count += 1
+        self.flush()
+
+    def flush(self):
+        if self.vectors is None:
+            return
+        self.vectors.flush()
+        self.ids.flush()
+        self.df.tofile(self.df_file)
+        tmp_file = self.meta_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({"dim": VECTOR_DIM, "count": self.count, "capacity": self.capacity}, f)
+        os.replace(tmp_file, self.meta_file)
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[int, float]]:
+        """Top-k (email_id, cosine similarity) pairs, best first."""
+        if not self.count:
+            return []
+        query_vector = self.embed(query)
+        if not query_vector.any():
+            return []
+        scores = self.vectors[:self.count] @ query_vector
+        k = min(k, self.count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+    def clear(self):
+        self.count, self.capacity, self.vectors, self.ids = 0, 0, None, None
+        for path in (self.meta_file, self.vectors_file, self.ids_file, self.df_file):
+            if os.path.exists(path):
+                os.remove(path)
+        self.df = np.zeros(DF_BUCKETS, dtype=np.int32)
+        self._id_set = set()